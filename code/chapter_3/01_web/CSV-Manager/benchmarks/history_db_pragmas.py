@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the sqlite pragmas of the history database.
+
+Measures archive throughput of a single writer and the number of history page reads,
+which concurrent readers can perform meanwhile. Runs once with sqlite defaults and once
+with SQLITE_PRAGMAS from the application configuration.
+
+Usage::
+
+    python benchmarks/history_db_pragmas.py [versions] [rows_per_version] [readers]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from _datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from csv_manager.applications.configuration import SQLITE_PRAGMAS
+from csv_manager.database import apply_sqlite_pragmas
+from csv_manager.plugins.csv_document_plugin.models import get_models
+
+
+class BenchmarkDatabase:
+    def __init__(self, url, pragmas):
+        self.engine = create_engine(url)
+        apply_sqlite_pragmas(self.engine, pragmas)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        self.Base = declarative_base()
+        self.Base.query = self.session.query_property()
+
+
+def run(pragmas, versions, rows_per_version, readers):
+    with tempfile.TemporaryDirectory() as path:
+        db = BenchmarkDatabase("sqlite:///%s" % os.path.join(path, "history_db.db"), pragmas)
+        try:
+            return _measure(db, versions, rows_per_version, readers)
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+
+
+def _measure(db, versions, rows_per_version, readers):
+    CsvFile, Version, MissingRow, NewRow, Snapshot, RowLineage, VersionSummary, CellChange, RowBlob = \
+        get_models(db)
+    db.Base.metadata.create_all(db.engine)
+
+    stop = threading.Event()
+    reads = []
+    read_errors = []
+
+    def _reader():
+        count = 0
+        errors = 0
+        while not stop.is_set():
+            try:
+                for csv_file in db.session.query(CsvFile).all():
+                    for version in csv_file.version[-10:]:
+                        len(version.new_row)
+                count += 1
+            except OperationalError:
+                errors += 1
+            db.session.remove()
+        reads.append(count)
+        read_errors.append(errors)
+
+    csv_file = CsvFile(name="benchmark.csv", created=datetime.utcnow(), current_version=0)
+    db.session.add(csv_file)
+    db.session.commit()
+
+    reader_threads = [threading.Thread(target=_reader) for _ in range(readers)]
+    for thread in reader_threads:
+        thread.start()
+
+    start = time.time()
+    for number in range(1, versions + 1):
+        csv_file.current_version = number
+        version = Version(version=number, created=datetime.utcnow(), csv_file=csv_file)
+        db.session.add(version)
+        for row in range(rows_per_version):
+            db.session.add(NewRow(row={"id": str(row), "value": str(number)}, version=version))
+        db.session.commit()
+    duration = time.time() - start
+
+    stop.set()
+    for thread in reader_threads:
+        thread.join()
+
+    return versions / duration, sum(reads) / duration, sum(read_errors)
+
+
+def main():
+    versions = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rows_per_version = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    print("%s versions with %s rows, %s concurrent readers" % (versions, rows_per_version, readers))
+    for name, pragmas in (("sqlite defaults", None), ("SQLITE_PRAGMAS", SQLITE_PRAGMAS)):
+        archived, read, errors = run(pragmas, versions, rows_per_version, readers)
+        print("%-16s archived versions/s: %8.1f   history reads/s: %8.1f   failed reads: %s" %
+              (name, archived, read, errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,16 +17,112 @@ APP_STRICT = True
 
 CSV_FILES = ["test2.csv"]
 CSV_INTERVAL = 2
+# Seconds to wait for the thread of an unregistered csv watcher to end
+CSV_WATCHER_JOIN_TIMEOUT = 5
+# The first checks of new watchers get spread over up to CSV_WATCHER_STARTUP_JITTER seconds (at most their interval)
+# and only CSV_WATCHER_STARTUP_CONCURRENCY of them run at the same time.
+CSV_WATCHER_STARTUP_JITTER = 10
+CSV_WATCHER_STARTUP_CONCURRENCY = 4
+# Starts the watchers in background, so that the activation of the watcher plugins returns immediately
+CSV_WATCHER_LAZY_START = False
 
 WATCHER_DATABASE_NAME = "WATCHER_DB"
 WATCHER_DATABASE_DESCRIPTION = "DB for CSV file watchers"
 WATCHER_DATABASE_LOCATION = "%s/watcher_db.db" % APP_PATH
 WATCHER_DATABASE_CONNECTION = "sqlite:///%s" % WATCHER_DATABASE_LOCATION
 
+# Pragmas, which get executed on each new sqlite connection.
+# WAL lets the web views read, while a watcher is archiving changes.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # in KiB, if negative
+    "mmap_size": 268435456,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+WATCHER_DATABASE_PRAGMAS = SQLITE_PRAGMAS
+
+# Seconds between two checks of the watcher table. Watchers of added, changed or removed rows get started,
+# updated or stopped without a restart.
+WATCHER_RECONCILE_INTERVAL = 5
+
 HISTORY_DATABASE_NAME = "HISTORY_DB"
 HISTORY_DATABASE_DESCRIPTION = "DB for CSV history"
 HISTORY_DATABASE_LOCATION = "%s/history_db.db" % APP_PATH
 HISTORY_DATABASE_CONNECTION = "sqlite:///%s" % HISTORY_DATABASE_LOCATION
+HISTORY_DATABASE_PRAGMAS = SQLITE_PRAGMAS
+
+# Number of history databases. Each csv file gets archived into one of them, chosen by a hash of its name
+# or by HISTORY_DATABASE_SHARD_MAP ({"file.csv": shard_index}).
+# Shard 0 uses HISTORY_DATABASE_CONNECTION, the others get a suffix like history_db_1.db.
+# Use HISTORY_DATABASE_SHARD_CONNECTIONS to place each shard on its own disk.
+# If sharding gets enabled for an existing history database, pin its files to shard 0 with the shard map.
+HISTORY_DATABASE_SHARDS = 1
+HISTORY_DATABASE_SHARD_MAP = {}
+
+# Columns, which identify a row of a csv file. For these files the history of each single row
+# gets recorded and can be requested by the command csv_history_lineage.
+HISTORY_KEY_COLUMNS = {
+    "test2.csv": ["name"],
+}
+
+# Stores modified rows of files with key columns as changed cells (key, column, old value, new value)
+# instead of a full missing and a full new row. Saves space for wide files, where only a few cells change.
+HISTORY_CELL_DELTAS = False
+
+# Stores the missing and new rows of each version as one compressed, column oriented blob
+# instead of one database row per csv row.
+HISTORY_ROW_BLOBS = False
+
+# Page sizes of the history web view: files per page, versions per page and rows per version
+HISTORY_VIEW_FILES = 20
+HISTORY_VIEW_VERSIONS = 10
+HISTORY_VIEW_ROWS = 50
+
+# Rendered html and rst snippets of archived versions get cached, as a version never changes after archiving.
+# HISTORY_FRAGMENT_CACHE is the number of snippets kept in memory. If HISTORY_FRAGMENT_PATH is set,
+# snippets get stored on disk there as well and survive restarts, e.g. "%s/history_fragments" % APP_PATH
+HISTORY_FRAGMENT_CACHE = 1000
+HISTORY_FRAGMENT_PATH = None
+
+# In-memory read model of the history: metadata of files and versions and the rows of recent versions.
+# History views, api and CsvDocument are served from it and read the history databases only on a miss.
+# HISTORY_READ_MODEL_SIZE is its estimated maximum size in bytes,
+# HISTORY_READ_MODEL_VERSIONS the number of newest versions it keeps per file.
+HISTORY_READ_MODEL_SIZE = 64 * 1024 * 1024
+HISTORY_READ_MODEL_VERSIONS = 100
+
+# Live change stream /csv/stream: buffered events per client, before a slow client gets dropped,
+# and seconds between two keepalive messages
+HISTORY_STREAM_BUFFER = 100
+HISTORY_STREAM_KEEPALIVE = 15
+
+# A full snapshot of a csv file gets stored after this amount of versions or changed rows.
+# Reconstructing an old version needs to replay only the deltas since the nearest snapshot.
+# Set a value to 0 to disable the related trigger.
+HISTORY_CHECKPOINT_VERSIONS = 50
+HISTORY_CHECKPOINT_ROWS = 10000
+
+# Squashing of old versions. Disabled by default, as squashed versions can not be read anymore.
+# To enable it, set a dictionary like {"keep_versions": 100, "keep_days": 30, "squash": "daily"}:
+# Versions, which are not among the newest keep_versions and older than keep_days, get squashed
+# in background into one version per day ("daily") or into a single version ("all").
+# The command csv_history_compact applies the policy once.
+HISTORY_RETENTION = None
+HISTORY_COMPACTION_INTERVAL = 3600
+HISTORY_COMPACTION_BATCH_SIZE = 500
+
+# "sqlite" stores the changed rows of each version only.
+# "git" commits the full content of each version into a bare git repository at HISTORY_GIT_PATH instead
+# and stores only the commit id. Git packs similar contents as deltas and old versions get read from there
+# without replaying changes. Versions archived this way need the repository, even if the storage gets changed later.
+# "segments" appends the rows of each version to compressed segment files at HISTORY_SEGMENT_PATH instead,
+# which get rotated after HISTORY_SEGMENT_SIZE bytes. Each version gets read from there with a single seek.
+HISTORY_STORAGE = "sqlite"
+HISTORY_GIT_PATH = "%s/history_git" % APP_PATH
+HISTORY_SEGMENT_PATH = "%s/history_segments" % APP_PATH
+HISTORY_SEGMENT_SIZE = 64 * 1024 * 1024
 
 
 GROUNDWORK_LOGGING = {
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for the sqlite databases used by the csv_manager plugins.
+"""
+from sqlalchemy import event
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    Executes the given pragmas on each new connection of an sqlite engine.
+
+    Engines of other database types are not touched.
+
+    :param engine: sqlalchemy engine, e.g. ``db.engine`` of a groundwork-database database
+    :param pragmas: Dictionary of pragma names and values, e.g. ``{"journal_mode": "WAL"}``
+    """
+    if not pragmas or engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA %s=%s" % (pragma, value))
+        cursor.close()
+
+    # Already opened connections do not know the pragmas yet
+    engine.dispose()
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import time
 import csv
+import logging
+import random
+import threading
 
 from groundwork.patterns import GwThreadsPattern
 from groundwork.util import gw_get
 
+# Seconds between two checks for a stop request, while a watcher waits for a free startup slot
+STARTUP_POLL_INTERVAL = 0.5
+
 
 class CsvWatcherPattern(GwThreadsPattern):
     def __init__(self, app, **kwargs):
@@ -20,7 +25,7 @@ class CsvWatcherPattern(GwThreadsPattern):
         # Adds csv_watcher on application level
         # This is done only once for each application
         if not hasattr(app, "csv_watcher"):
-            app.csv_watcher = CsvWatcherApplication()
+            app.csv_watcher = CsvWatcherApplication(app)
 
         # Registers a signal, which get s called every time a change
         # is detected inside an watched csv file.
@@ -41,24 +46,48 @@ class CsvWatcherPlugin:
         self._app = plugin.app
         self._watchers = {}
 
+        # Stops the watchers of the plugin, when it gets deactivated
+        self._plugin.signals.connect(receiver="%s_csv_watchers_deactivation" % self._plugin.name,
+                                     signal="plugin_deactivate_post",
+                                     function=self.__deactivate_watchers,
+                                     description="Stop csv watchers of %s" % self._plugin.name,
+                                     sender=self._plugin)
+
+    def __deactivate_watchers(self, plugin, *args, **kwargs):
+        for csv_file in list(self.get().keys()):
+            self.unregister(csv_file)
+
     def register(self, csv_file, interval, description):
         return self._app.csv_watcher.register(csv_file, interval, description, self._plugin)
 
-    def unregister(self, csv_file):
-        return self._app.csv_watcher.unregister(csv_file, self._plugin)
+    def unregister(self, csv_file, timeout=None):
+        return self._app.csv_watcher.unregister(csv_file, self._plugin, timeout)
 
     def get(self, csv_file=None):
         return self._app.csv_watcher.get(csv_file, self._plugin)
 
+    def get_progress(self):
+        return self._app.csv_watcher.get_progress(self._plugin)
+
 
 class CsvWatcherApplication:
     """
     Main class for handling watchers of csv files.
     """
 
-    def __init__(self):
+    def __init__(self, app=None):
+        self.app = app
+        self.log = logging.getLogger(__name__)
         self._watchers = {}
 
+        config = app.config if app is not None else {}
+        # Seconds, over which the first checks of new watchers get spread
+        self.startup_jitter = config.get("CSV_WATCHER_STARTUP_JITTER", 10)
+        # Limits the number of first checks, which run at the same time
+        self.startup = threading.BoundedSemaphore(config.get("CSV_WATCHER_STARTUP_CONCURRENCY", 4))
+        self._ready = 0
+        self._ready_lock = threading.Lock()
+
     def register(self, csv_file, interval, description, plugin):
         if csv_file in self._watchers.keys():
             raise CsvWatcherExistsException("csv file %s is already registered by %s." %
@@ -67,22 +96,77 @@ class CsvWatcherApplication:
         if not os.path.exists(csv_file):
             raise FileNotFoundError("CSV file %s does not exist" % csv_file)
 
-        self._watchers[csv_file] = CsvWatcher(csv_file, interval, description, plugin)
+        delay = random.uniform(0, min(interval, self.startup_jitter))
+        self._watchers[csv_file] = CsvWatcher(csv_file, interval, description, plugin, delay)
         return self._watchers[csv_file]
 
-    def unregister(self, csv_file, plugin):
-        pass
+    def unregister(self, csv_file, plugin, timeout=None):
+        """
+        Stops the watcher of a csv file and removes it.
+
+        :param csv_file: Path of the csv file
+        :param plugin: Plugin, which has registered the watcher
+        :param timeout: Seconds to wait for the end of the watcher thread.
+                        Default is CSV_WATCHER_JOIN_TIMEOUT from the configuration or 5.
+        :return: The removed watcher or None, if the plugin has not registered a watcher for the csv file
+        """
+        watcher = gw_get(self._watchers, csv_file, plugin)
+        if watcher is None:
+            self.log.warning("Can not unregister watcher of %s" % csv_file)
+            return None
+        with self._ready_lock:
+            del self._watchers[csv_file]
+            if watcher.ready:
+                self._ready -= 1
+
+        if timeout is None:
+            timeout = self.app.config.get("CSV_WATCHER_JOIN_TIMEOUT", 5) if self.app is not None else 5
+        if not watcher.stop(timeout):
+            # The thread ends after its current check
+            self.log.warning("Watcher thread of %s did not stop within %s seconds" % (csv_file, timeout))
+        if plugin.threads.get(watcher.csv_thread.name) is not None:
+            plugin.threads.unregister(watcher.csv_thread.name)
+        return watcher
 
     def get(self, csv_file=None, plugin=None):
         return gw_get(self._watchers, csv_file, plugin)
 
+    def get_progress(self, plugin=None):
+        """
+        Returns the number of watchers and of watchers, which have finished their first check.
+
+        :param plugin: Counts only the watchers of this plugin
+        :return: Dictionary with total and ready
+        """
+        watchers = list((self.get(plugin=plugin) or {}).values())
+        return {"total": len(watchers), "ready": len([watcher for watcher in watchers if watcher.ready])}
+
+    def _watcher_ready(self, watcher):
+        with self._ready_lock:
+            if self._watchers.get(watcher.csv_file, None) is not watcher:
+                # Got unregistered in the meantime
+                return
+            watcher.ready = True
+            self._ready += 1
+            ready = self._ready
+            total = len(self._watchers)
+        if ready >= total or ready % 100 == 0:
+            self.log.info("%s of %s csv watchers have finished their first check" % (ready, total))
+
 
 class CsvWatcher:
-    def __init__(self, csv_file, interval, description, plugin):
+    def __init__(self, csv_file, interval, description, plugin, delay=0):
         self.csv_file = csv_file
         self.interval = interval
         self.plugin = plugin
         self.description = description
+        # Seconds before the first check
+        self.delay = delay
+        # True, after the first check has finished
+        self.ready = False
+        # Content of the last check. Released, when the watcher stops.
+        self.snapshot = None
+        self._stop = threading.Event()
 
         # Register thread
         self.csv_thread = plugin.threads.register("csv_thread_%s" % csv_file, self._csv_watcher_thread,
@@ -93,9 +177,23 @@ class CsvWatcher:
     def run(self):
         self.csv_thread.run()
 
+    def stop(self, timeout=None):
+        """
+        Asks the watcher thread to end and waits for it.
+
+        :param timeout: Seconds to wait for the thread. None waits until it has ended.
+        :return: True, if the thread is not running anymore
+        """
+        self._stop.set()
+        thread = self.csv_thread.thread
+        if thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout)
+        # Also set by the thread itself, in case it did not end in time
+        self.snapshot = None
+        return not thread.is_alive()
+
     def _csv_watcher_thread(self, plugin):
         csv_file = self.csv_file
-        interval = self.interval
 
         # Check if the given csv_file really exists
         if not os.path.exists(csv_file):
@@ -103,40 +201,74 @@ class CsvWatcher:
             return
 
         # Start with an "empty csv file"
-        old_content = []
-
-        while True:
-            csv_file_object = open(csv_file)
+        self.snapshot = []
+
+        try:
+            # Spreads the first checks of watchers, which got started at the same time
+            self._stop.wait(self.delay)
+            while not self._stop.is_set():
+                if self.ready:
+                    self._check(plugin)
+                else:
+                    # The first check reads and reports the whole file.
+                    # Only a few of them may run at the same time.
+                    startup = plugin.app.csv_watcher.startup
+                    if not self._acquire(startup):
+                        break
+                    try:
+                        self._check(plugin)
+                    finally:
+                        startup.release()
+                    plugin.app.csv_watcher._watcher_ready(self)
+
+                # Wait x seconds or until the watcher gets stopped.
+                # The interval may get changed while the watcher is running.
+                self._stop.wait(self.interval)
+        finally:
+            self.snapshot = None
+
+    def _acquire(self, semaphore):
+        """
+        Waits for the semaphore, but not longer than the watcher is running.
+
+        :return: True, if the semaphore got acquired. False, if the watcher got stopped before.
+        """
+        while not self._stop.is_set():
+            if semaphore.acquire(timeout=STARTUP_POLL_INTERVAL):
+                if not self._stop.is_set():
+                    return True
+                semaphore.release()
+        return False
+
+    def _check(self, plugin):
+        csv_file = self.csv_file
+        with open(csv_file) as csv_file_object:
             new_content = list(csv.DictReader(csv_file_object))
+        old_content = self.snapshot
 
-            if new_content != old_content:
-                plugin.log.debug("Change detected")
-
-                new_rows = []
-                missing_rows = []
-
-                # Check if there are new/changed rows
-                for row in new_content:
-                    if row not in old_content:
-                        new_rows.append(row)
+        if new_content != old_content:
+            plugin.log.debug("Change detected")
 
-                # Check if old rows are missing
-                for row in old_content:
-                    if row not in new_content:
-                        missing_rows.append(row)
+            new_rows = []
+            missing_rows = []
 
-                # Store the current csv file content as old content
-                old_content = new_content
+            # Check if there are new/changed rows
+            for row in new_content:
+                if row not in old_content:
+                    new_rows.append(row)
 
-                plugin.signals.send("csv_watcher_change",
-                                    csv_file=csv_file,
-                                    new_rows=new_rows,
-                                    missing_rows=missing_rows)
+            # Check if old rows are missing
+            for row in old_content:
+                if row not in new_content:
+                    missing_rows.append(row)
 
-            csv_file_object.close()
+            # Store the current csv file content as old content
+            self.snapshot = new_content
 
-            # Wait x seconds
-            time.sleep(interval)
+            plugin.signals.send("csv_watcher_change",
+                                csv_file=csv_file,
+                                new_rows=new_rows,
+                                missing_rows=missing_rows)
 
 
 class CsvWatcherExistsException(BaseException):
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import queue
+import threading
+
+
+class ChangeBroadcaster:
+    """
+    Fans out archived changes to any number of subscribers, e.g. open event streams of web clients.
+
+    Each subscription has a bounded buffer. If a subscriber does not keep up and its buffer is full,
+    it gets dropped instead of blocking the thread, which publishes the change.
+    """
+
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, csv_file=None):
+        """
+        :param csv_file: Optional name of a csv file. Only its changes get delivered.
+        :return: Subscription, which must be passed to unsubscribe() at the end
+        """
+        subscription = Subscription(csv_file, self.buffer_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event):
+        """
+        Delivers an event to all matching subscriptions. Never blocks.
+
+        :param event: Dictionary, which contains at least csv_file
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.csv_file is not None and subscription.csv_file != event["csv_file"]:
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+
+    def close(self):
+        """
+        Ends all subscriptions.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self._subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.closed = True
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+
+class Subscription:
+    def __init__(self, csv_file, buffer_size):
+        self.csv_file = csv_file
+        self.queue = queue.Queue(buffer_size)
+        self.dropped = False
+        self.closed = False
+
+    def get(self, timeout):
+        """
+        Returns the next event or None, if no event arrived within timeout seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
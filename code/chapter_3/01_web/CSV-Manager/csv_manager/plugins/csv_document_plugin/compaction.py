@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from _datetime import datetime, timedelta
+from itertools import groupby
+
+from sqlalchemy import select, func
+
+from .history import squash_deltas
+
+
+class HistoryCompactor:
+    """
+    Applies the configured retention policy to the history database.
+
+    Old versions get squashed into their net change and superseded rows get deleted in small batches,
+    so that the database write lock is only held for short moments.
+
+    Retention options:
+
+    * ``keep_versions``: The newest n versions of each csv file are never touched.
+    * ``keep_days``: Versions newer than n days are never touched.
+    * ``squash``: ``"daily"`` squashes older versions into one version per day,
+      ``"all"`` squashes them into a single version.
+
+    Days are UTC days, like all archive timestamps.
+    """
+
+    def __init__(self, plugin, shard, retention=None, batch_size=500):
+        self.plugin = plugin
+        self.shard = shard
+        self.log = plugin.log
+        retention = retention or {}
+        self.keep_versions = retention.get("keep_versions", 100)
+        self.keep_days = retention.get("keep_days", 30)
+        self.squash = retention.get("squash", "daily")
+        self.batch_size = batch_size
+
+    def compact(self):
+        """
+        Squashes old versions of all csv files and purges the superseded rows.
+
+        :return: Number of removed versions
+        """
+        shard = self.shard
+        removed = 0
+        for csv_file_object in shard.CsvFile.query.all():
+            removed += self.compact_file(csv_file_object)
+        self.purge_detached()
+        shard.db.session.remove()
+        return removed
+
+    def compact_file(self, csv_file_object):
+        plugin = self.plugin
+        shard = self.shard
+        Version = shard.Version
+
+        # Oldest version, which must be kept because of keep_versions
+        protected = shard.db.query(Version.version) \
+            .filter(Version.csv_file_id == csv_file_object.id) \
+            .order_by(Version.version.desc()) \
+            .offset(max(self.keep_versions - 1, 0)).limit(1).scalar()
+        if protected is None:
+            return 0
+
+        cutoff = datetime.utcnow() - timedelta(days=self.keep_days)
+        candidates = shard.db.query(Version.id, Version.version, Version.created) \
+            .filter(Version.csv_file_id == csv_file_object.id,
+                    Version.version < protected,
+                    Version.created < cutoff) \
+            .order_by(Version.version).all()
+
+        if self.squash == "daily":
+            groups = [list(group) for day, group in groupby(candidates, key=lambda candidate: candidate.created.date())]
+        else:
+            groups = [candidates]
+
+        removed = 0
+        for group in groups:
+            if len(group) > 1:
+                removed += self._squash_versions(csv_file_object, [candidate.id for candidate in group])
+
+        if removed > 0:
+            plugin._checkpoints.pop(csv_file_object.name, None)
+            plugin.fragment_cache.invalidate(csv_file_object.name, protected - 1)
+            plugin.read_model.invalidate(csv_file_object.name, protected - 1)
+            self.log.debug("Squashed %s old versions of %s" % (removed, csv_file_object.name))
+        return removed
+
+    def _squash_versions(self, csv_file_object, version_ids):
+        """
+        Replaces the changes of the last given version by the net change of all given versions
+        and detaches the other versions from their csv file.
+        """
+        plugin = self.plugin
+        shard = self.shard
+        versions = shard.Version.query.filter(shard.Version.id.in_(version_ids)) \
+            .order_by(shard.Version.version).all()
+
+        missing_rows, new_rows = squash_deltas(
+            (missing, new) for version_object, missing, new in
+            plugin.iter_version_deltas(shard, csv_file_object, versions[0].version - 1, versions[-1].version))
+
+        kept_version = versions[-1]
+        superseded_ids = [version.id for version in versions[:-1]]
+
+        # Everything inside a single, short transaction. The bulk of old rows gets deleted later by purge_detached().
+        for row_class in (shard.MissingRow, shard.NewRow, shard.CellChange, shard.RowBlob, shard.RowLineage,
+                          shard.VersionSummary):
+            shard.db.query(row_class).filter(row_class.version_id == kept_version.id) \
+                .delete(synchronize_session=False)
+        plugin.store_version_rows(shard, csv_file_object, kept_version, missing_rows, new_rows)
+        shard.search.remove([kept_version.id])
+        plugin.index_version(shard, csv_file_object, kept_version, missing_rows, new_rows)
+        self.detach_versions(superseded_ids)
+        shard.db.commit()
+        return len(superseded_ids)
+
+    def detach_versions(self, version_ids):
+        """
+        Removes the given versions from their csv file without deleting their rows.
+
+        Detached versions are invisible for all history queries. Their rows and search index entries get deleted
+        by purge_detached(). Must be committed by the caller.
+        """
+        shard = self.shard
+        for start in range(0, len(version_ids), self.batch_size):
+            shard.db.query(shard.Version).filter(shard.Version.id.in_(version_ids[start:start + self.batch_size])) \
+                .update({shard.Version.csv_file_id: None}, synchronize_session=False)
+
+    def detach_csv_file(self, csv_file_id):
+        """
+        Detaches all versions of a csv file. Must be committed by the caller.
+        """
+        shard = self.shard
+        shard.db.query(shard.Version).filter(shard.Version.csv_file_id == csv_file_id) \
+            .update({shard.Version.csv_file_id: None}, synchronize_session=False)
+
+    def count_detached(self):
+        """
+        :return: Number of detached versions and rows, which are waiting for purge_detached()
+        """
+        shard = self.shard
+        detached = self._detached_versions()
+        count = shard.db.query(func.count(shard.Version.id)).filter(shard.Version.csv_file_id.is_(None)).scalar()
+        for row_class in self._row_classes():
+            count += shard.db.query(func.count(row_class.id)).filter(row_class.version_id.in_(detached)).scalar()
+        return count
+
+    def purge_detached(self, progress=None):
+        """
+        Deletes detached versions, their rows and search index entries in batches of batch_size rows.
+        Each batch is committed on its own, so other writers get the database lock between two batches.
+
+        :param progress: Optional function, which gets called with the number of deleted rows after each batch
+        :return: Number of deleted rows
+        """
+        shard = self.shard
+        detached = self._detached_versions()
+
+        deleted = 0
+        for row_class in self._row_classes():
+            row_table = row_class.__table__
+            batch = select([row_table.c.id]).where(row_table.c.version_id.in_(detached)).limit(self.batch_size)
+            while True:
+                result = shard.db.session.execute(row_table.delete().where(row_table.c.id.in_(batch)))
+                shard.db.commit()
+                deleted += result.rowcount
+                if progress is not None:
+                    progress(deleted)
+                if result.rowcount < self.batch_size:
+                    break
+
+        version_table = shard.Version.__table__
+        while True:
+            version_ids = [version_id for version_id, in
+                           shard.db.session.execute(detached.limit(self.batch_size))]
+            if len(version_ids) == 0:
+                break
+            shard.search.remove(version_ids)
+            shard.db.session.execute(version_table.delete().where(version_table.c.id.in_(version_ids)))
+            shard.db.commit()
+            deleted += len(version_ids)
+            if progress is not None:
+                progress(deleted)
+        return deleted
+
+    def _row_classes(self):
+        shard = self.shard
+        return (shard.Snapshot, shard.RowLineage, shard.VersionSummary, shard.CellChange, shard.RowBlob,
+                shard.MissingRow, shard.NewRow)
+
+    def _detached_versions(self):
+        version_table = self.shard.Version.__table__
+        return select([version_table.c.id]).where(version_table.c.csv_file_id.is_(None))
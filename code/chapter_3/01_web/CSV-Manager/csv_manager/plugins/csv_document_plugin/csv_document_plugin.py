@@ -1,27 +1,56 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
+import csv
+import json
+import time
+import heapq
+import hashlib
+import threading
 from _datetime import datetime
-from flask import request, flash, url_for
+from click import Argument, Option
+from flask import request, flash, url_for, jsonify, Response, stream_with_context, abort, make_response, Markup
+from jinja2 import Environment
+from sqlalchemy import func, or_, and_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
 
-from groundwork.patterns import GwDocumentsPattern
+from groundwork.patterns import GwCommandsPattern, GwDocumentsPattern
 from groundwork_database.patterns import GwSqlPattern
 from groundwork_web.patterns import GwWebPattern
 from csv_manager.patterns import CsvWatcherPattern
+from csv_manager.database import apply_sqlite_pragmas
 
-from .models import get_models
+from .history import apply_delta, compress_rows, decompress_rows, get_key_value, get_keyed_changes, \
+    summarize_changes, parse_timestamp, encode_cursor, decode_cursor, squash_deltas, split_cell_changes, \
+    expand_cell_changes, compress_columnar, iter_columnar, diff_rows
+from .compaction import HistoryCompactor
+from .shards import HistoryShard, get_shard_connections, get_shard_index
+from .search import SearchIndex
+from .migrations import migrate
+from .broadcast import ChangeBroadcaster
+from .fragments import FragmentCache
+from .read_model import HistoryReadModel, FileInfo, VersionInfo, get_summary_info
 
 
-class CsvDocumentPlugin(CsvWatcherPattern, GwDocumentsPattern, GwSqlPattern, GwWebPattern):
+class CsvDocumentPlugin(GwCommandsPattern, CsvWatcherPattern, GwDocumentsPattern, GwSqlPattern, GwWebPattern):
     def __init__(self, app, **kwargs):
         self.name = self.__class__.__name__
         super().__init__(app, **kwargs)
         self.archive = {}
-        self.db = None
-        self.CsvFile = None
-        self.Version = None
-        self.MissingRow = None
-        self.NewRow = None
+        self.shards = []
+        self.git_storage = None
+        self.segment_storage = None
+        self.broadcaster = None
+        self.fragment_cache = None
+        self.read_model = None
+        self._version_content = None
+        # Last checkpoint version and rows changed since then, per csv file
+        self._checkpoints = {}
+        self._compaction_stop = threading.Event()
+        # Progress of running history deletions, per csv file
+        self.deletion_jobs = {}
 
     def activate(self):
         this_dir = os.path.dirname(__file__)
@@ -30,19 +59,92 @@ class CsvDocumentPlugin(CsvWatcherPattern, GwDocumentsPattern, GwSqlPattern, GwW
             self.documents.register(name="CsvDocument",
                                     content=doc_content.read(),
                                     description="Stores pass csv watcher activities")
+        with open(os.path.join(this_dir, 'csv_version_content.rst'), 'r') as version_content:
+            self._version_content = Environment().from_string(version_content.read())
 
         self.signals.connect("csv_archive_receiver", "csv_watcher_change",
                              self._archive_csv_change, "listen to changes to archive them.")
 
-        self.db = self.databases.register(self.app.config.get("HISTORY_DATABASE_NAME", "csv_history"),
-                                          self.app.config.get("HISTORY_DATABASE_CONNECTION", "sqlite://"),
-                                          self.app.config.get("HISTORY_DATABASE_DESCRIPTION", "Stores csv history"))
-        self.CsvFile, self.Version, self.MissingRow, self.NewRow = get_models(self.db)
-        self.db.classes.register(self.CsvFile)
-        self.db.classes.register(self.Version)
-        self.db.classes.register(self.MissingRow)
-        self.db.classes.register(self.NewRow)
-        self.db.create_all()
+        self.setup_shards()
+        self.broadcaster = ChangeBroadcaster(self.app.config.get("HISTORY_STREAM_BUFFER", 100))
+        self.fragment_cache = FragmentCache(self.app.config.get("HISTORY_FRAGMENT_CACHE", 1000),
+                                            self.app.config.get("HISTORY_FRAGMENT_PATH", None))
+        self.read_model = HistoryReadModel(self.app.config.get("HISTORY_READ_MODEL_SIZE", 64 * 1024 * 1024),
+                                           self.app.config.get("HISTORY_READ_MODEL_VERSIONS", 100))
+
+        if self.app.config.get("HISTORY_STORAGE", "sqlite") == "git":
+            # Import only if needed, so that sqlite storage works without git being installed
+            from .git_storage import GitHistoryStorage
+            git_path = self.app.config.get("HISTORY_GIT_PATH",
+                                           os.path.join(self.app.config.get("APP_PATH"), "history_git"))
+            self.git_storage = GitHistoryStorage(git_path, self.log)
+        elif self.app.config.get("HISTORY_STORAGE", "sqlite") == "segments":
+            from .segments import SegmentStorage
+            segment_path = self.app.config.get("HISTORY_SEGMENT_PATH",
+                                               os.path.join(self.app.config.get("APP_PATH"), "history_segments"))
+            self.segment_storage = SegmentStorage(segment_path, self.log,
+                                                  self.app.config.get("HISTORY_SEGMENT_SIZE", 64 * 1024 * 1024))
+
+        self.commands.register("csv_history_version",
+                               "Prints the content of a csv file at a given version",
+                               self.csv_history_version,
+                               params=[Argument(("csv_file",), required=True, type=str),
+                                       Argument(("version",), required=True, type=int)])
+
+        self.commands.register("csv_history_search",
+                               "Searches archived rows of all csv files",
+                               self.csv_history_search,
+                               params=[Argument(("query",), required=True, type=str),
+                                       Option(("-f", "--csv_file"), type=str, default=None,
+                                              help="Searches only inside the history of this csv file"),
+                                       Option(("-l", "--limit"), type=int, default=100,
+                                              help="Maximum number of results")])
+
+        self.commands.register("csv_history_lineage",
+                               "Shows all changes of a row, identified by the key columns of its csv file",
+                               self.csv_history_lineage,
+                               params=[Argument(("csv_file",), required=True, type=str),
+                                       Argument(("key",), required=True, type=str)])
+
+        self.commands.register("csv_history_changes",
+                               "Lists the versions of all csv files, which were archived inside a time range (UTC)",
+                               self.csv_history_changes,
+                               params=[Option(("-s", "--start"), type=str, default=None,
+                                              help="Start of the time range, e.g. 2017-05-01 or 2017-05-01 12:30"),
+                                       Option(("-e", "--end"), type=str, default=None,
+                                              help="End of the time range (exclusive)"),
+                                       Option(("-c", "--cursor"), type=str, default=None,
+                                              help="Cursor of the next page, as printed by the previous call"),
+                                       Option(("-l", "--limit"), type=int, default=100,
+                                              help="Maximum number of changes")])
+
+        self.commands.register("csv_history_replay",
+                               "Sends archived versions again as csv_watcher_change signals",
+                               self.csv_history_replay,
+                               params=[Option(("-f", "--csv_file"), type=str, default=None,
+                                              help="Replays only the versions of this csv file"),
+                                       Option(("-s", "--start"), type=str, default=None,
+                                              help="Start of the time range (UTC), e.g. 2017-05-01"),
+                                       Option(("-e", "--end"), type=str, default=None,
+                                              help="End of the time range (UTC, exclusive)"),
+                                       Option(("--speed",), type=float, default=1.0,
+                                              help="1 keeps the original timing, 10 replays ten times faster, "
+                                                   "0 replays as fast as possible")])
+
+        self.commands.register("csv_history_compact",
+                               "Applies the history retention policy once",
+                               self.csv_history_compact)
+
+        retention = self.app.config.get("HISTORY_RETENTION", None)
+        for shard in self.shards:
+            shard.compactor = HistoryCompactor(self, shard, retention,
+                                               self.app.config.get("HISTORY_COMPACTION_BATCH_SIZE", 500))
+        if retention or self.segment_storage is not None:
+            compaction_thread = self.threads.register("csv_history_compaction", self._compaction_thread,
+                                                      "Squashes old csv versions in background")
+            # Must not keep cli commands alive. Each compaction step is committed on its own.
+            compaction_thread.thread.daemon = True
+            compaction_thread.run()
 
         if self.app.web.contexts.get("csv") is None:
             self.web.contexts.register(name="csv",
@@ -56,6 +158,46 @@ class CsvDocumentPlugin(CsvWatcherPattern, GwDocumentsPattern, GwSqlPattern, GwW
                                  endpoint=self._history_view,
                                  context="csv")
 
+        self.web.routes.register(url="/history/version",
+                                 methods=["GET"],
+                                 endpoint=self._history_version_view,
+                                 context="csv")
+
+        self.web.routes.register(url="/stream",
+                                 methods=["GET"],
+                                 endpoint=self._stream_view,
+                                 context="csv")
+
+        self.web.routes.register(url="/search",
+                                 methods=["GET"],
+                                 endpoint=self._search_view,
+                                 context="csv")
+
+        self.web.routes.register(url="/api/files",
+                                 methods=["GET"],
+                                 endpoint=self._files_api,
+                                 context="csv")
+
+        self.web.routes.register(url="/api/versions",
+                                 methods=["GET"],
+                                 endpoint=self._versions_api,
+                                 context="csv")
+
+        self.web.routes.register(url="/api/rows",
+                                 methods=["GET"],
+                                 endpoint=self._rows_api,
+                                 context="csv")
+
+        self.web.routes.register(url="/api/diff",
+                                 methods=["GET"],
+                                 endpoint=self._diff_api,
+                                 context="csv")
+
+        self.web.routes.register(url="/api/changes",
+                                 methods=["GET"],
+                                 endpoint=self._changes_api,
+                                 context="csv")
+
         try:
             menu_csv = self.web.menus.register(name="CSV", link="#")
         except Exception:
@@ -63,60 +205,1423 @@ class CsvDocumentPlugin(CsvWatcherPattern, GwDocumentsPattern, GwSqlPattern, GwW
 
         with self.app.web.flask.app_context():
             menu_csv.register("History", link=url_for("csv._history_view"))
+            menu_csv.register("Search", link=url_for("csv._search_view"))
+
+    def setup_shards(self):
+        """
+        Registers one history database per configured shard.
+        Without HISTORY_DATABASE_SHARDS, only HISTORY_DATABASE_CONNECTION is used.
+        """
+        name = self.app.config.get("HISTORY_DATABASE_NAME", "csv_history")
+        description = self.app.config.get("HISTORY_DATABASE_DESCRIPTION", "Stores csv history")
+        connections = self.app.config.get("HISTORY_DATABASE_SHARD_CONNECTIONS", None)
+        if not connections:
+            connections = get_shard_connections(self.app.config.get("HISTORY_DATABASE_CONNECTION", "sqlite://"),
+                                                self.app.config.get("HISTORY_DATABASE_SHARDS", 1))
+
+        for index, connection in enumerate(connections):
+            if index > 0:
+                db = self.databases.register("%s_%s" % (name, index), connection,
+                                             "%s (shard %s)" % (description, index))
+            else:
+                db = self.databases.register(name, connection, description)
+            apply_sqlite_pragmas(db.engine, self.app.config.get("HISTORY_DATABASE_PRAGMAS", None))
+            shard = HistoryShard(index, db)
+            shard.search = SearchIndex(shard, self.log)
+            self.shards.append(shard)
+        for shard in self.shards:
+            migrate(shard, self.log, self)
+
+    def get_shard(self, csv_file):
+        """
+        Returns the history shard, which archives the given csv file.
+        """
+        return self.shards[get_shard_index(csv_file, len(self.shards),
+                                           self.app.config.get("HISTORY_DATABASE_SHARD_MAP", None))]
 
     def _history_view(self):
 
         if request.method == 'POST':
             csv_file = request.form['csv_file']
-            csv_file_object = self.CsvFile.query.filter_by(name=csv_file).first()
-            versions = self.Version.query.filter_by(csv_file=csv_file_object).all()
-            for version in versions:
-                self.db.session.delete(version)
-            self.db.commit()
-            flash("Versions of %s deleted" % request.form['csv_file'])
-        watchers = self.get_csv_history()
-        return self.web.render("csv_history.html", watchers=watchers)
+            if csv_file in self.deletion_jobs.keys() and not self.deletion_jobs[csv_file]["done"]:
+                flash("Versions of %s are already getting deleted" % csv_file)
+            elif request.form.get("background", None):
+                self.delete_csv_history_background(csv_file)
+                flash("Deletion of versions of %s started" % csv_file)
+            else:
+                self.delete_csv_history(csv_file)
+                flash("Versions of %s deleted" % csv_file)
+
+            return self.web.render("csv_history.html", **self._get_history_page(request.args.get("csv_file", None)))
+
+        csv_file = request.args.get("csv_file", None)
+        return self._conditional_response(self.get_history_etag(csv_file),
+                                          lambda: self.web.render("csv_history.html",
+                                                                  **self._get_history_page(csv_file)))
+
+    def _get_history_page(self, csv_file=None):
+        row_limit = self.app.config.get("HISTORY_VIEW_ROWS", 50)
+        if csv_file:
+            # Versions of a single file, newest first
+            shard = self.get_shard(csv_file)
+            versions, next_before = self.get_versions_page(csv_file, request.args.get("before", None, type=int),
+                                                           self.app.config.get("HISTORY_VIEW_VERSIONS", 10))
+            fragments = dict((version_object.version, self._render_version_fragment(shard, csv_file, version_object,
+                                                                                    row_limit))
+                             for version_object in versions)
+            return dict(csv_file=csv_file, versions=versions, fragments=fragments, next_before=next_before,
+                        deletion_jobs=self.deletion_jobs)
+
+        files_per_page = self.app.config.get("HISTORY_VIEW_FILES", 20)
+        page = max(request.args.get("page", 1, type=int), 1)
+        csv_files = self.get_csv_files((page - 1) * files_per_page, files_per_page + 1)
+        return dict(csv_files=csv_files[:files_per_page], page=page, has_next=len(csv_files) > files_per_page,
+                    deletion_jobs=self.deletion_jobs)
+
+    def _render_version_fragment(self, shard, csv_file, version_object, row_limit):
+        """
+        Returns the html snippet of a version for the history page. Its changes get only loaded,
+        if the snippet is not cached yet.
+        The revision is part of the key, so snippets of squashed versions are never served, even if another
+        process squashed them.
+        """
+        def _render():
+            changes = self._get_version_changes(shard, csv_file, version_object, 0, row_limit)
+            return self.web.render("csv_history_fragment.html", csv_file=csv_file, version=version_object,
+                                   changes=changes)
+
+        revision = version_object.summary.id if version_object.summary is not None else 0
+        return Markup(self.fragment_cache.get_or_render(csv_file, version_object.version,
+                                                        "html_%s_%s" % (row_limit, revision), _render))
+
+    @staticmethod
+    def _conditional_response(etag, render, cache_control="no-cache"):
+        """
+        Answers with 304, if the client already has the current version of the page. Otherwise renders it.
+        """
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(render())
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    def get_history_etag(self, csv_file=None):
+        """
+        Returns an ETag for the history pages. It changes with each new, deleted or squashed version.
+        The read model gets validated against the same state, so that the page matches its ETag.
+
+        :param csv_file: Name of a csv file for its version pages or None for the list of files
+        """
+        state = self.validate_read_model(csv_file)
+        # The pages show the progress of running deletions
+        jobs = sorted((name, job["deleted"], job["total"])
+                      for name, job in self.deletion_jobs.items() if not job["done"])
+        return hashlib.sha1(repr((csv_file, state, jobs)).encode("utf-8")).hexdigest()
+
+    def validate_read_model(self, csv_file=None):
+        """
+        Drops the read model entries of a csv file or, for None, the list of files, if the history database
+        got changed by another process, e.g. by compaction, deletion or replay commands.
+
+        :return: State of the history database, which changes with each new, deleted or squashed version
+        """
+        if csv_file:
+            shard = self.get_shard(csv_file)
+            state = self._query_file_state(shard, csv_file)
+            shard.db.session.remove()
+        else:
+            state = []
+            for shard in self.shards:
+                state.append(self._query_files_state(shard))
+                shard.db.session.remove()
+            state = tuple(state)
+        # Cached snippets stay valid, as their keys contain the revision of the version
+        self.read_model.validate(csv_file, state)
+        return state
+
+    @staticmethod
+    def _query_file_state(shard, csv_file, version_id=None, summary_id=None):
+        """
+        Returns id and current version of a csv file together with the highest ids of its versions and
+        summaries or None for an unknown csv file. Deletions detach versions and squashing stores a new summary,
+        so the state changes with each new, deleted or squashed version.
+        Each value is read from an index, independent of the number of versions.
+
+        :param version_id: Id of a new version. Returns the state before this version and its summary got stored.
+        :param summary_id: Id of the summary of the new version
+        """
+        csv_file_object = shard.db.query(shard.CsvFile.id, shard.CsvFile.current_version) \
+            .filter(shard.CsvFile.name == csv_file).first()
+        if csv_file_object is None:
+            return None
+        csv_file_id, current_version = csv_file_object
+        versions = shard.db.query(func.max(shard.Version.id)).filter(shard.Version.csv_file_id == csv_file_id)
+        summaries = shard.db.query(func.max(shard.VersionSummary.id)) \
+            .filter(shard.VersionSummary.csv_file_id == csv_file_id)
+        if version_id is not None:
+            current_version -= 1
+            versions = versions.filter(shard.Version.id < version_id)
+            summaries = summaries.filter(shard.VersionSummary.id < summary_id)
+        return csv_file_id, current_version, versions.scalar(), summaries.scalar()
+
+    @staticmethod
+    def _query_files_state(shard):
+        return tuple(shard.db.query(func.count(shard.CsvFile.id),
+                                    func.coalesce(func.sum(shard.CsvFile.current_version), 0)).first())
+
+    def _history_version_view(self):
+        csv_file = request.args.get("csv_file", "")
+        version = request.args.get("version", 0, type=int)
+        offset = max(request.args.get("offset", 0, type=int), 0)
+        limit = self.app.config.get("HISTORY_VIEW_ROWS", 50)
+        revision = self.get_version_revision(csv_file, version)
+        if revision is None:
+            abort(404)
+
+        def _render():
+            result = self.get_version_changes(csv_file, version, offset, limit)
+            if result is None:
+                abort(404)
+            changes, total = result
+            return self.web.render("csv_history_version.html", csv_file=csv_file, version=version, changes=changes,
+                                   offset=offset, limit=limit, total=total, revision=revision)
+
+        etag = hashlib.sha1(repr((csv_file, version, revision, offset, limit)).encode("utf-8")).hexdigest()
+        if request.args.get("rev", None, type=int) == revision:
+            # The url contains the revision, so its content never changes
+            return self._conditional_response(etag, _render, "public, max-age=31536000, immutable")
+        return self._conditional_response(etag, _render)
+
+    def get_version_revision(self, csv_file, version):
+        """
+        Returns a number, which changes, if the rows of an archived version change.
+        This only happens, if the version gets squashed by the retention compaction.
+
+        :return: Revision or None, if the version is unknown
+        """
+        shard = self.get_shard(csv_file)
+        result = shard.db.query(shard.Version.id, shard.VersionSummary.id) \
+            .join(shard.CsvFile, shard.CsvFile.id == shard.Version.csv_file_id) \
+            .outerjoin(shard.VersionSummary, shard.VersionSummary.version_id == shard.Version.id) \
+            .filter(shard.CsvFile.name == csv_file, shard.Version.version == version).first()
+        shard.db.session.remove()
+        if result is None:
+            return None
+        version_id, summary_id = result
+        return summary_id or 0
+
+    def _search_view(self):
+        query = request.args.get("q", "")
+        csv_file = request.args.get("csv_file", "") or None
+        results = []
+        if query:
+            try:
+                results = self.search_history(query, csv_file)
+            except OperationalError:
+                flash("Invalid search query: %s" % query)
+        return self.web.render("csv_search.html", query=query, csv_file=csv_file, results=results)
+
+    def _changes_api(self):
+        try:
+            start = parse_timestamp(request.args["start"]) if request.args.get("start") else None
+            end = parse_timestamp(request.args["end"]) if request.args.get("end") else None
+            limit = min(int(request.args.get("limit", 100)), 1000)
+            changes, cursor = self.get_changes(start, end, request.args.get("cursor", None), limit)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        for change in changes:
+            change["created"] = change["created"].isoformat()
+        return jsonify(changes=changes, cursor=cursor)
+
+    def _stream_view(self):
+        """
+        Server-Sent Events stream of archived changes.
+
+        Each event has the id of its change, so that reconnecting clients, which send Last-Event-ID,
+        get the missed changes from the archive first.
+        """
+        csv_file = request.args.get("csv_file", None) or None
+        last_event_id = request.headers.get("Last-Event-ID", None) or request.args.get("last_event_id", None)
+        keepalive = self.app.config.get("HISTORY_STREAM_KEEPALIVE", 15)
+        try:
+            position = decode_cursor(last_event_id) if last_event_id else None
+        except ValueError:
+            return jsonify(error="Invalid Last-Event-ID: %s" % last_event_id), 400
+
+        # Subscribe before reading the archive, so that no change gets lost in between
+        subscription = self.broadcaster.subscribe(csv_file)
+
+        def _format(event):
+            data = dict(event, created=event["created"].isoformat())
+            return "id: %s\nevent: change\ndata: %s\n\n" % (
+                encode_cursor(event["created"], event["csv_file"], event["version"]), json.dumps(data))
+
+        def _events():
+            # Changes sent from the archive, which the subscription may deliver a second time.
+            # Live events are not ordered by created, as created gets set before the commit.
+            replayed = set()
+            try:
+                cursor = last_event_id if position is not None else None
+                while cursor is not None:
+                    changes, cursor = self.get_changes(cursor=cursor, csv_file=csv_file)
+                    rows = self._get_version_rows(changes)
+                    for change in changes:
+                        missing_rows, new_rows = rows[(change["csv_file"], change["version"])]
+                        event = self._get_stream_event(change["csv_file"], change["version"], change["created"],
+                                                       missing_rows, new_rows)
+                        replayed.add((change["csv_file"], change["version"]))
+                        yield _format(event)
+
+                while not subscription.closed:
+                    if subscription.dropped:
+                        # Client is too slow. It can reconnect and resume from the archive.
+                        yield "event: dropped\ndata: {}\n\n"
+                        break
+                    event = subscription.get(keepalive)
+                    if event is None:
+                        yield ": keepalive\n\n"
+                        continue
+                    key = (event["csv_file"], event["version"])
+                    if key in replayed:
+                        replayed.discard(key)
+                        continue
+                    yield _format(event)
+            finally:
+                self.broadcaster.unsubscribe(subscription)
+
+        return Response(stream_with_context(_events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @staticmethod
+    def _get_stream_event(csv_file, version, created, missing_rows, new_rows):
+        return {"csv_file": csv_file,
+                "version": version,
+                "created": created,
+                "missing_rows": missing_rows,
+                "new_rows": new_rows}
+
+    @staticmethod
+    def _get_api_limit():
+        return max(min(request.args.get("limit", 100, type=int), 1000), 1)
+
+    def _files_api(self):
+        limit = self._get_api_limit()
+        csv_files = self.get_csv_files(limit=limit + 1, after=request.args.get("cursor", None))
+        files = [{"name": csv_file_object.name,
+                  "current_version": csv_file_object.current_version,
+                  "created": csv_file_object.created.isoformat() if csv_file_object.created else None}
+                 for csv_file_object in csv_files[:limit]]
+        cursor = files[-1]["name"] if len(csv_files) > limit else None
+        return jsonify(files=files, cursor=cursor)
+
+    def _versions_api(self):
+        csv_file = request.args.get("csv_file", None)
+        if not csv_file:
+            return jsonify(error="csv_file is needed"), 400
+        try:
+            before = int(request.args["cursor"]) if request.args.get("cursor", None) else None
+        except ValueError:
+            return jsonify(error="Invalid cursor: %s" % request.args["cursor"]), 400
+        versions, cursor = self.get_versions_page(csv_file, before, self._get_api_limit())
+        result = []
+        for version_object in versions:
+            summary = version_object.summary
+            result.append({"version": version_object.version,
+                           "created": version_object.created.isoformat() if version_object.created else None,
+                           "new_rows": summary.new_rows if summary else None,
+                           "missing_rows": summary.missing_rows if summary else None,
+                           "changed_rows": summary.changed_rows if summary else None})
+        return jsonify(versions=result, cursor=cursor)
+
+    def _rows_api(self):
+        csv_file = request.args.get("csv_file", "")
+        changes = self.iter_version_changes(csv_file, request.args.get("version", 0, type=int))
+        if changes is None:
+            return jsonify(error="Unknown csv file or version"), 404
+
+        def _lines():
+            for change, row in changes:
+                yield json.dumps({"change": change, "row": row}) + "\n"
+
+        return Response(stream_with_context(_lines()), mimetype="application/x-ndjson")
+
+    def _diff_api(self):
+        try:
+            csv_file = request.args["csv_file"]
+            diff = self.diff_versions(csv_file, int(request.args["from"]), int(request.args["to"]))
+        except (KeyError, ValueError) as e:
+            return jsonify(error="csv_file, from and to are needed: %s" % e), 400
+        if diff is None:
+            return jsonify(error="Unknown csv file or version"), 404
+
+        def _lines(missing_rows, new_rows):
+            for change, rows in (("missing", missing_rows), ("new", new_rows)):
+                for row in rows:
+                    yield json.dumps({"change": change, "row": row}) + "\n"
+
+        return Response(stream_with_context(_lines(*diff)), mimetype="application/x-ndjson")
+
+    def delete_csv_history(self, csv_file, progress=None):
+        """
+        Deletes all archived versions of a csv file.
+
+        The versions get detached from the csv file in one statement. Afterwards versions and rows are deleted
+        set-based in chunks, without loading them into memory.
+
+        :param csv_file: Name of the csv file
+        :param progress: Optional function, which gets called with the number of deleted and the total number of
+                         versions and rows after each chunk
+        :return: Number of deleted versions and rows
+        """
+        shard = self.get_shard(csv_file)
+        csv_file_object = shard.CsvFile.query.filter_by(name=csv_file).first()
+        if csv_file_object is not None:
+            shard.compactor.detach_csv_file(csv_file_object.id)
+            shard.db.commit()
+            self._checkpoints.pop(csv_file, None)
+            self.fragment_cache.invalidate(csv_file)
+            self.read_model.invalidate(csv_file)
+            if self.git_storage is not None:
+                self.git_storage.remove(csv_file)
+            if self.segment_storage is not None:
+                self.segment_storage.remove(csv_file)
+
+        if progress is not None:
+            total = shard.compactor.count_detached()
+            deleted = shard.compactor.purge_detached(lambda deleted_rows: progress(deleted_rows, total))
+        else:
+            deleted = shard.compactor.purge_detached()
+        shard.db.session.remove()
+        return deleted
+
+    def delete_csv_history_background(self, csv_file):
+        """
+        Runs delete_csv_history() in a background thread.
+        The progress is available in ``deletion_jobs`` and gets shown on the history page.
+        """
+        job = {"deleted": 0, "total": 0, "done": False}
+        self.deletion_jobs[csv_file] = job
+        thread_name = "csv_history_delete_%s" % csv_file
+
+        def _progress(deleted, total):
+            job["deleted"] = deleted
+            job["total"] = total
+
+        def _delete_thread(plugin):
+            try:
+                self.delete_csv_history(csv_file, _progress)
+            except Exception as e:
+                self.log.error("Deletion of versions of %s failed: %s" % (csv_file, e))
+            finally:
+                # Unregistered first, so that a new deletion can be started as soon as this one is done
+                self.threads.unregister(thread_name)
+                job["done"] = True
+
+        self.threads.register(thread_name, _delete_thread, "Deletes versions of %s" % csv_file).run()
 
     def _archive_csv_change(self, plugin, **kwargs):
+        # Replayed changes are already part of the archive
+        if kwargs.get("replay", False):
+            return
+
         csv_file = kwargs.get("csv_file", None)
         new_rows = kwargs.get("new_rows", None)
         missing_rows = kwargs.get("missing_rows", None)
 
         if csv_file is not None:
+            shard = self.get_shard(csv_file)
+
             # Csc file
-            csv_file_object = self.CsvFile.query.filter_by(name=csv_file).first()
-            if csv_file_object is None:
-                csv_file_object = self.CsvFile(name=csv_file,
-                                               created=datetime.now(),
-                                               current_version=0)
+            csv_file_object = shard.CsvFile.query.filter_by(name=csv_file).first()
+            new_file = csv_file_object is None
+            if new_file:
+                csv_file_object = shard.CsvFile(name=csv_file,
+                                                created=datetime.utcnow(),
+                                                current_version=0)
 
             csv_file_object.current_version += 1
-            self.db.add(csv_file_object)
+            shard.db.add(csv_file_object)
 
             # Version
-            version_object = self.Version(version=csv_file_object.current_version,
-                                          created=datetime.now(),
-                                          csv_file=csv_file_object)
-            self.db.add(version_object)
+            version_object = shard.Version(version=csv_file_object.current_version,
+                                           created=datetime.utcnow(),
+                                           csv_file=csv_file_object)
+            shard.db.add(version_object)
+            shard.db.session.flush()
+
+            if self.git_storage is not None:
+                self._commit_to_git(shard, csv_file_object, version_object, missing_rows, new_rows)
+            self.store_version_rows(shard, csv_file_object, version_object, missing_rows, new_rows)
+            summary_object = self.index_version(shard, csv_file_object, version_object, missing_rows, new_rows)
+            shard.db.session.flush()
+            file_info = FileInfo(csv_file_object.id, csv_file_object.name, csv_file_object.current_version,
+                                 csv_file_object.created)
+            version_info = VersionInfo(version_object.id, version_object.version, version_object.created,
+                                       get_summary_info(summary_object))
+            # Queried inside the write transaction, so no other process can have changed them in between
+            previous_file_state = None if new_file else \
+                self._query_file_state(shard, csv_file, version_object.id, summary_object.id)
+            file_state = self._query_file_state(shard, csv_file)
+            files_state = self._query_files_state(shard)
+
+            shard.db.commit()
+            self.read_model.add_version(file_info, version_info, missing_rows, new_rows)
+            self._update_read_model_state(shard, csv_file, new_file, previous_file_state, file_state, files_state)
+
+            self._write_checkpoint_if_due(shard, csv_file_object, len(new_rows) + len(missing_rows))
+
+            self.broadcaster.publish(self._get_stream_event(csv_file_object.name, version_object.version,
+                                                            version_object.created, missing_rows, new_rows))
+
+            self.log.debug("Change %s archived for %s" % (csv_file_object.current_version, csv_file_object.name))
+            shard.db.session.remove()
+
+    def _update_read_model_state(self, shard, csv_file, new_file, previous_file_state, file_state, files_state):
+        """
+        Lets the read model know the state after an archived version, so that it stays valid.
+        The state of the files before is derived from it, as the version added exactly one file version.
+        """
+        self.read_model.update_state(csv_file, previous_file_state, file_state)
+        known = self.read_model.get_state(None)
+        files_count, versions_sum = files_state
+        if known is not None and known[shard.index] == (files_count - int(new_file), versions_sum - 1):
+            self.read_model.update_state(None, known,
+                                         known[:shard.index] + (files_state,) + known[shard.index + 1:])
+
+    def _commit_to_git(self, shard, csv_file_object, version_object, missing_rows, new_rows):
+        """
+        Commits the full content after the given version to the git storage and stores the commit id
+        in the version. Must be committed by the caller.
+
+        If the commit fails, the error gets logged and the version keeps no commit id,
+        so that its rows get stored in the history database instead.
+        """
+        Version = shard.Version
+        try:
+            parent = shard.db.query(Version.commit_id) \
+                .filter(Version.csv_file_id == csv_file_object.id, Version.version < version_object.version) \
+                .order_by(Version.version.desc()).limit(1).scalar()
+            if parent is not None:
+                rows = self.git_storage.read(parent)
+            else:
+                # First version, git storage got enabled for an existing history or the last commit failed
+                rows = self._get_csv_content(shard, csv_file_object, version_object.version - 1)
+            version_object.commit_id = self.git_storage.commit(csv_file_object.name, version_object.version,
+                                                               apply_delta(rows, missing_rows, new_rows),
+                                                               parent, version_object.created)
+        except Exception as e:
+            self.log.error("Git commit of version %s of %s failed, rows get stored in the history database: %s" %
+                           (version_object.version, csv_file_object.name, e))
+
+    def _get_git_delta(self, csv_file, version, commit_id, rows=None):
+        """
+        Returns the missing and new rows of a version, which is stored as git commit.
+
+        :param rows: Content of the csv file before the version. Gets reconstructed, if it is not given.
+        """
+        if rows is None:
+            shard = self.get_shard(csv_file)
+            rows = self._get_csv_content(shard, shard.CsvFile.query.filter_by(name=csv_file).first(), version - 1)
+        return diff_rows(rows, self.git_storage.read(commit_id))
+
+    def _get_row_delta(self, csv_file, version_object, rows=None):
+        """
+        Returns the stored missing and new rows of a version from git, the segments or the history database.
+        Changed cells are not part of them.
+        """
+        if self.git_storage is not None and version_object.commit_id is not None:
+            return self._get_git_delta(csv_file, version_object.version, version_object.commit_id, rows)
+        if self.segment_storage is not None and version_object.segment is not None:
+            return self.segment_storage.read(version_object.segment, csv_file, version_object.version) or ([], [])
+        return list(version_object.iter_missing_rows()), list(version_object.iter_new_rows())
+
+    def _has_external_rows(self, version_object):
+        """
+        Returns True, if the rows of a version are stored in git or the segments instead of the history database.
+        """
+        return (self.git_storage is not None and version_object.commit_id is not None) or \
+            (self.segment_storage is not None and version_object.segment is not None)
+
+    def store_version_rows(self, shard, csv_file_object, version_object, missing_rows, new_rows):
+        """
+        Stores the missing and new rows of a version. Must be committed by the caller.
 
+        With HISTORY_CELL_DELTAS, modified rows of files with key columns are stored as changed cells only.
+        With HISTORY_ROW_BLOBS, the rows are stored as one compressed blob instead of one database row per csv row.
+        Versions with a git commit store nothing, their rows are part of the commit.
+        With segment storage, the rows get appended to the active segment instead.
+        """
+        if version_object.commit_id is not None:
+            return
+
+        version_object.segment = None
+        if self.segment_storage is not None:
+            try:
+                version_object.segment = self.segment_storage.append(csv_file_object.name, version_object.version,
+                                                                     version_object.created, missing_rows, new_rows)
+                return
+            except Exception as e:
+                self.log.error("Appending version %s of %s to the history segments failed, "
+                               "rows get stored in the history database: %s" %
+                               (version_object.version, csv_file_object.name, e))
+
+        cell_changes = []
+        if self._stores_cells(csv_file_object.name):
+            missing_rows, new_rows, cell_changes = split_cell_changes(missing_rows, new_rows,
+                                                                      self.get_key_columns(csv_file_object.name))
+
+        if self.app.config.get("HISTORY_ROW_BLOBS", False):
+            # All rows of the version in a single database row
+            shard.db.add(shard.RowBlob(missing_rows=compress_columnar(missing_rows),
+                                       new_rows=compress_columnar(new_rows),
+                                       csv_file_id=csv_file_object.id,
+                                       version_id=version_object.id))
+        else:
             # Missing rows
             for missing_row in missing_rows:
-                missing_row_object = self.MissingRow(row=missing_row, version=version_object)
-                self.db.add(missing_row_object)
+                shard.db.add(shard.MissingRow(row=missing_row, version_id=version_object.id))
 
             # New rows
             for new_row in new_rows:
-                new_row_object = self.NewRow(row=new_row, version=version_object)
-                self.db.add(new_row_object)
+                shard.db.add(shard.NewRow(row=new_row, version_id=version_object.id))
 
-            self.db.commit()
+        # Changed cells
+        for key, column, old_value, new_value in cell_changes:
+            shard.db.add(shard.CellChange(row_key=key,
+                                          column_name=column,
+                                          old_value=old_value,
+                                          new_value=new_value,
+                                          csv_file_id=csv_file_object.id,
+                                          version_id=version_object.id))
 
-            self.log.debug("Change %s archived for %s" % (csv_file_object.current_version, csv_file_object.name))
-            self.db.session.remove()
+    def get_key_columns(self, csv_file):
+        """
+        Returns the configured key columns of a csv file or None.
+        """
+        return (self.app.config.get("HISTORY_KEY_COLUMNS", None) or {}).get(csv_file, None)
+
+    def _stores_cells(self, csv_file):
+        return bool(self.get_key_columns(csv_file)) and self.app.config.get("HISTORY_CELL_DELTAS", False)
+
+    def index_version(self, shard, csv_file_object, version_object, missing_rows, new_rows):
+        """
+        Stores search index entries, row lineage and summary of a version. Must be committed by the caller.
+
+        :return: VersionSummary
+        """
+        shard.search.add(version_object.id, missing_rows, new_rows)
+        self.store_row_lineage(shard, csv_file_object, version_object, missing_rows, new_rows)
+        return self.store_version_summary(shard, csv_file_object, version_object, missing_rows, new_rows)
+
+    def store_row_lineage(self, shard, csv_file_object, version_object, missing_rows, new_rows):
+        """
+        Stores the changes of keyed rows of a version, if its csv file has key columns.
+        Must be committed by the caller.
+        """
+        key_columns = self.get_key_columns(csv_file_object.name)
+        if key_columns:
+            for key, change in get_keyed_changes(missing_rows, new_rows, key_columns):
+                shard.db.add(shard.RowLineage(row_key=key,
+                                              change=change,
+                                              version=version_object.version,
+                                              csv_file_id=csv_file_object.id,
+                                              version_id=version_object.id))
+
+    def store_version_summary(self, shard, csv_file_object, version_object, missing_rows, new_rows):
+        """
+        Stores the summary of a version. Must be committed by the caller.
+
+        :return: VersionSummary
+        """
+        summary_object = shard.VersionSummary(version=version_object.version,
+                                              csv_file_id=csv_file_object.id,
+                                              version_id=version_object.id,
+                                              **summarize_changes(missing_rows, new_rows,
+                                                                  self.get_key_columns(csv_file_object.name)))
+        shard.db.add(summary_object)
+        return summary_object
+
+    def _write_checkpoint_if_due(self, shard, csv_file_object, changed_rows):
+        """
+        Stores a full snapshot of the csv file, if the configured amount of versions or changed rows
+        was reached since the last snapshot.
+        This bounds the number of deltas, which must be replayed by get_csv_at_version().
+        Not needed for git storage, where each commit contains the full content.
+        """
+        if self.git_storage is not None:
+            return
+
+        checkpoint_versions = self.app.config.get("HISTORY_CHECKPOINT_VERSIONS", 50)
+        checkpoint_rows = self.app.config.get("HISTORY_CHECKPOINT_ROWS", 10000)
+
+        if csv_file_object.name in self._checkpoints.keys():
+            last_version, rows_since = self._checkpoints[csv_file_object.name]
+            rows_since += changed_rows
+        else:
+            last_version = self._get_snapshots(shard, csv_file_object) \
+                .with_entities(func.max(shard.Snapshot.version)).scalar() or 0
+            rows_since = self._count_changed_rows(shard, csv_file_object, last_version)
+
+        versions_since = csv_file_object.current_version - last_version
+        if (checkpoint_versions and versions_since >= checkpoint_versions) or \
+                (checkpoint_rows and rows_since >= checkpoint_rows):
+            version_object = shard.Version.query.filter_by(csv_file_id=csv_file_object.id,
+                                                           version=csv_file_object.current_version).first()
+            rows = self._get_csv_content(shard, csv_file_object, csv_file_object.current_version)
+            snapshot_object = shard.Snapshot(version=csv_file_object.current_version,
+                                             rows=compress_rows(rows),
+                                             csv_file_id=csv_file_object.id,
+                                             version_id=version_object.id)
+            shard.db.add(snapshot_object)
+            shard.db.commit()
+            self.log.debug("Checkpoint %s stored for %s" % (csv_file_object.current_version, csv_file_object.name))
+            last_version, rows_since = csv_file_object.current_version, 0
+
+        self._checkpoints[csv_file_object.name] = (last_version, rows_since)
+
+    def _count_changed_rows(self, shard, csv_file_object, after_version):
+        # Rows can be stored as single rows, blobs or cells. The summaries know the count for all of them.
+        summary = shard.VersionSummary
+        changed_rows = shard.db.query(func.sum(summary.new_rows + summary.missing_rows)) \
+            .join(shard.Version, shard.Version.id == summary.version_id) \
+            .filter(summary.csv_file_id == csv_file_object.id,
+                    shard.Version.csv_file_id == csv_file_object.id,
+                    summary.version > after_version).scalar() or 0
+        return changed_rows
+
+    @staticmethod
+    def _get_snapshots(shard, csv_file_object):
+        """
+        Returns a query of the snapshots of a csv file. Snapshots of detached versions are not part of it,
+        they get deleted later by the compactor.
+        """
+        return shard.db.query(shard.Snapshot) \
+            .join(shard.Version, shard.Version.id == shard.Snapshot.version_id) \
+            .filter(shard.Snapshot.csv_file_id == csv_file_object.id,
+                    shard.Version.csv_file_id == csv_file_object.id)
 
     def get_csv_history(self):
-        self.db.session.remove()
-        return self.db.query(self.CsvFile).all()
+        """
+        Returns the archived csv files of all shards, ordered by name.
+        """
+        return self.get_csv_files()
+
+    def get_csv_files(self, offset=0, limit=None, after=None):
+        """
+        Returns a page of the archived csv files of all shards as FileInfo, ordered by name.
+        Served from the read model, if it contains the files. Otherwise pages get ordered and filtered by the
+        databases, so only offset + limit files per shard get loaded. Without limit, all files get loaded
+        for the read model.
+
+        :param after: Only files with a name after this one get returned
+        """
+        self.validate_read_model()
+        csv_files = self.read_model.get_files()
+        if csv_files is None and limit is not None:
+            pages = []
+            for shard in self.shards:
+                query = shard.db.query(shard.CsvFile.id, shard.CsvFile.name, shard.CsvFile.current_version,
+                                       shard.CsvFile.created)
+                if after is not None:
+                    query = query.filter(shard.CsvFile.name > after)
+                pages.append([FileInfo(*row) for row in query.order_by(shard.CsvFile.name).limit(offset + limit)])
+                shard.db.session.remove()
+            return list(heapq.merge(*pages, key=lambda file_info: file_info.name))[offset:offset + limit]
+
+        if csv_files is None:
+            generation = self.read_model.generation()
+            csv_files = {}
+            for shard in self.shards:
+                for row in shard.db.query(shard.CsvFile.id, shard.CsvFile.name, shard.CsvFile.current_version,
+                                          shard.CsvFile.created):
+                    csv_files[row.name] = FileInfo(*row)
+                shard.db.session.remove()
+            self.read_model.set_files(csv_files, generation)
+
+        names = sorted(name for name in csv_files.keys() if after is None or name > after)
+        if limit is not None:
+            names = names[offset:offset + limit]
+        else:
+            names = names[offset:]
+        return [csv_files[name] for name in names]
+
+    def get_versions_page(self, csv_file, before=None, limit=10):
+        """
+        Returns versions of a csv file together with their summaries as VersionInfo, newest first.
+        Served from the read model, if it contains the requested versions.
+
+        :param before: Only versions older than this version number get returned
+        :return: Tuple of the list of versions and the before value of the next page or None
+        """
+        self.validate_read_model(csv_file)
+        cached = self.read_model.get_versions(csv_file)
+        if cached is not None:
+            versions = [version_info for version_info in cached["versions"]
+                        if before is None or version_info.version < before]
+            if len(versions) > limit or cached["complete"]:
+                return self._get_versions_page(versions, limit)
+
+        generation = self.read_model.generation(csv_file)
+        # The first page loads the versions for the read model as well
+        load_limit = limit if before is not None else max(limit, self.read_model.max_versions)
+        shard = self.get_shard(csv_file)
+        query = shard.Version.query \
+            .options(selectinload(shard.Version.summary)) \
+            .join(shard.CsvFile, shard.CsvFile.id == shard.Version.csv_file_id) \
+            .filter(shard.CsvFile.name == csv_file)
+        if before is not None:
+            query = query.filter(shard.Version.version < before)
+        versions = [VersionInfo(version_object.id, version_object.version, version_object.created,
+                                get_summary_info(version_object.summary))
+                    for version_object in query.order_by(shard.Version.version.desc()).limit(load_limit + 1)]
+        shard.db.session.remove()
+        if before is None:
+            self.read_model.set_versions(csv_file, versions, len(versions) <= load_limit, generation)
+        return self._get_versions_page(versions, limit)
+
+    @staticmethod
+    def _get_versions_page(versions, limit):
+        if len(versions) > limit:
+            return versions[:limit], versions[limit - 1].version
+        return versions[:limit], None
+
+    def get_version_changes(self, csv_file, version, offset=0, limit=50):
+        """
+        Returns a page of the changes of a version. Rows outside of the page are not loaded.
+
+        :return: Tuple of a list of (change, row) tuples and the total number of changes or None,
+                 if the version is unknown. change is "missing", "new" or "cell". Rows of changed cells
+                 are dictionaries with key, column, old and new.
+        """
+        self.validate_read_model(csv_file)
+        shard = self.get_shard(csv_file)
+        version_object = shard.Version.query \
+            .join(shard.CsvFile, shard.CsvFile.id == shard.Version.csv_file_id) \
+            .filter(shard.CsvFile.name == csv_file, shard.Version.version == version).first()
+        if version_object is None:
+            return None
+        return self._get_version_changes(shard, csv_file, version_object, offset, limit)
+
+    def iter_version_changes(self, csv_file, version, batch_size=500):
+        """
+        Returns a generator over all changes of a version, which loads batch_size rows at a time.
+
+        :return: Generator of (change, row) tuples like get_version_changes() or None, if the version is unknown
+        """
+        self.validate_read_model(csv_file)
+        diff = self.read_model.get_diff(csv_file, version)
+        if diff is not None and not self._stores_cells(csv_file):
+            return ((change, row) for change, rows in (("missing", diff[0]), ("new", diff[1])) for row in rows)
+
+        shard = self.get_shard(csv_file)
+        version_object = shard.Version.query \
+            .join(shard.CsvFile, shard.CsvFile.id == shard.Version.csv_file_id) \
+            .filter(shard.CsvFile.name == csv_file, shard.Version.version == version).first()
+        if version_object is None:
+            shard.db.session.remove()
+            return None
+        if self._has_external_rows(version_object):
+            diff = self._get_row_delta(csv_file, version_object)
+            shard.db.session.remove()
+            return ((change, row) for change, rows in (("missing", diff[0]), ("new", diff[1])) for row in rows)
+        version_id = version_object.id
+
+        def _changes():
+            try:
+                for change, row_class in (("missing", shard.MissingRow), ("new", shard.NewRow)):
+                    for row, in shard.db.query(row_class.row).filter(row_class.version_id == version_id) \
+                            .order_by(row_class.id).yield_per(batch_size):
+                        yield change, row
+                row_blob = shard.db.query(shard.RowBlob).filter(shard.RowBlob.version_id == version_id).first()
+                if row_blob is not None:
+                    for change, data in (("missing", row_blob.missing_rows), ("new", row_blob.new_rows)):
+                        for row in iter_columnar(data):
+                            yield change, row
+                for cell in shard.db.query(shard.CellChange).filter(shard.CellChange.version_id == version_id) \
+                        .order_by(shard.CellChange.id).yield_per(batch_size):
+                    yield "cell", {"key": cell.row_key, "column": cell.column_name,
+                                   "old": cell.old_value, "new": cell.new_value}
+            finally:
+                shard.db.session.remove()
+
+        return _changes()
+
+    def _get_version_changes(self, shard, csv_file, version_object, offset, limit):
+        """
+        Returns a page of the changes of a version like get_version_changes().
+
+        :param version_object: Version or VersionInfo
+        """
+        diff = self.read_model.get_diff(csv_file, version_object.version)
+        if diff is not None and not self._stores_cells(csv_file):
+            return self._page_changes(diff[0], diff[1], offset, limit)
+
+        if self.git_storage is not None or self.segment_storage is not None:
+            stored = shard.db.query(shard.Version.version, shard.Version.commit_id, shard.Version.segment) \
+                .filter(shard.Version.id == version_object.id).first()
+            if stored is not None and self._has_external_rows(stored):
+                missing_rows, new_rows = self._get_row_delta(csv_file, stored)
+                return self._page_changes(missing_rows, new_rows, offset, limit)
+
+        def _table_source(change, row_class):
+            query = shard.db.query(row_class.row).filter(row_class.version_id == version_object.id) \
+                .order_by(row_class.id)
+            return query.count(), lambda start, stop: [(change, row)
+                                                       for row, in query.offset(start).limit(stop - start)]
+
+        def _list_source(change, rows):
+            return len(rows), lambda start, stop: [(change, row) for row in rows[start:stop]]
+
+        sources = [_table_source("missing", shard.MissingRow), _table_source("new", shard.NewRow)]
+        row_blob = shard.db.query(shard.RowBlob).filter(shard.RowBlob.version_id == version_object.id).first()
+        if row_blob is not None:
+            sources.append(_list_source("missing", list(iter_columnar(row_blob.missing_rows))))
+            sources.append(_list_source("new", list(iter_columnar(row_blob.new_rows))))
+        cells = shard.db.query(shard.CellChange).filter(shard.CellChange.version_id == version_object.id) \
+            .order_by(shard.CellChange.id)
+        sources.append((cells.count(), lambda start, stop: [
+            ("cell", {"key": cell.row_key, "column": cell.column_name, "old": cell.old_value, "new": cell.new_value})
+            for cell in cells.offset(start).limit(stop - start)]))
+
+        changes = []
+        total = 0
+        for count, fetch in sources:
+            start = max(offset - total, 0)
+            stop = min(offset + limit - total, count)
+            if start < stop:
+                changes += fetch(start, stop)
+            total += count
+        return changes, total
+
+    @staticmethod
+    def _page_changes(missing_rows, new_rows, offset, limit):
+        # Same order as stored: missing rows first
+        new_offset = offset - len(missing_rows)
+        changes = [("missing", row) for row in missing_rows[offset:offset + limit]]
+        changes += [("new", row) for row in new_rows[max(new_offset, 0):max(new_offset + limit, 0)]]
+        return changes, len(missing_rows) + len(new_rows)
+
+    def get_csv_at_version(self, csv_file, version):
+        """
+        Reconstructs the content of a csv file after the given version.
+
+        It starts from the nearest stored snapshot or, with git storage, the nearest commit
+        and applies only the deltas, which were archived after it.
+
+        :param csv_file: Name of the csv file
+        :param version: Version number, 0 is the empty file before the first version
+        :return: List of rows or None, if the csv file or version is unknown or the version got deleted or squashed
+        """
+        shard = self.get_shard(csv_file)
+        csv_file_object = shard.CsvFile.query.filter_by(name=csv_file).first()
+        if csv_file_object is None or not self._is_archived_version(shard, csv_file_object, version):
+            return None
+        return self._get_csv_content(shard, csv_file_object, version)
+
+    @staticmethod
+    def _is_archived_version(shard, csv_file_object, version):
+        """
+        Returns True for 0 and for versions of the csv file, which were neither deleted nor squashed.
+        """
+        if version == 0:
+            return True
+        return 0 < version <= csv_file_object.current_version and \
+            shard.db.query(shard.Version.id) \
+            .filter(shard.Version.csv_file_id == csv_file_object.id, shard.Version.version == version) \
+            .first() is not None
+
+    def _get_csv_content(self, shard, csv_file_object, version):
+        """
+        Returns the content of a csv file after the newest archived version up to the given version number.
+        Squashed versions are part of the version, which replaced them, so their numbers are valid here.
+        """
+        csv_file = csv_file_object.name
+        snapshot_object = self._get_snapshots(shard, csv_file_object) \
+            .filter(shard.Snapshot.version <= version) \
+            .order_by(shard.Snapshot.version.desc()).first()
+
+        if snapshot_object is not None:
+            rows = decompress_rows(snapshot_object.rows)
+            start_version = snapshot_object.version
+        else:
+            rows = []
+            start_version = 0
+
+        if self.git_storage is not None:
+            commit = shard.db.query(shard.Version.version, shard.Version.commit_id) \
+                .filter(shard.Version.csv_file_id == csv_file_object.id,
+                        shard.Version.version > start_version,
+                        shard.Version.version <= version,
+                        shard.Version.commit_id.isnot(None)) \
+                .order_by(shard.Version.version.desc()).first()
+            if commit is not None:
+                rows = self.git_storage.read(commit.commit_id)
+                start_version = commit.version
+
+        key_columns = self.get_key_columns(csv_file)
+        for version_object in self._load_versions(shard, csv_file_object, start_version, version):
+            missing_rows, new_rows = self._get_version_delta(csv_file, version_object, rows, key_columns)
+            rows = apply_delta(rows, missing_rows, new_rows)
+        return rows
+
+    def iter_version_deltas(self, shard, csv_file_object, after_version, until_version, batch_size=100):
+        """
+        Yields (version_object, missing_rows, new_rows) of the versions after after_version up to until_version,
+        ordered by version.
+
+        Changed cells get expanded to full missing and new rows and git commits get compared to the content before.
+        As this needs the old rows, the content of the csv file gets reconstructed and updated along the way,
+        if the versions contain changed cells or git storage is used.
+        """
+        key_columns = self.get_key_columns(csv_file_object.name)
+        rows = None
+        has_cells = self.git_storage is None and \
+            shard.db.query(shard.CellChange.id) \
+            .join(shard.Version, shard.Version.id == shard.CellChange.version_id) \
+            .filter(shard.Version.csv_file_id == csv_file_object.id,
+                    shard.Version.version > after_version,
+                    shard.Version.version <= until_version).first() is not None
+        if has_cells or self.git_storage is not None:
+            rows = self._get_csv_content(shard, csv_file_object, after_version)
+
+        for version_object in self._load_versions(shard, csv_file_object, after_version, until_version, batch_size):
+            missing_rows, new_rows = self._get_version_delta(csv_file_object.name, version_object, rows,
+                                                             key_columns)
+            if rows is not None:
+                rows = apply_delta(rows, missing_rows, new_rows)
+            yield version_object, missing_rows, new_rows
+
+    def _load_versions(self, shard, csv_file_object, after_version, until_version, batch_size=100):
+        """
+        Yields the versions after after_version up to until_version together with their rows and changed cells.
+        Versions are loaded batch_size at a time and removed from the session afterwards.
+        """
+        Version = shard.Version
+        while after_version < until_version:
+            versions = Version.query \
+                .options(selectinload(Version.missing_row), selectinload(Version.new_row),
+                         selectinload(Version.cell_change), selectinload(Version.row_blob)) \
+                .filter(Version.csv_file_id == csv_file_object.id,
+                        Version.version > after_version,
+                        Version.version <= until_version) \
+                .order_by(Version.version).limit(batch_size).all()
+            if len(versions) == 0:
+                break
+            for version_object in versions:
+                yield version_object
+            after_version = versions[-1].version
+            # Keeps the session small, rows get expunged together with their version
+            for version_object in versions:
+                shard.db.session.expunge(version_object)
+
+    def _get_version_delta(self, csv_file, version_object, rows, key_columns):
+        """
+        Returns the full missing and new rows of a version.
+
+        :param rows: Content of the csv file before the version. Needed, if the version has changed cells,
+                     optional for versions stored as git commit.
+        """
+        missing_rows, new_rows = self._get_row_delta(csv_file, version_object, rows)
+        if len(version_object.cell_change) > 0:
+            cell_missing_rows, cell_new_rows = expand_cell_changes(
+                rows, [(cell.row_key, cell.column_name, cell.old_value, cell.new_value)
+                       for cell in version_object.cell_change], key_columns)
+            missing_rows += cell_missing_rows
+            new_rows += cell_new_rows
+        return missing_rows, new_rows
+
+    def diff_versions(self, csv_file, v_from, v_to, batch_size=100):
+        """
+        Returns the net change between two versions of a csv file.
+
+        Only the deltas between both versions get loaded, batch_size versions at a time.
+        Rows, which got added and removed again in between, are not part of the result.
+        Changed cells need the old rows, so if the range contains any, the content at the older version
+        gets reconstructed once and updated along the way. With git storage, both contents get read from git.
+
+        :param csv_file: Name of the csv file
+        :param v_from: Version number, 0 is the empty file before the first version
+        :param v_to: Version number. If it is lower than v_from, the reverse change is returned.
+        :return: Tuple of (missing_rows, new_rows) or None, if the csv file or a version is unknown
+                 or got deleted or squashed
+        """
+        self.validate_read_model(csv_file)
+        shard = self.get_shard(csv_file)
+        csv_file_object = shard.CsvFile.query.filter_by(name=csv_file).first()
+        if csv_file_object is None or \
+                not self._is_archived_version(shard, csv_file_object, v_from) or \
+                not self._is_archived_version(shard, csv_file_object, v_to):
+            shard.db.session.remove()
+            return None
+
+        missing_rows, new_rows = squash_deltas(
+            self._iter_deltas(shard, csv_file_object, min(v_from, v_to), max(v_from, v_to), batch_size))
+        shard.db.session.remove()
+        if v_to < v_from:
+            return new_rows, missing_rows
+        return missing_rows, new_rows
+
+    def _iter_deltas(self, shard, csv_file_object, after_version, until_version, batch_size):
+        """
+        Yields (missing_rows, new_rows) of the versions after after_version up to until_version, ordered by version.
+        Reads from the read model, if it contains all of these versions.
+        """
+        deltas = self._get_cached_deltas(csv_file_object.name, after_version, until_version)
+        if deltas is not None:
+            for missing_rows, new_rows in deltas:
+                yield missing_rows, new_rows
+            return
+
+        if self.git_storage is not None:
+            # Both contents are a single commit lookup
+            yield diff_rows(self._get_csv_content(shard, csv_file_object, after_version),
+                            self._get_csv_content(shard, csv_file_object, until_version))
+            return
+
+        for version_object, missing_rows, new_rows in \
+                self.iter_version_deltas(shard, csv_file_object, after_version, until_version, batch_size):
+            yield missing_rows, new_rows
+
+    def _get_cached_deltas(self, csv_file, after_version, until_version):
+        """
+        Returns the (missing_rows, new_rows) of the given versions from the read model
+        or None, if it does not contain all of them.
+        """
+        deltas = []
+        for version in range(after_version + 1, until_version + 1):
+            diff = self.read_model.get_diff(csv_file, version)
+            if diff is None:
+                return None
+            deltas.append(diff)
+        return deltas
+
+    def search_history(self, query, csv_file=None, limit=100):
+        """
+        Searches the archived rows of all csv files.
+
+        :param query: FTS5 query, e.g. ``4711`` or ``"Richard" AND Paris``
+        :param csv_file: Optional name of a csv file to restrict the search to
+        :param limit: Maximum number of results
+        :return: List of dictionaries with csv_file, version, created, change and row. Ordered by archive time.
+        """
+        shards = [self.get_shard(csv_file)] if csv_file is not None else self.shards
+        results = []
+        for shard in shards:
+            try:
+                results += shard.search.search(query, csv_file, limit)
+            finally:
+                shard.db.session.remove()
+        return sorted(results, key=lambda result: result["created"])[:limit]
+
+    def csv_history_search(self, query, csv_file=None, limit=100):
+        try:
+            results = self.search_history(query, csv_file, limit)
+        except OperationalError as e:
+            self.log.error("Invalid search query %s: %s" % (query, e))
+            return
+        for result in results:
+            self.log.info("%s - version %s - %s row: %s" % (result["csv_file"], result["version"],
+                                                            result["change"], result["row"]))
+
+    def get_changes(self, start=None, end=None, cursor=None, limit=100, csv_file=None):
+        """
+        Returns the versions of all csv files, which were archived inside the given time range.
+
+        Pages are addressed by keyset cursors, so later pages are as cheap as the first one
+        and do not shift, if new versions get archived meanwhile.
+
+        :param start: Optional UTC datetime, inclusive
+        :param end: Optional UTC datetime, exclusive
+        :param cursor: Cursor of the next page, as returned by the previous call
+        :param limit: Maximum number of changes
+        :param csv_file: Optional name of a csv file to restrict the changes to
+        :return: Tuple of a list of dictionaries with csv_file, version, created, new_rows and missing_rows,
+                 ordered by created, csv_file and version, and the cursor of the next page or None
+        """
+        position = decode_cursor(cursor) if cursor else None
+        shards = [self.get_shard(csv_file)] if csv_file is not None else self.shards
+        changes = []
+        for shard in shards:
+            Version = shard.Version
+            CsvFile = shard.CsvFile
+            query = shard.db.query(Version.version, Version.created, CsvFile.name,
+                                   shard.VersionSummary.new_rows, shard.VersionSummary.missing_rows) \
+                .join(CsvFile, CsvFile.id == Version.csv_file_id) \
+                .outerjoin(shard.VersionSummary, shard.VersionSummary.version_id == Version.id)
+            if csv_file is not None:
+                query = query.filter(CsvFile.name == csv_file)
+            if start is not None:
+                query = query.filter(Version.created >= start)
+            if end is not None:
+                query = query.filter(Version.created < end)
+            if position is not None:
+                created, name, version = position
+                query = query.filter(or_(Version.created > created,
+                                         and_(Version.created == created,
+                                              or_(CsvFile.name > name,
+                                                  and_(CsvFile.name == name, Version.version > version)))))
+            # One more than needed, to know if there is a next page
+            for version, created, name, new_rows, missing_rows in \
+                    query.order_by(Version.created, CsvFile.name, Version.version).limit(limit + 1):
+                changes.append({"csv_file": name,
+                                "version": version,
+                                "created": created,
+                                "new_rows": new_rows,
+                                "missing_rows": missing_rows})
+            shard.db.session.remove()
+
+        changes.sort(key=lambda change: (change["created"], change["csv_file"], change["version"]))
+        next_cursor = None
+        if len(changes) > limit:
+            changes = changes[:limit]
+            last = changes[-1]
+            next_cursor = encode_cursor(last["created"], last["csv_file"], last["version"])
+        return changes, next_cursor
+
+    def csv_history_changes(self, start=None, end=None, cursor=None, limit=100):
+        try:
+            changes, next_cursor = self.get_changes(parse_timestamp(start) if start else None,
+                                                    parse_timestamp(end) if end else None,
+                                                    cursor, limit)
+        except ValueError as e:
+            self.log.error(e)
+            return
+        for change in changes:
+            self.log.info("%s - %s - version %s: %s new, %s missing rows" % (
+                change["created"], change["csv_file"], change["version"], change["new_rows"],
+                change["missing_rows"]))
+        if next_cursor is not None:
+            self.log.info("More changes available, next cursor: %s" % next_cursor)
+
+    def replay_history(self, csv_file=None, start=None, end=None, speed=1.0, batch_size=100):
+        """
+        Sends archived versions again as ``csv_watcher_change`` signals, ordered by archive time.
+
+        Receivers get the same arguments as for a detected change plus ``replay=True``, ``version`` and
+        ``created``. So new receivers can be filled from the archive and receivers can be load tested
+        without touching real csv files. The archive itself ignores replayed changes.
+
+        :param csv_file: Optional name of a csv file
+        :param start: Optional UTC datetime, inclusive
+        :param end: Optional UTC datetime, exclusive
+        :param speed: 1 keeps the original time between two versions, 10 is ten times faster,
+                      0 sends all versions as fast as possible
+        :param batch_size: Number of versions, which get loaded at once
+        :return: Number of replayed versions
+        """
+        replayed = 0
+        last_created = None
+        cursor = None
+        while True:
+            changes, cursor = self.get_changes(start, end, cursor, batch_size, csv_file)
+            rows = self._get_version_rows(changes)
+            for change in changes:
+                if speed and last_created is not None:
+                    time.sleep(max((change["created"] - last_created).total_seconds(), 0) / speed)
+                last_created = change["created"]
+                missing_rows, new_rows = rows[(change["csv_file"], change["version"])]
+                self.signals.send("csv_watcher_change",
+                                  csv_file=change["csv_file"],
+                                  new_rows=new_rows,
+                                  missing_rows=missing_rows,
+                                  replay=True,
+                                  version=change["version"],
+                                  created=change["created"])
+                replayed += 1
+            if cursor is None:
+                break
+        return replayed
+
+    def _get_version_rows(self, changes):
+        """
+        Loads the rows of the given changes, as returned by get_changes().
+
+        :return: Dictionary of (missing_rows, new_rows) by (csv_file, version)
+        """
+        versions_by_file = {}
+        for change in changes:
+            versions_by_file.setdefault(change["csv_file"], []).append(change["version"])
+
+        rows = {}
+        for csv_file, versions in versions_by_file.items():
+            shard = self.get_shard(csv_file)
+            csv_file_object = shard.CsvFile.query.filter_by(name=csv_file).first()
+            for version_object, missing_rows, new_rows in \
+                    self.iter_version_deltas(shard, csv_file_object, min(versions) - 1, max(versions)):
+                if version_object.version in versions:
+                    rows[(csv_file, version_object.version)] = (missing_rows, new_rows)
+            shard.db.session.remove()
+        return rows
+
+    def csv_history_replay(self, csv_file=None, start=None, end=None, speed=1.0):
+        try:
+            start = parse_timestamp(start) if start else None
+            end = parse_timestamp(end) if end else None
+        except ValueError as e:
+            self.log.error(e)
+            return
+        started = time.time()
+        replayed = self.replay_history(csv_file, start, end, speed)
+        duration = time.time() - started
+        self.log.info("%s versions replayed in %.1f seconds (%.1f versions/s)" %
+                      (replayed, duration, replayed / duration if duration > 0 else 0))
+
+    def get_version_summaries(self, csv_file):
+        """
+        Returns the summaries of all versions of a csv file as SummaryInfo, ordered by version.
+        No archived rows get loaded.
+        """
+        self.validate_read_model(csv_file)
+        summaries = self._get_cached_summaries(csv_file)
+        if summaries is not None:
+            return summaries
+        shard = self.get_shard(csv_file)
+        summaries = [get_summary_info(summary) for summary in
+                     self._query_summaries(shard, csv_file).order_by(shard.VersionSummary.version)]
+        shard.db.session.remove()
+        return summaries
+
+    def _get_cached_summaries(self, csv_file):
+        """
+        Returns the summaries of all versions from the read model, ordered by version,
+        or None, if it does not contain all versions.
+        """
+        cached = self.read_model.get_versions(csv_file)
+        if cached is None or not cached["complete"]:
+            return None
+        return [version_info.summary for version_info in reversed(cached["versions"])
+                if version_info.summary is not None]
+
+    @staticmethod
+    def _query_summaries(shard, csv_file):
+        # Summaries of detached versions exist, until the compactor has purged them
+        return shard.db.query(shard.VersionSummary) \
+            .join(shard.Version, shard.Version.id == shard.VersionSummary.version_id) \
+            .join(shard.CsvFile, shard.CsvFile.id == shard.Version.csv_file_id) \
+            .filter(shard.CsvFile.name == csv_file)
+
+    def get_version_fragments(self, csv_file):
+        """
+        Returns the rst snippets of all versions of a csv file for the CsvDocument, ordered by version.
+        Only summaries of versions without a cached snippet get loaded.
+        """
+        self.validate_read_model(csv_file)
+        summaries = self._get_cached_summaries(csv_file)
+        if summaries is not None:
+            return [self.fragment_cache.get_or_render(csv_file, summary.version, "rst_%s" % summary.id,
+                                                      lambda: self._version_content.render(summary=summary))
+                    for summary in summaries]
+
+        shard = self.get_shard(csv_file)
+        query = self._query_summaries(shard, csv_file)
+        generation = self.fragment_cache.generation(csv_file)
+        fragments = dict((version, self.fragment_cache.get(csv_file, version, "rst_%s" % summary_id))
+                         for version, summary_id in
+                         query.with_entities(shard.VersionSummary.version, shard.VersionSummary.id))
+        missing = [version for version, fragment in fragments.items() if fragment is None]
+        for start in range(0, len(missing), 500):
+            for summary in query.filter(shard.VersionSummary.version.in_(missing[start:start + 500])):
+                fragments[summary.version] = self._version_content.render(summary=summary)
+                self.fragment_cache.set(csv_file, summary.version, "rst_%s" % summary.id, fragments[summary.version],
+                                        generation)
+        shard.db.session.remove()
+        return [fragments[version] for version in sorted(fragments.keys()) if fragments[version] is not None]
+
+    def get_row_lineage(self, csv_file, key, with_rows=False):
+        """
+        Returns all changes of a single row.
+
+        :param csv_file: Name of the csv file. Key columns must be configured in HISTORY_KEY_COLUMNS.
+        :param key: Value of the key column. Values of several key columns are separated by ``\\x1f``.
+        :param with_rows: If True, the missing and new rows of each change get loaded as well.
+                          Rows stored as changed cells are returned as list of (column, old value, new value)
+                          tuples in cells.
+        :return: List of dictionaries with version, created and change, ordered by version
+        """
+        shard = self.get_shard(csv_file)
+        key_columns = self.get_key_columns(csv_file)
+        lineage = []
+        query = shard.db.query(shard.RowLineage, shard.Version.created) \
+            .join(shard.Version, shard.Version.id == shard.RowLineage.version_id) \
+            .join(shard.CsvFile, shard.CsvFile.id == shard.Version.csv_file_id) \
+            .filter(shard.CsvFile.name == csv_file, shard.RowLineage.row_key == key) \
+            .order_by(shard.RowLineage.version)
+        entries = query.all()
+
+        versions = {}
+        if with_rows and len(entries) > 0:
+            versions = dict((version_object.id, version_object) for version_object in shard.Version.query
+                            .options(selectinload(shard.Version.missing_row), selectinload(shard.Version.new_row),
+                                     selectinload(shard.Version.cell_change), selectinload(shard.Version.row_blob))
+                            .filter(shard.Version.id.in_([entry.version_id for entry, created in entries])))
+
+        for entry, created in entries:
+            change = {"version": entry.version, "created": created, "change": entry.change}
+            if with_rows:
+                version_object = versions[entry.version_id]
+                missing_rows, new_rows = self._get_row_delta(csv_file, version_object)
+                change["missing_rows"] = [row for row in missing_rows if get_key_value(row, key_columns) == key]
+                change["new_rows"] = [row for row in new_rows if get_key_value(row, key_columns) == key]
+                change["cells"] = [(cell.column_name, cell.old_value, cell.new_value)
+                                   for cell in version_object.cell_change if cell.row_key == key]
+            lineage.append(change)
+        shard.db.session.remove()
+        return lineage
+
+    def csv_history_lineage(self, csv_file, key):
+        if not self.get_key_columns(csv_file):
+            self.log.error("No key columns configured for %s in HISTORY_KEY_COLUMNS" % csv_file)
+            return
+        for change in self.get_row_lineage(csv_file, key, with_rows=True):
+            if len(change["cells"]) > 0:
+                cells = ", ".join("%s: %s -> %s" % cell for cell in change["cells"])
+                self.log.info("version %s - %s - %s: %s" % (change["version"], change["created"], change["change"],
+                                                            cells))
+            else:
+                self.log.info("version %s - %s - %s: %s -> %s" % (change["version"], change["created"],
+                                                                  change["change"], change["missing_rows"],
+                                                                  change["new_rows"]))
+
+    def csv_history_version(self, csv_file, version):
+        rows = self.get_csv_at_version(csv_file, version)
+        if rows is None:
+            self.log.error("No version %s archived for %s" % (version, csv_file))
+            return
+
+        if len(rows) > 0:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def _compaction_thread(self, plugin):
+        interval = self.app.config.get("HISTORY_COMPACTION_INTERVAL", 3600)
+        retention = self.app.config.get("HISTORY_RETENTION", None)
+        while not self._compaction_stop.wait(interval):
+            for shard in self.shards if retention else []:
+                try:
+                    shard.compactor.compact()
+                except Exception as e:
+                    self.log.error("History compaction of %s failed: %s" % (shard, e))
+            if self.segment_storage is not None:
+                try:
+                    self.segment_storage.compact()
+                except Exception as e:
+                    self.log.error("Compaction of history segments failed: %s" % e)
+
+    def csv_history_compact(self):
+        if self.segment_storage is not None:
+            self.log.info("%s deleted versions removed from history segments" % self.segment_storage.compact())
+        if not self.app.config.get("HISTORY_RETENTION", None):
+            self.log.error("No HISTORY_RETENTION configured")
+            return
+        removed = 0
+        for shard in self.shards:
+            removed += shard.compactor.compact()
+        self.log.info("%s versions squashed" % removed)
 
     def deactivate(self):
-        pass
+        self._compaction_stop.set()
+        if self.broadcaster is not None:
+            self.broadcaster.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    """
+    Caches rendered snippets of archived versions, keyed by csv file, version and kind of snippet.
+
+    An archived version never changes, so its snippets only need to be rendered once. Entries get removed
+    only by invalidate(), which must be called, if versions get deleted or squashed.
+
+    The newest max_entries snippets are kept in memory. If a path is given, all snippets are stored on disk
+    as well, one directory per csv file, and survive restarts.
+    """
+
+    def __init__(self, max_entries=1000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented by invalidate(). Snippets, which were rendered before, do not get stored.
+        self._generations = {}
+
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+    def get(self, csv_file, version, kind):
+        """
+        Returns a cached snippet or None.
+        """
+        key = (csv_file, version, kind)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.path is not None:
+            fragment_path = self._fragment_path(csv_file, version, kind)
+            if os.path.exists(fragment_path):
+                with open(fragment_path, "r", encoding="utf-8") as fragment_file:
+                    fragment = fragment_file.read()
+                with self._lock:
+                    self._remember(key, fragment)
+                return fragment
+        return None
+
+    def get_or_render(self, csv_file, version, kind, render):
+        """
+        Returns a cached snippet or calls render() and caches its result.
+        """
+        fragment = self.get(csv_file, version, kind)
+        if fragment is None:
+            generation = self.generation(csv_file)
+            fragment = render()
+            self.set(csv_file, version, kind, fragment, generation)
+        return fragment
+
+    def set(self, csv_file, version, kind, fragment, generation=None):
+        """
+        Caches a snippet.
+
+        :param generation: Value of generation() before the snippet got rendered. If the csv file got invalidated
+                           in the meantime, the snippet gets dropped.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation(csv_file):
+                return
+            self._remember((csv_file, version, kind), fragment)
+
+            if self.path is not None:
+                fragment_path = self._fragment_path(csv_file, version, kind)
+                if not os.path.exists(os.path.dirname(fragment_path)):
+                    os.makedirs(os.path.dirname(fragment_path))
+                with open(fragment_path + ".tmp", "w", encoding="utf-8") as fragment_file:
+                    fragment_file.write(fragment)
+                os.replace(fragment_path + ".tmp", fragment_path)
+
+    def generation(self, csv_file):
+        """
+        Returns a number, which changes with each invalidation of the csv file.
+        """
+        return self._generations.get(csv_file, 0)
+
+    def invalidate(self, csv_file, until_version=None):
+        """
+        Removes the snippets of a csv file.
+
+        :param until_version: Removes only the snippets of this and older versions. None removes all.
+        """
+        with self._lock:
+            self._generations[csv_file] = self._generations.get(csv_file, 0) + 1
+            for key in [key for key in self._entries.keys() if key[0] == csv_file and
+                        (until_version is None or key[1] <= until_version)]:
+                del self._entries[key]
+
+            if self.path is None or not os.path.exists(self._file_path(csv_file)):
+                return
+            if until_version is None:
+                shutil.rmtree(self._file_path(csv_file), ignore_errors=True)
+                return
+            for name in os.listdir(self._file_path(csv_file)):
+                if int(name.split("_", 1)[0]) <= until_version:
+                    os.remove(os.path.join(self._file_path(csv_file), name))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, fragment):
+        # Must be called with the lock held
+        self._entries[key] = fragment
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _file_path(self, csv_file):
+        return os.path.join(self.path, hashlib.sha1(csv_file.encode("utf-8")).hexdigest())
+
+    def _fragment_path(self, csv_file, version, kind):
+        return os.path.join(self._file_path(csv_file), "%s_%s" % (version, kind))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import calendar
+import csv
+import hashlib
+import io
+import os
+import threading
+
+from git import Repo, Actor
+from git.objects import Blob, Tree, Commit
+from git.refs import Reference
+from gitdb import IStream
+
+CONTENT_PATH = "content.csv"
+# Header of the first column, which holds the shape of each row (see _to_csv)
+SHAPE_COLUMN = "#shape"
+
+
+class GitHistoryStorage:
+    """
+    Stores the full content of each csv version as commit inside a local bare git repository.
+
+    Each csv file gets its own chain of commits, referenced by ``refs/csv/<sha1 of the file name>``.
+    Git stores similar contents as deltas inside its packfiles, so slowly changing files need little space
+    and reading any version costs a single object lookup.
+    The mapping from (csv file, version) to commit is stored in the history database by the caller.
+    """
+
+    def __init__(self, path, log, gc_interval=100):
+        self.path = path
+        self.log = log
+        self.gc_interval = gc_interval
+        if os.path.exists(path):
+            self.repo = Repo(path)
+        else:
+            self.repo = Repo.init(path, mkdir=True, bare=True)
+        self.actor = Actor("csv_manager", "csv_manager@localhost")
+        self._lock = threading.Lock()
+        self._commits = 0
+
+    def commit(self, csv_file, version, rows, parent=None, created=None):
+        """
+        Stores the content of a csv file after the given version.
+
+        :param rows: Full content of the csv file as list of dictionaries
+        :param parent: Commit id of the previous version or None
+        :param created: UTC datetime of the version
+        :return: Commit id
+        """
+        with self._lock:
+            blob_sha = self._store(Blob.type, self._to_csv(rows))
+            tree_sha = self._store(Tree.type, b"100644 " + CONTENT_PATH.encode("utf-8") + b"\0" + blob_sha)
+            date = None
+            if created is not None:
+                date = "%s +0000" % calendar.timegm(created.utctimetuple())
+            parent_commits = [self.repo.commit(parent)] if parent else []
+            commit = Commit.create_from_tree(self.repo, Tree(self.repo, tree_sha),
+                                             "%s version %s" % (csv_file, version),
+                                             parent_commits=parent_commits, head=False,
+                                             author=self.actor, committer=self.actor,
+                                             author_date=date, commit_date=date)
+            Reference.create(self.repo, self._ref(csv_file), commit.hexsha, force=True)
+
+            self._commits += 1
+            if self.gc_interval and self._commits % self.gc_interval == 0:
+                # Packs loose objects into delta compressed packfiles, if git thinks it is worth it
+                self.repo.git.gc("--auto", "--quiet")
+            return commit.hexsha
+
+    def read(self, commit_id):
+        """
+        Returns the content of a csv file at the given commit as list of dictionaries.
+        """
+        data = self.repo.commit(commit_id).tree[CONTENT_PATH].data_stream.read().decode("utf-8")
+        reader = csv.reader(io.StringIO(data))
+        header = next(reader, None)
+        if header is None:
+            return []
+        if header[0] != SHAPE_COLUMN:
+            # Stored without row shapes
+            return [dict(row) for row in csv.DictReader(io.StringIO(data))]
+        return [self._from_cells(header[1:], cells[0], cells[1:]) for cells in reader]
+
+    def remove(self, csv_file):
+        """
+        Removes the reference of a csv file. Its commits get deleted by the next git gc.
+        """
+        with self._lock:
+            self.repo.git.update_ref("-d", self._ref(csv_file))
+
+    def _store(self, object_type, data):
+        return self.repo.odb.store(IStream(object_type, len(data), io.BytesIO(data))).binsha
+
+    @staticmethod
+    def _ref(csv_file):
+        return "refs/csv/%s" % hashlib.sha1(csv_file.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _to_csv(rows):
+        """
+        Returns the rows as csv content. Values are stored as strings.
+
+        Rows of ragged csv files have None values for missing cells and a list of surplus cells
+        under the key None. So each row starts with its shape, one character per column:
+        ``v`` for a value, ``n`` for None and ``-`` for a column the row does not have.
+        A trailing ``+`` tells, that the cells after the columns belong to the key None.
+        """
+        if len(rows) == 0:
+            return b""
+        fieldnames = []
+        for row in rows:
+            for column in row.keys():
+                if column is not None and column not in fieldnames:
+                    fieldnames.append(column)
+        content = io.StringIO()
+        writer = csv.writer(content, lineterminator="\n")
+        writer.writerow([SHAPE_COLUMN] + fieldnames)
+        for row in rows:
+            shape = "".join("-" if column not in row else "n" if row[column] is None else "v"
+                            for column in fieldnames)
+            cells = [row[column] if flag == "v" else "" for column, flag in zip(fieldnames, shape)]
+            if None in row:
+                shape += "+"
+                cells.extend(row[None])
+            writer.writerow([shape] + cells)
+        return content.getvalue().encode("utf-8")
+
+    @staticmethod
+    def _from_cells(fieldnames, shape, cells):
+        row = {}
+        for column, flag, value in zip(fieldnames, shape, cells):
+            if flag != "-":
+                row[column] = value if flag == "v" else None
+        if shape.endswith("+"):
+            row[None] = cells[len(fieldnames):]
+        return row
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for working with archived csv rows outside of the database models.
+"""
+import base64
+import json
+import pickle
+import zlib
+from _datetime import datetime
+from collections import Counter
+
+TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+def row_key(row):
+    """
+    Returns a hashable representation of a csv row, which compares the same way
+    as the row dictionaries compared by the csv watcher.
+    """
+    return tuple(sorted((str(key), str(value)) for key, value in row.items()))
+
+
+def apply_delta(rows, missing_rows, new_rows):
+    """
+    Applies the changes of a single version to a list of rows.
+
+    Each missing row removes exactly one equal row, new rows get appended.
+    """
+    missing = Counter(row_key(row) for row in missing_rows)
+    result = []
+    for row in rows:
+        key = row_key(row)
+        if missing[key] > 0:
+            missing[key] -= 1
+            continue
+        result.append(row)
+    result.extend(new_rows)
+    return result
+
+
+def diff_rows(old_rows, new_rows):
+    """
+    Returns the change between two contents of a csv file as (missing_rows, new_rows),
+    so that apply_delta(old_rows, missing_rows, new_rows) has the same rows as new_rows.
+    """
+    old_counts = Counter(row_key(row) for row in old_rows)
+    new_counts = Counter(row_key(row) for row in new_rows)
+    missing = old_counts - new_counts
+    added = new_counts - old_counts
+    missing_rows = []
+    for row in old_rows:
+        key = row_key(row)
+        if missing[key] > 0:
+            missing[key] -= 1
+            missing_rows.append(row)
+    added_rows = []
+    for row in new_rows:
+        key = row_key(row)
+        if added[key] > 0:
+            added[key] -= 1
+            added_rows.append(row)
+    return missing_rows, added_rows
+
+
+def compress_rows(rows):
+    return zlib.compress(pickle.dumps([dict(row) for row in rows], pickle.HIGHEST_PROTOCOL))
+
+
+def decompress_rows(data):
+    return pickle.loads(zlib.decompress(data))
+
+
+def compress_columnar(rows):
+    """
+    Compresses rows column by column, so that similar values of a column are close to each other.
+
+    Rows with different columns are stored in separate layouts. The order of the rows is kept.
+    """
+    layouts = []
+    values = []
+    row_layouts = []
+    for row in rows:
+        columns = tuple(row.keys())
+        if columns not in layouts:
+            layouts.append(columns)
+            values.append([[] for column in columns])
+        layout = layouts.index(columns)
+        row_layouts.append(layout)
+        for column_values, value in zip(values[layout], row.values()):
+            column_values.append(value)
+    return zlib.compress(pickle.dumps((layouts, values, row_layouts), pickle.HIGHEST_PROTOCOL))
+
+
+def iter_columnar(data):
+    """
+    Yields the rows of a blob created by compress_columnar() one by one.
+    """
+    layouts, values, row_layouts = pickle.loads(zlib.decompress(data))
+    positions = [0] * len(layouts)
+    for layout in row_layouts:
+        position = positions[layout]
+        positions[layout] += 1
+        yield dict(zip(layouts[layout], (column_values[position] for column_values in values[layout])))
+
+
+def squash_deltas(deltas):
+    """
+    Combines the changes of several consecutive versions into their net change.
+
+    Rows, which got added and removed again (or the other way round) inside the given versions, cancel out.
+
+    :param deltas: Iterable of (missing_rows, new_rows) tuples, ordered by version
+    :return: Tuple of (missing_rows, new_rows)
+    """
+    net_missing = {}
+    net_new = {}
+    for missing_rows, new_rows in deltas:
+        for row in missing_rows:
+            key = row_key(row)
+            if net_new.get(key):
+                net_new[key].pop()
+            else:
+                net_missing.setdefault(key, []).append(row)
+        for row in new_rows:
+            key = row_key(row)
+            if net_missing.get(key):
+                net_missing[key].pop()
+            else:
+                net_new.setdefault(key, []).append(row)
+
+    return ([row for rows in net_missing.values() for row in rows],
+            [row for rows in net_new.values() for row in rows])
+
+
+def get_key_value(row, key_columns):
+    """
+    Returns the business key of a row as string.
+    Values of several key columns are separated by the ASCII unit separator.
+    """
+    return "\x1f".join(str(row.get(column, "")) for column in key_columns)
+
+
+def get_keyed_changes(missing_rows, new_rows, key_columns):
+    """
+    Classifies the changes of a version by the business key of the rows.
+
+    A key, which is part of the missing and the new rows, got modified.
+
+    :return: List of (key, change) tuples. change is "added", "removed" or "modified"
+    """
+    missing_keys = set(get_key_value(row, key_columns) for row in missing_rows)
+    new_keys = set(get_key_value(row, key_columns) for row in new_rows)
+    changes = [(key, "modified") for key in sorted(missing_keys & new_keys)]
+    changes += [(key, "removed") for key in sorted(missing_keys - new_keys)]
+    changes += [(key, "added") for key in sorted(new_keys - missing_keys)]
+    return changes
+
+
+def summarize_changes(missing_rows, new_rows, key_columns=None):
+    """
+    Computes the summary of a single version.
+
+    Null counts and numeric min/max values are calculated over the new rows.
+    Modified rows and changed columns are only detected by key columns. Without key columns,
+    changed_rows is None and changed_columns contains all columns, whose values differ between
+    missing and new rows.
+
+    :return: Dictionary with new_rows, missing_rows, changed_rows, null_counts, numeric_min,
+             numeric_max and changed_columns
+    """
+    columns = []
+    for row in list(missing_rows) + list(new_rows):
+        for column in row.keys():
+            if column not in columns:
+                columns.append(column)
+
+    null_counts = {}
+    numeric_min = {}
+    numeric_max = {}
+    for column in columns:
+        values = [row.get(column, None) for row in new_rows]
+        null_counts[column] = len([value for value in values if value is None or value == ""])
+        numbers = []
+        for value in values:
+            if value is None or value == "":
+                continue
+            try:
+                numbers.append(float(value))
+            except (TypeError, ValueError):
+                numbers = None
+                break
+        if numbers:
+            numeric_min[column] = min(numbers)
+            numeric_max[column] = max(numbers)
+
+    changed_rows = None
+    changed_columns = set()
+    if key_columns:
+        missing_by_key = dict((get_key_value(row, key_columns), row) for row in missing_rows)
+        new_by_key = dict((get_key_value(row, key_columns), row) for row in new_rows)
+        modified_keys = set(missing_by_key.keys()) & set(new_by_key.keys())
+        changed_rows = len(modified_keys)
+        for key in modified_keys:
+            for column in columns:
+                if missing_by_key[key].get(column, None) != new_by_key[key].get(column, None):
+                    changed_columns.add(column)
+    else:
+        for column in columns:
+            if Counter(str(row.get(column, None)) for row in missing_rows) != \
+                    Counter(str(row.get(column, None)) for row in new_rows):
+                changed_columns.add(column)
+
+    return {"new_rows": len(new_rows),
+            "missing_rows": len(missing_rows),
+            "changed_rows": changed_rows,
+            "null_counts": null_counts,
+            "numeric_min": numeric_min,
+            "numeric_max": numeric_max,
+            "changed_columns": sorted(str(column) for column in changed_columns)}
+
+
+def parse_timestamp(value):
+    """
+    Parses timestamps like ``2017-05-01``, ``2017-05-01 12:30`` or ``2017-05-01T12:30:00``.
+
+    :raises ValueError: If the value has none of the supported formats
+    """
+    value = value.strip().replace("T", " ")
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid timestamp: %s" % value)
+
+
+def encode_cursor(created, csv_file, version):
+    """
+    Returns an url safe cursor for the position (created, csv_file, version) inside a list of changes.
+    """
+    position = json.dumps([created.strftime(TIMESTAMP_FORMATS[0]), csv_file, version])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (created, csv_file, version) position of a cursor created by encode_cursor().
+
+    :raises ValueError: If the cursor is invalid
+    """
+    try:
+        created, csv_file, version = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return datetime.strptime(created, TIMESTAMP_FORMATS[0]), csv_file, int(version)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+
+def split_cell_changes(missing_rows, new_rows, key_columns):
+    """
+    Replaces modified rows by the values of their changed cells.
+
+    A row counts as modified, if exactly one missing and one new row have its key and both have the same columns.
+
+    :return: Tuple of (missing_rows, new_rows, cell_changes). missing_rows and new_rows contain only real
+             deletes and inserts. cell_changes is a list of (key, column, old_value, new_value) tuples.
+    """
+    missing_by_key = {}
+    for row in missing_rows:
+        missing_by_key.setdefault(get_key_value(row, key_columns), []).append(row)
+    new_by_key = {}
+    for row in new_rows:
+        new_by_key.setdefault(get_key_value(row, key_columns), []).append(row)
+
+    modified_keys = set()
+    cell_changes = []
+    for key in sorted(set(missing_by_key.keys()) & set(new_by_key.keys())):
+        if len(missing_by_key[key]) != 1 or len(new_by_key[key]) != 1:
+            continue
+        old_row = missing_by_key[key][0]
+        new_row = new_by_key[key][0]
+        if list(old_row.keys()) != list(new_row.keys()):
+            continue
+        changes = [(key, column, old_row[column], new_row[column])
+                   for column in old_row.keys() if old_row[column] != new_row[column]]
+        if len(changes) > 0:
+            modified_keys.add(key)
+            cell_changes += changes
+
+    return ([row for row in missing_rows if get_key_value(row, key_columns) not in modified_keys],
+            [row for row in new_rows if get_key_value(row, key_columns) not in modified_keys],
+            cell_changes)
+
+
+def expand_cell_changes(rows, cell_changes, key_columns):
+    """
+    Turns cell changes back into full rows.
+
+    The key does not need to be unique: a change applies to the first row with its key,
+    which still has the old values in all changed columns.
+
+    :param rows: Content of the csv file before the change
+    :param cell_changes: List of (key, column, old_value, new_value) tuples
+    :return: Tuple of (missing_rows, new_rows)
+    """
+    changes_by_key = {}
+    for key, column, old_value, new_value in cell_changes:
+        changes_by_key.setdefault(key, []).append((column, old_value, new_value))
+
+    missing_rows = []
+    new_rows = []
+    for row in rows:
+        changes = changes_by_key.get(get_key_value(row, key_columns), None)
+        if changes is None or any(row.get(column) != old_value for column, old_value, new_value in changes):
+            continue
+        new_row = dict(row)
+        for column, old_value, new_value in changes:
+            new_row[column] = new_value
+        del changes_by_key[get_key_value(row, key_columns)]
+        missing_rows.append(row)
+        new_rows.append(new_row)
+    return missing_rows, new_rows
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Schema migrations for existing history databases.
+
+The schema version of a database is stored in sqlite's ``user_version`` pragma.
+"""
+import time
+from _datetime import datetime
+
+from sqlalchemy import inspect, text, exists
+
+SCHEMA_VERSION = 6
+
+
+def migrate(shard, log, plugin, batch_size=1000):
+    """
+    Brings the database of a shard to the current schema version.
+    Must be called after the tables and all shards of the plugin got created,
+    as stored versions get read through the plugin.
+    """
+    engine = shard.db.engine
+    if engine.dialect.name != "sqlite":
+        return
+    create_missing_indexes(shard, log)
+
+    schema_version = engine.execute("PRAGMA user_version").scalar()
+    if schema_version < 1:
+        log.info("Migrating %s to schema version 1: created timestamps as UTC" % shard)
+        for table in (shard.CsvFile.__table__, shard.Version.__table__):
+            _convert_created_to_utc(engine, table, batch_size)
+    if schema_version < 2:
+        _add_missing_column(shard, log, shard.Version.__table__, "commit_id")
+    if schema_version < 3:
+        _add_missing_column(shard, log, shard.Version.__table__, "segment")
+    if schema_version < 4:
+        index_archived_summaries(shard, log, plugin, batch_size)
+    if schema_version < 5:
+        index_archived_search(shard, log, plugin, batch_size)
+    if schema_version < 6:
+        index_archived_lineage(shard, log, plugin, batch_size)
+    engine.execute("PRAGMA user_version = %s" % SCHEMA_VERSION)
+
+
+def create_missing_indexes(shard, log):
+    """
+    create_all() does not add new indexes to already existing tables, so this is done here.
+    """
+    engine = shard.db.engine
+    inspector = inspect(engine)
+    for table in shard.db.Base.metadata.sorted_tables:
+        existing = [index["name"] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info("Creating index %s on %s" % (index.name, table.name))
+                index.create(engine)
+
+
+def index_archived_summaries(shard, log, plugin, batch_size=1000):
+    """
+    Stores the summary of versions without a summary.
+    These were archived before summaries existed, so the history views would not show them.
+    """
+    Summary = shard.VersionSummary
+
+    def _pending(csv_file_object):
+        return shard.db.query(shard.Version.id, shard.Version.version) \
+            .outerjoin(Summary, Summary.version_id == shard.Version.id) \
+            .filter(shard.Version.csv_file_id == csv_file_object.id, Summary.id.is_(None))
+
+    def _index(csv_file_object, version_object, missing_rows, new_rows):
+        plugin.store_version_summary(shard, csv_file_object, version_object, missing_rows, new_rows)
+
+    _index_versions(shard, log, plugin, "summaries", _pending, _index, batch_size)
+
+
+def index_archived_lineage(shard, log, plugin, batch_size=1000):
+    """
+    Stores the row lineage of versions of csv files with key columns, which have no lineage entries.
+    These were archived before the lineage existed, so the lineage of their rows would be incomplete.
+    """
+    RowLineage = shard.RowLineage
+
+    def _pending(csv_file_object):
+        if not plugin.get_key_columns(csv_file_object.name):
+            return []
+        return shard.db.query(shard.Version.id, shard.Version.version) \
+            .filter(shard.Version.csv_file_id == csv_file_object.id,
+                    ~exists().where(RowLineage.version_id == shard.Version.id))
+
+    def _index(csv_file_object, version_object, missing_rows, new_rows):
+        plugin.store_row_lineage(shard, csv_file_object, version_object, missing_rows, new_rows)
+
+    _index_versions(shard, log, plugin, "row lineage", _pending, _index, batch_size)
+
+
+def index_archived_search(shard, log, plugin, batch_size=1000):
+    """
+    Adds the rows of versions without search index entries to the search index.
+    These were archived before the search existed, so searches would not find them.
+    """
+    if not shard.search.available:
+        return
+
+    def _pending(csv_file_object):
+        return shard.db.query(shard.Version.id, shard.Version.version) \
+            .filter(shard.Version.csv_file_id == csv_file_object.id, ~shard.search.has_entries())
+
+    def _index(csv_file_object, version_object, missing_rows, new_rows):
+        shard.search.add(version_object.id, missing_rows, new_rows)
+
+    _index_versions(shard, log, plugin, "search index", _pending, _index, batch_size)
+
+
+def _index_versions(shard, log, plugin, name, pending, index, batch_size):
+    """
+    Reads the rows of archived versions through the plugin and calls
+    index(csv_file_object, version_object, missing_rows, new_rows) for each of them, which is returned by
+    pending(csv_file_object) as query of id and version. Every batch_size versions get committed.
+    """
+    for csv_file_object in shard.CsvFile.query.order_by(shard.CsvFile.id).all():
+        versions = dict(pending(csv_file_object))
+        if len(versions) == 0:
+            continue
+        log.info("Building the %s of %s archived versions of %s" % (name, len(versions), csv_file_object.name))
+        done = 0
+        for version_object, missing_rows, new_rows in \
+                plugin.iter_version_deltas(shard, csv_file_object, min(versions.values()) - 1,
+                                           max(versions.values()), batch_size):
+            if version_object.id not in versions:
+                continue
+            index(csv_file_object, version_object, missing_rows, new_rows)
+            done += 1
+            if done % batch_size == 0:
+                shard.db.commit()
+        shard.db.commit()
+    shard.db.session.remove()
+
+
+def _add_missing_column(shard, log, table, name):
+    engine = shard.db.engine
+    if name in [column["name"] for column in inspect(engine).get_columns(table.name)]:
+        return
+    column = table.c[name]
+    log.info("Adding column %s to %s" % (name, table.name))
+    engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, name, column.type.compile(engine.dialect)))
+
+
+def _convert_created_to_utc(engine, table, batch_size):
+    """
+    Converts the local time strings, written by older versions via str(datetime.now()),
+    into UTC timestamps in the format of sqlalchemy's DateTime type.
+    """
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(text("SELECT id, created FROM %s WHERE id > :last_id ORDER BY id LIMIT :limit"
+                                           % table.name), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if len(rows) == 0:
+                break
+            updates = []
+            for row_id, created in rows:
+                if created:
+                    updates.append({"row_id": row_id, "created": _local_to_utc(created)})
+            if len(updates) > 0:
+                connection.execute(text("UPDATE %s SET created = :created WHERE id = :row_id" % table.name), updates)
+            last_id = rows[-1][0]
+
+
+def _local_to_utc(value):
+    local = datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f" if "." in value else "%Y-%m-%d %H:%M:%S")
+    utc = datetime.utcfromtimestamp(time.mktime(local.timetuple())).replace(microsecond=local.microsecond)
+    return utc.strftime("%Y-%m-%d %H:%M:%S.%f")
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from sqlalchemy import Column, ForeignKey, Integer, String, PickleType
+from sqlalchemy import Column, ForeignKey, Integer, String, PickleType, LargeBinary, Index, DateTime, Text
 from sqlalchemy.orm import relationship, backref
 
+from .history import iter_columnar
+
 
 def get_models(db):
 
@@ -13,8 +15,9 @@ def get_models(db):
         __tablename__ = 'csv_file'
 
         id = Column(Integer, primary_key=True)
-        name = Column(String(2048), nullable=False)
-        created = Column(String(255))
+        name = Column(String(2048), nullable=False, index=True)
+        # UTC
+        created = Column(DateTime, index=True)
         current_version = Column(Integer)
 
         # version_id = Column(ForeignKey(u'version.id'))
@@ -25,24 +28,56 @@ def get_models(db):
 
     class Version(Base):
         __tablename__ = 'version'
+        __table_args__ = (Index('ix_version_csv_file_version', 'csv_file_id', 'version'),)
 
         id = Column(Integer, primary_key=True)
         version = Column(Integer, nullable=False)
-        created = Column(String(255))
-        csv_file_id = Column(Integer, ForeignKey('csv_file.id'))
+        # UTC
+        created = Column(DateTime, index=True)
+        csv_file_id = Column(Integer, ForeignKey('csv_file.id'), index=True)
+        # Commit of the version, if HISTORY_STORAGE is "git"
+        commit_id = Column(String(40))
+        # Segment, which contains the rows of the version, if HISTORY_STORAGE is "segments"
+        segment = Column(Integer)
         csv_file = relationship("CsvFile", backref="version")
         new_row = relationship("NewRow", back_populates="version", cascade="all, delete-orphan")
         missing_row = relationship("MissingRow", back_populates="version", cascade="all, delete-orphan")
+        snapshot = relationship("Snapshot", cascade="all, delete-orphan", uselist=False)
+        summary = relationship("VersionSummary", cascade="all, delete-orphan", uselist=False)
+        cell_change = relationship("CellChange", cascade="all, delete-orphan")
+        row_blob = relationship("RowBlob", cascade="all, delete-orphan", uselist=False)
 
         def __str__(self):
             return str(self.version)
 
+        def iter_missing_rows(self):
+            """
+            Yields the stored missing rows, no matter if they are stored as single rows or as blob.
+            Changed cells are not part of them.
+            """
+            for missing_row in self.missing_row:
+                yield missing_row.row
+            if self.row_blob is not None:
+                for row in iter_columnar(self.row_blob.missing_rows):
+                    yield row
+
+        def iter_new_rows(self):
+            """
+            Yields the stored new rows, no matter if they are stored as single rows or as blob.
+            Changed cells are not part of them.
+            """
+            for new_row in self.new_row:
+                yield new_row.row
+            if self.row_blob is not None:
+                for row in iter_columnar(self.row_blob.new_rows):
+                    yield row
+
     class MissingRow(Base):
         __tablename__ = 'missing_row'
 
         id = Column(Integer, primary_key=True)
         row = Column(PickleType, nullable=False)
-        version_id = Column(Integer, ForeignKey('version.id'))
+        version_id = Column(Integer, ForeignKey('version.id'), index=True)
         version = relationship("Version", back_populates="missing_row")
 
         def __str__(self):
@@ -53,10 +88,100 @@ def get_models(db):
 
         id = Column(Integer, primary_key=True)
         row = Column(PickleType, nullable=False)
-        version_id = Column(Integer, ForeignKey('version.id'))
+        version_id = Column(Integer, ForeignKey('version.id'), index=True)
         version = relationship("Version", back_populates="new_row")
 
         def __str__(self):
             return str(self.row)
 
-    return CsvFile, Version, MissingRow, NewRow
+    class Snapshot(Base):
+        """
+        Full, compressed content of a csv file after a specific version.
+        Used as starting point for reconstructing older versions.
+        """
+        __tablename__ = 'snapshot'
+        __table_args__ = (Index('ix_snapshot_csv_file_version', 'csv_file_id', 'version'),)
+
+        id = Column(Integer, primary_key=True)
+        version = Column(Integer, nullable=False)
+        rows = Column(LargeBinary, nullable=False)
+        csv_file_id = Column(Integer, ForeignKey('csv_file.id'))
+        version_id = Column(Integer, ForeignKey('version.id'))
+
+        def __str__(self):
+            return str(self.version)
+
+    class RowLineage(Base):
+        """
+        Change of a single row, identified by the key columns of its csv file.
+        """
+        __tablename__ = 'row_lineage'
+        __table_args__ = (Index('ix_row_lineage_csv_file_key', 'csv_file_id', 'row_key', 'version'),)
+
+        id = Column(Integer, primary_key=True)
+        row_key = Column(String(2048), nullable=False)
+        change = Column(String(16), nullable=False)
+        version = Column(Integer, nullable=False)
+        csv_file_id = Column(Integer, ForeignKey('csv_file.id'))
+        version_id = Column(Integer, ForeignKey('version.id'), index=True)
+
+        def __str__(self):
+            return "%s %s" % (self.row_key, self.change)
+
+    class VersionSummary(Base):
+        """
+        Precomputed counts and column statistics of a version.
+        Views can show what changed without loading the archived rows.
+        """
+        __tablename__ = 'version_summary'
+
+        id = Column(Integer, primary_key=True)
+        version = Column(Integer, nullable=False)
+        new_rows = Column(Integer, nullable=False)
+        missing_rows = Column(Integer, nullable=False)
+        changed_rows = Column(Integer)
+        null_counts = Column(PickleType)
+        numeric_min = Column(PickleType)
+        numeric_max = Column(PickleType)
+        changed_columns = Column(PickleType)
+        csv_file_id = Column(Integer, ForeignKey('csv_file.id'), index=True)
+        version_id = Column(Integer, ForeignKey('version.id'), index=True)
+
+        def __str__(self):
+            return "%s new, %s missing" % (self.new_rows, self.missing_rows)
+
+    class CellChange(Base):
+        """
+        Changed value of a single cell of a keyed row.
+        Stored instead of a full missing and new row, if HISTORY_CELL_DELTAS is enabled.
+        """
+        __tablename__ = 'cell_change'
+
+        id = Column(Integer, primary_key=True)
+        row_key = Column(String(2048), nullable=False)
+        column_name = Column(String(2048), nullable=False)
+        old_value = Column(Text)
+        new_value = Column(Text)
+        csv_file_id = Column(Integer, ForeignKey('csv_file.id'))
+        version_id = Column(Integer, ForeignKey('version.id'), index=True)
+
+        def __str__(self):
+            return "%s %s: %s -> %s" % (self.row_key, self.column_name, self.old_value, self.new_value)
+
+    class RowBlob(Base):
+        """
+        Missing and new rows of a version, each compressed column by column into a single blob.
+        Stored instead of MissingRow and NewRow entries, if HISTORY_ROW_BLOBS is enabled.
+        """
+        __tablename__ = 'row_blob'
+
+        id = Column(Integer, primary_key=True)
+        missing_rows = Column(LargeBinary, nullable=False)
+        new_rows = Column(LargeBinary, nullable=False)
+        csv_file_id = Column(Integer, ForeignKey('csv_file.id'))
+        version_id = Column(Integer, ForeignKey('version.id'), index=True)
+
+        def __str__(self):
+            return str(self.version_id)
+
+    return CsvFile, Version, MissingRow, NewRow, Snapshot, RowLineage, VersionSummary, CellChange, RowBlob
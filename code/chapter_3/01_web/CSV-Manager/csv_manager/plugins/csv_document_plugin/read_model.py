@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+
+FileInfo = namedtuple("FileInfo", "id name current_version created")
+VersionInfo = namedtuple("VersionInfo", "id version created summary")
+SummaryInfo = namedtuple("SummaryInfo", "id version new_rows missing_rows changed_rows null_counts numeric_min "
+                                        "numeric_max changed_columns")
+
+FILES_KEY = ("files",)
+
+
+def get_summary_info(summary):
+    """
+    Returns a SummaryInfo with the values of a VersionSummary or None.
+    """
+    if summary is None:
+        return None
+    return SummaryInfo(*[getattr(summary, field) for field in SummaryInfo._fields])
+
+
+def estimate_size(value, sample=100):
+    """
+    Returns the estimated memory usage of a value in bytes, including the values it contains.
+    Long lists get estimated from their first sample items.
+    """
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        size = sum(estimate_size(item) for item in value[:sample])
+        if len(value) > sample:
+            size = size * len(value) // sample
+        return sys.getsizeof(value) + size
+    return sys.getsizeof(value)
+
+
+class HistoryReadModel:
+    """
+    Keeps the metadata of archived csv files and versions and the rows of recent versions in memory,
+    so that views can be served without reading the history databases.
+
+    The archiver updates the read model after each archived version. Readers fill it on a miss.
+    Entries are evicted least recently used first, when their estimated size exceeds max_bytes.
+    Other processes, like commands, change the history databases without the read model, so readers validate
+    it against the current state of the database first.
+
+    Entries:
+
+    * All csv files as dictionary of FileInfo by name
+    * Per csv file the newest max_versions versions as list of VersionInfo, newest first.
+      ``complete`` tells, if these are all versions of the file.
+    * Per version the missing and new rows, as they were archived
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_versions=100):
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented by each change of a csv file. Values, which were loaded before, do not get stored.
+        self._generations = {}
+        # State of the history database, which the entries belong to. Per csv file and None for the list of files.
+        self._states = {}
+
+    def generation(self, csv_file=None):
+        """
+        Returns a number, which changes with each change of the csv file.
+        None returns the number for the list of files, which changes with each change of any csv file.
+        """
+        return self._generations.get(csv_file, 0)
+
+    def get_files(self):
+        """
+        Returns the dictionary of FileInfo by name or None.
+        """
+        return self._get(FILES_KEY)
+
+    def set_files(self, files, generation):
+        """
+        :param files: Dictionary of FileInfo by name
+        :param generation: Value of generation() before the files got loaded
+        """
+        self._set(FILES_KEY, files, None, generation)
+
+    def get_versions(self, csv_file):
+        """
+        Returns a dictionary with the list of VersionInfo (versions, newest first) and complete or None.
+        """
+        return self._get(("versions", csv_file))
+
+    def set_versions(self, csv_file, versions, complete, generation):
+        """
+        :param versions: List of VersionInfo, newest first
+        :param complete: True, if these are all versions of the csv file
+        :param generation: Value of generation(csv_file) before the versions got loaded
+        """
+        self._set(("versions", csv_file), {"versions": versions[:self.max_versions],
+                                           "complete": complete and len(versions) <= self.max_versions},
+                  csv_file, generation)
+
+    def get_diff(self, csv_file, version):
+        """
+        Returns the tuple of missing and new rows of a version or None.
+        """
+        return self._get(("diff", csv_file, version))
+
+    def add_version(self, file_info, version_info, missing_rows, new_rows):
+        """
+        Adds a just archived version.
+        """
+        csv_file = file_info.name
+        diff = (missing_rows, new_rows)
+        diff_size = estimate_size(diff)
+        with self._lock:
+            self._generations[csv_file] = self._generations.get(csv_file, 0) + 1
+            self._generations[None] = self._generations.get(None, 0) + 1
+
+            # Entries get replaced instead of changed, as readers might iterate over them right now
+            if FILES_KEY in self._entries:
+                files, size = self._entries[FILES_KEY]
+                if csv_file not in files.keys():
+                    size += estimate_size(csv_file) + estimate_size(file_info)
+                files = dict(files)
+                files[csv_file] = file_info
+                self._replace(FILES_KEY, files, size)
+
+            versions_key = ("versions", csv_file)
+            if versions_key in self._entries:
+                entry, size = self._entries[versions_key]
+                versions = [version_info] + entry["versions"]
+                complete = entry["complete"]
+                size += estimate_size(version_info)
+                if len(versions) > self.max_versions:
+                    size -= estimate_size(versions.pop())
+                    complete = False
+                self._replace(versions_key, {"versions": versions, "complete": complete}, size)
+
+            self._put(("diff", csv_file, version_info.version), diff, diff_size)
+
+    def invalidate(self, csv_file, until_version=None):
+        """
+        Removes the versions of a csv file and the rows of its versions.
+
+        :param until_version: Removes only the rows of this and older versions. None removes all.
+        """
+        with self._lock:
+            self._invalidate(csv_file, until_version)
+
+    def validate(self, csv_file, state):
+        """
+        Removes the entries of a csv file or, for None, the list of files, if the given state of the history
+        database differs from the one of the last call.
+
+        :param state: Value, which changes with each change of the csv file or the list of files in the database
+        :return: True, if the entries got removed
+        """
+        with self._lock:
+            if csv_file in self._states.keys() and self._states[csv_file] == state:
+                return False
+            self._states[csv_file] = state
+            if csv_file is None:
+                self._generations[None] = self._generations.get(None, 0) + 1
+                if FILES_KEY in self._entries:
+                    self.size -= self._entries.pop(FILES_KEY)[1]
+            else:
+                self._invalidate(csv_file)
+            return True
+
+    def get_state(self, csv_file):
+        """
+        Returns the state of the last validate() call or None.
+        """
+        return self._states.get(csv_file, None)
+
+    def update_state(self, csv_file, previous_state, state):
+        """
+        Sets the state after a change, which was already applied by add_version().
+        Only done, if the entries belong to previous_state, i.e. no other process changed the database before.
+        """
+        with self._lock:
+            if csv_file in self._states.keys() and self._states[csv_file] == previous_state:
+                self._states[csv_file] = state
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def _invalidate(self, csv_file, until_version=None):
+        # Must be called with the lock held
+        self._generations[csv_file] = self._generations.get(csv_file, 0) + 1
+        for key in [key for key in self._entries.keys() if
+                    (key[0] == "versions" and key[1] == csv_file) or
+                    (key[0] == "diff" and key[1] == csv_file and
+                     (until_version is None or key[2] <= until_version))]:
+            self.size -= self._entries.pop(key)[1]
+
+    def _set(self, key, value, csv_file, generation):
+        size = estimate_size(value)
+        with self._lock:
+            if generation != self._generations.get(csv_file, 0):
+                return
+            self._put(key, value, size)
+
+    def _put(self, key, value, size):
+        # Must be called with the lock held
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def _replace(self, key, value, size):
+        # Must be called with the lock held. Updates the size of a changed entry.
+        self.size += size - self._entries[key][1]
+        self._entries[key] = (value, size)
+        self._entries.move_to_end(key)
+        while self.size > self.max_bytes:
+            self.size -= self._entries.popitem(last=False)[1][1]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+from itertools import chain, islice
+
+from sqlalchemy import text, DateTime
+from sqlalchemy.exc import OperationalError
+
+# The rowid of an index entry is built from the version id and the position of the row inside the version.
+# So all entries of a version can be removed by a cheap rowid range delete.
+# Rows of a version after the first 2^ROWID_SHIFT would collide with the next version and are not indexed.
+ROWID_SHIFT = 24
+MAX_VERSION_ENTRIES = 1 << ROWID_SHIFT
+
+
+class SearchIndex:
+    """
+    Full-text index over the archived rows of a history shard, based on sqlite FTS5.
+
+    Each archived row gets one entry, which contains its column names and values.
+    If the sqlite library does not support FTS5, the index is disabled and searches return no results.
+    """
+
+    def __init__(self, shard, log):
+        self.shard = shard
+        self.log = log
+        self.available = False
+        try:
+            with shard.db.engine.begin() as connection:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS row_search "
+                                   "USING fts5(content, change UNINDEXED, row UNINDEXED)")
+        except OperationalError as e:
+            self.log.warning("Search index for %s disabled, FTS5 not available: %s" % (shard, e))
+        else:
+            self.available = True
+
+    def add(self, version_id, missing_rows, new_rows):
+        """
+        Adds the rows of a version to the index. Must be committed by the caller.
+        Only the first MAX_VERSION_ENTRIES rows of a version get indexed.
+        """
+        if not self.available:
+            return
+        changes = chain((("missing", row) for row in missing_rows), (("new", row) for row in new_rows))
+        entries = [{"rowid": (version_id << ROWID_SHIFT) + position,
+                    "content": " ".join("%s %s" % (key, value) for key, value in row.items()),
+                    "change": change,
+                    "row": json.dumps(row)}
+                   for position, (change, row) in enumerate(islice(changes, MAX_VERSION_ENTRIES))]
+        if len(missing_rows) + len(new_rows) > MAX_VERSION_ENTRIES:
+            self.log.warning("Version %s has more than %s rows, the others are not searchable" %
+                             (version_id, MAX_VERSION_ENTRIES))
+        if len(entries) > 0:
+            self.shard.db.session.execute(text("INSERT INTO row_search (rowid, content, change, row) "
+                                               "VALUES (:rowid, :content, :change, :row)"), entries)
+
+    def remove(self, version_ids):
+        """
+        Removes the entries of the given versions. Must be committed by the caller.
+        """
+        if not self.available:
+            return
+        if len(version_ids) > 0:
+            self.shard.db.session.execute(text("DELETE FROM row_search WHERE rowid >= :first AND rowid < :last"),
+                                          [{"first": version_id << ROWID_SHIFT,
+                                            "last": (version_id + 1) << ROWID_SHIFT} for version_id in version_ids])
+
+    @staticmethod
+    def has_entries():
+        """
+        Returns an sql condition for queries of the version table, which is true for versions with index entries.
+        """
+        return text("EXISTS (SELECT 1 FROM row_search WHERE rowid >= (version.id << %s) "
+                    "AND rowid < ((version.id + 1) << %s))" % (ROWID_SHIFT, ROWID_SHIFT))
+
+    def search(self, query, csv_file=None, limit=100):
+        """
+        Searches archived rows.
+
+        :param query: FTS5 query, e.g. ``4711`` or ``"Richard" AND Paris``
+        :param csv_file: Optional name of a csv file to restrict the search to
+        :param limit: Maximum number of results
+        :return: List of dictionaries with csv_file, version, created, change and row. Ordered by archive time.
+        """
+        if not self.available:
+            return []
+        statement = "SELECT csv_file.name, version.version, version.created AS created, " \
+                    "row_search.change, row_search.row " \
+                    "FROM row_search " \
+                    "JOIN version ON version.id = (row_search.rowid >> %s) " \
+                    "JOIN csv_file ON csv_file.id = version.csv_file_id " \
+                    "WHERE row_search MATCH :query " % ROWID_SHIFT
+        params = {"query": query, "limit": limit}
+        if csv_file is not None:
+            statement += "AND csv_file.name = :csv_file "
+            params["csv_file"] = csv_file
+        statement += "ORDER BY row_search.rowid LIMIT :limit"
+
+        results = []
+        for name, version, created, change, row in self.shard.db.session.execute(
+                text(statement).columns(created=DateTime), params):
+            results.append({"csv_file": name,
+                            "version": version,
+                            "created": created,
+                            "change": change,
+                            "row": json.loads(row)})
+        return results
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import calendar
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+# payload length, name length, version, created (UTC, microseconds since epoch)
+RECORD_HEADER = struct.Struct(">IHIq")
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+TOMBSTONES = "tombstones.pickle"
+
+
+class SegmentStorage:
+    """
+    Append-only storage for change events, split into size-rotated segment files.
+
+    Each record consists of a fixed header, the name of the csv file and the zlib compressed
+    missing and new rows of one version. Appending is a single sequential write.
+
+    The index stores the offset of each record per segment, csv file and version, so a version gets read
+    directly from the memory map of its segment. If a version gets appended again, the latest record wins.
+    Closed segments get their index stored next to them, so only the active segment gets scanned on startup.
+
+    Deleting a history rotates the active segment and stores a tombstone: all records of the csv file
+    in older segments are deleted and get removed from them by compact().
+    """
+
+    def __init__(self, path, log, segment_size=64 * 1024 * 1024):
+        self.path = path
+        self.log = log
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        # {segment number: {csv_file: {version: offset}}}
+        self._index = {}
+        # {csv_file: first segment number, which was not deleted}
+        self._tombstones = {}
+        # {segment number: memory map of the segment}, mapped by the first read
+        self._maps = {}
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        tombstones_path = os.path.join(path, TOMBSTONES)
+        if os.path.exists(tombstones_path):
+            with open(tombstones_path, "rb") as tombstones_file:
+                self._tombstones = pickle.load(tombstones_file)
+
+        segments = self._segment_numbers()
+        for number in segments:
+            index_path = self._segment_path(number, INDEX_SUFFIX)
+            if os.path.exists(index_path) and number != segments[-1]:
+                with open(index_path, "rb") as index_file:
+                    self._index[number] = pickle.load(index_file)
+            else:
+                self._index[number] = self._scan(number)
+        self._active = segments[-1] if len(segments) > 0 else 1
+        self._index.setdefault(self._active, {})
+
+    def append(self, csv_file, version, created, missing_rows, new_rows):
+        """
+        Appends the change event of a version to the active segment.
+
+        :return: Number of the segment, which contains the record
+        """
+        name = csv_file.encode("utf-8")
+        payload = zlib.compress(pickle.dumps(([dict(row) for row in missing_rows], [dict(row) for row in new_rows]),
+                                             pickle.HIGHEST_PROTOCOL))
+        timestamp = calendar.timegm(created.utctimetuple()) * 1000000 + created.microsecond
+        record = RECORD_HEADER.pack(len(payload), len(name), version, timestamp) + name + payload
+
+        with self._lock:
+            segment_path = self._segment_path(self._active)
+            if os.path.exists(segment_path) and os.path.getsize(segment_path) + len(record) > self.segment_size:
+                self._rotate()
+                segment_path = self._segment_path(self._active)
+            with open(segment_path, "ab") as segment_file:
+                offset = segment_file.tell()
+                segment_file.write(record)
+            self._index[self._active].setdefault(csv_file, {})[version] = offset
+            return self._active
+
+    def read(self, number, csv_file, version):
+        """
+        Returns (missing_rows, new_rows) of a version from the given segment
+        or None, if the segment does not contain it or it got deleted.
+        """
+        with self._lock:
+            offset = self._index.get(number, {}).get(csv_file, {}).get(version, None)
+            if offset is None or self._is_deleted(number, csv_file):
+                return None
+            # Copied under the lock, so that compact() can not replace the segment between index and read
+            payload_length, name_length, version, created = RECORD_HEADER.unpack_from(
+                self._map(number, offset + RECORD_HEADER.size), offset)
+            start = offset + RECORD_HEADER.size + name_length
+            payload = self._map(number, start + payload_length)[start:start + payload_length]
+        return pickle.loads(zlib.decompress(payload))
+
+    def iter_versions(self, csv_file, after_version, until_version):
+        """
+        Yields (version, missing_rows, new_rows) of the versions after after_version up to until_version,
+        ordered by version.
+        """
+        records = {}
+        with self._lock:
+            for number in sorted(self._index.keys()):
+                if self._is_deleted(number, csv_file):
+                    continue
+                for version in self._index[number].get(csv_file, {}).keys():
+                    if after_version < version <= until_version:
+                        records[version] = number
+
+        for version in sorted(records.keys()):
+            rows = self.read(records[version], csv_file, version)
+            if rows is not None:
+                yield version, rows[0], rows[1]
+
+    def remove(self, csv_file):
+        """
+        Marks all stored versions of a csv file as deleted.
+        Versions, which get appended later, are not affected.
+        """
+        with self._lock:
+            if os.path.exists(self._segment_path(self._active)):
+                self._rotate()
+            self._tombstones[csv_file] = self._active
+            self._write_pickle(os.path.join(self.path, TOMBSTONES), self._tombstones)
+
+    def compact(self):
+        """
+        Rewrites closed segments, which contain deleted versions, without them.
+        Older records of versions, which got appended again, get dropped from them as well.
+        Segments without any remaining record get deleted.
+
+        :return: Number of removed records
+        """
+        with self._lock:
+            segments = dict((number, dict((csv_file, dict(versions)) for csv_file, versions in entries.items()))
+                            for number, entries in self._index.items()
+                            if number != self._active and
+                            any(self._is_deleted(number, csv_file) for csv_file in entries.keys()))
+
+        removed = 0
+        for number in sorted(segments.keys()):
+            entries = segments[number]
+            index = {}
+            temp_path = self._segment_path(number, ".tmp")
+            with open(temp_path, "wb") as temp_file:
+                for start, end, csv_file, version, data in self._records(number):
+                    if self._is_deleted(number, csv_file) or entries[csv_file][version] != start:
+                        removed += 1
+                        continue
+                    index.setdefault(csv_file, {})[version] = temp_file.tell()
+                    temp_file.write(data[start:end])
+
+            with self._lock:
+                self._unmap(number)
+                if len(index) == 0:
+                    os.remove(temp_path)
+                    os.remove(self._segment_path(number))
+                    if os.path.exists(self._segment_path(number, INDEX_SUFFIX)):
+                        os.remove(self._segment_path(number, INDEX_SUFFIX))
+                    del self._index[number]
+                else:
+                    os.replace(temp_path, self._segment_path(number))
+                    self._write_pickle(self._segment_path(number, INDEX_SUFFIX), index)
+                    self._index[number] = index
+        if removed > 0:
+            self.log.debug("Removed %s deleted versions from history segments" % removed)
+        return removed
+
+    def _map(self, number, size):
+        """
+        Returns the memory map of a segment, which contains at least size bytes. Must be called under the lock.
+        The active segment gets mapped again, if it grew since it got mapped.
+        """
+        data = self._maps.get(number, None)
+        if data is None or len(data) < size:
+            self._unmap(number)
+            with open(self._segment_path(number), "rb") as segment_file:
+                data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[number] = data
+        return data
+
+    def _unmap(self, number):
+        data = self._maps.pop(number, None)
+        if data is not None:
+            data.close()
+
+    def _is_deleted(self, number, csv_file):
+        return number < self._tombstones.get(csv_file, 0)
+
+    def _rotate(self):
+        self._write_pickle(self._segment_path(self._active, INDEX_SUFFIX), self._index[self._active])
+        self._active += 1
+        self._index[self._active] = {}
+
+    def _records(self, number, offset=0):
+        """
+        Yields (start, end, csv_file, version, data) of all records of a segment, starting at offset.
+        Used to scan and rewrite whole segments.
+        data is the memory mapped segment, which is only valid until the next record gets requested.
+        """
+        segment_path = self._segment_path(number)
+        if not os.path.exists(segment_path) or os.path.getsize(segment_path) == 0:
+            return
+        with open(segment_path, "rb") as segment_file:
+            data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                while offset + RECORD_HEADER.size <= len(data):
+                    payload_length, name_length, version, created = RECORD_HEADER.unpack_from(data, offset)
+                    name_start = offset + RECORD_HEADER.size
+                    end = name_start + name_length + payload_length
+                    if end > len(data):
+                        # Incomplete record of an interrupted write
+                        break
+                    yield offset, end, data[name_start:name_start + name_length].decode("utf-8"), version, data
+                    offset = end
+            finally:
+                data.close()
+
+    def _scan(self, number):
+        index = {}
+        for start, end, csv_file, version, data in self._records(number):
+            index.setdefault(csv_file, {})[version] = start
+        return index
+
+    def _segment_numbers(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, number, suffix=SEGMENT_SUFFIX):
+        return os.path.join(self.path, "%08d%s" % (number, suffix))
+
+    @staticmethod
+    def _write_pickle(path, value):
+        with open(path + ".tmp", "wb") as pickle_file:
+            pickle.dump(value, pickle_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import zlib
+
+from .models import get_models
+
+
+class HistoryShard:
+    """
+    A single history database together with its model classes.
+
+    Each csv file is archived into exactly one shard, so that watchers of different files
+    do not have to wait for the same sqlite write lock.
+    """
+
+    def __init__(self, index, db):
+        self.index = index
+        self.db = db
+        self.CsvFile, self.Version, self.MissingRow, self.NewRow, self.Snapshot, self.RowLineage, \
+            self.VersionSummary, self.CellChange, self.RowBlob = get_models(db)
+        self.db.classes.register(self.CsvFile)
+        self.db.classes.register(self.Version)
+        self.db.classes.register(self.MissingRow)
+        self.db.classes.register(self.NewRow)
+        self.db.classes.register(self.Snapshot)
+        self.db.classes.register(self.RowLineage)
+        self.db.classes.register(self.VersionSummary)
+        self.db.classes.register(self.CellChange)
+        self.db.classes.register(self.RowBlob)
+        self.db.create_all()
+        self.compactor = None
+        self.search = None
+
+    def __str__(self):
+        return str(self.db.name)
+
+
+def get_shard_connections(connection, shards):
+    """
+    Returns one connection string per shard.
+
+    The first shard uses the given connection, so that an existing history database stays in use.
+    File based sqlite databases of the other shards get the shard index as suffix,
+    e.g. ``history_db_1.db``.
+    """
+    connections = [connection]
+    for index in range(1, shards):
+        if connection in ("sqlite://", "sqlite:///:memory:"):
+            connections.append(connection)
+        else:
+            root, ext = os.path.splitext(connection)
+            connections.append("%s_%s%s" % (root, index, ext))
+    return connections
+
+
+def get_shard_index(csv_file, shards, shard_map=None):
+    """
+    Returns the index of the shard, which stores the history of the given csv file.
+
+    An explicit entry in shard_map wins. Otherwise a stable hash of the file name is used.
+    """
+    if shard_map and csv_file in shard_map.keys():
+        return shard_map[csv_file] % shards
+    return zlib.crc32(csv_file.encode("utf-8")) % shards
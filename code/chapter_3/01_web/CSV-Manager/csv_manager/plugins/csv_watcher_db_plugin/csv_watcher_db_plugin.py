@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import threading
 from click import Argument, Option
-from sqlalchemy import Column, Integer, String
-from flask import url_for
+from sqlalchemy import Column, Integer, String, func
+from flask import url_for, request, jsonify
 from flask_restless import url_for as rest_url_for
 
 from groundwork.patterns import GwCommandsPattern
 # from groundwork_database.patterns import GwSqlPattern #  No longer needed, as GwWebDbAdminPattern inherits from it.
 from groundwork_web.patterns import GwWebDbAdminPattern, GwWebDbRestPattern
 from csv_manager.patterns import CsvWatcherPattern
+from csv_manager.patterns.csv_watcher_pattern.csv_watcher_pattern import CsvWatcherExistsException
+from csv_manager.database import apply_sqlite_pragmas
 
 
 class CsvWatcherDbPlugin(GwCommandsPattern, CsvWatcherPattern, GwWebDbAdminPattern, GwWebDbRestPattern):
@@ -21,6 +25,15 @@ class CsvWatcherDbPlugin(GwCommandsPattern, CsvWatcherPattern, GwWebDbAdminPatte
         super().__init__(app, **kwargs)
         self.db = None
         self.Watcher = None
+        self.WatchersRevision = None
+        self._reconcile_lock = threading.Lock()
+        self._reconcile_stop = threading.Event()
+        # Revision of the watcher table, which was reconciled last
+        self._revision = None
+        # csv files, whose watchers could not be started by the last reconciliation
+        self._failed = set()
+        # csv files, which were already watched by other plugins at the last reconciliation
+        self._external = set()
 
     def activate(self):
 
@@ -49,7 +62,15 @@ class CsvWatcherDbPlugin(GwCommandsPattern, CsvWatcherPattern, GwWebDbAdminPatte
                                params=[path_argument])
 
         self.setup_db()
-        self.load_watchers()
+        # With lazy start, the first run of the reconciliation thread starts the watchers
+        if not self.app.config.get("CSV_WATCHER_LAZY_START", False):
+            self.load_watchers()
+
+        reconcile_thread = self.threads.register("csv_watcher_reconciliation", self._reconcile_thread,
+                                                 "Starts and stops watchers after changes of the watcher table")
+        # Must not keep cli commands alive
+        reconcile_thread.thread.daemon = True
+        reconcile_thread.run()
 
         self.web.db.register(self.Watcher, self.db.session)
 
@@ -65,10 +86,23 @@ class CsvWatcherDbPlugin(GwCommandsPattern, CsvWatcherPattern, GwWebDbAdminPatte
         with self.app.web.flask.app_context():
             menu_csv.register(name="REST CsvWatchers", link=rest_url_for(self.Watcher))
 
+        # Bulk operations next to the single object api of flask-restless
+        self.web.contexts.register(name="csv_watchers",
+                                   template_folder=os.path.join(os.path.dirname(__file__), "templates"),
+                                   static_folder=os.path.join(os.path.dirname(__file__), "static"),
+                                   url_prefix="/api/csvwatchers",
+                                   description="context for csv watcher bulk operations")
+
+        self.web.routes.register(url="/bulk",
+                                 methods=["POST", "PUT", "DELETE"],
+                                 endpoint=self._bulk_api,
+                                 context="csv_watchers")
+
     def setup_db(self):
         self.db = self.databases.register(self.app.config.get("WATCHER_DATABASE_NAME", "csv_watcher_db"),
                                           self.app.config.get("WATCHER_DATABASE_CONNECTION", "sqlite://"),
                                           self.app.config.get("WATCHER_DATABASE_DESCRIPTION", "Stores csv watchers"))
+        apply_sqlite_pragmas(self.db.engine, self.app.config.get("WATCHER_DATABASE_PRAGMAS", None))
         Base = self.db.Base
 
         class CsvWatchers(Base):
@@ -78,16 +112,229 @@ class CsvWatcherDbPlugin(GwCommandsPattern, CsvWatcherPattern, GwWebDbAdminPatte
             csv_file = Column(String(2048), nullable=False)
             interval = Column(Integer)
 
-        self.Watcher = self.db.classes.register(CsvWatchers)
+        class CsvWatchersRevision(Base):
+            """
+            Single row, whose revision gets incremented by triggers on each change of csv_watchers.
+            """
+            __tablename__ = 'csv_watchers_revision'
+
+            id = Column(Integer, primary_key=True)
+            revision = Column(Integer, nullable=False, default=0)
+
+        # Newer groundwork-database versions return a wrapper instead of the registered class
+        self.db.classes.register(CsvWatchers)
+        self.db.classes.register(CsvWatchersRevision)
+        self.Watcher = CsvWatchers
+        self.WatchersRevision = CsvWatchersRevision
         self.db.create_all()
+        self._create_revision_triggers()
 
-    def load_watchers(self):
-        current_watchers = self.Watcher.query.all()
-        for watcher in current_watchers:
+    def _create_revision_triggers(self):
+        """
+        Lets sqlite maintain the revision of the watcher table. This catches all changes,
+        no matter if they were made by the admin views, the rest api, commands or other processes.
+        """
+        if self.db.engine.dialect.name != "sqlite":
+            return
+        with self.db.engine.begin() as connection:
+            connection.execute("INSERT INTO csv_watchers_revision (id, revision) "
+                               "SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM csv_watchers_revision)")
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                connection.execute("CREATE TRIGGER IF NOT EXISTS csv_watchers_%s AFTER %s ON csv_watchers "
+                                   "BEGIN UPDATE csv_watchers_revision SET revision = revision + 1; END"
+                                   % (event.lower(), event))
+
+    def get_watchers_revision(self):
+        """
+        Returns a value, which changes with each change of the watcher table.
+
+        Other databases than sqlite have no triggers for the revision. For them, count, highest id and
+        sum of intervals are used, which misses changes, which keep all three values.
+        """
+        if self.db.engine.dialect.name == "sqlite":
+            return self.db.query(self.WatchersRevision.revision).scalar()
+        return tuple(self.db.query(func.count(self.Watcher.id), func.max(self.Watcher.id),
+                                   func.sum(self.Watcher.interval)).first())
+
+    def _reconcile_thread(self, plugin):
+        interval = self.app.config.get("WATCHER_RECONCILE_INTERVAL", 5)
+        wait = 0 if self._revision is None else interval
+        while not self._reconcile_stop.wait(wait):
+            wait = interval
             try:
-                self.activate_watcher(watcher.csv_file, watcher.interval)
-            except Exception:
-                self.log.error("Couldn't activate watcher for %s" % watcher.csv_file)
+                revision = self.get_watchers_revision()
+                self.db.session.remove()
+                # Watchers of not yet existing files get retried. Files watched by other plugins get
+                # taken over, if these plugins stop watching them.
+                if revision != self._revision or len(self._failed) > 0 or len(self._external) > 0:
+                    self.reconcile_watchers()
+            except Exception as e:
+                self.log.error("Reconciliation of csv watchers failed: %s" % e)
+
+    def load_watchers(self):
+        self.reconcile_watchers()
+
+    def reconcile_watchers(self):
+        """
+        Compares the watcher table with the running watchers of this plugin.
+        Starts watchers for new rows, stops watchers without a row and applies changed intervals.
+        Rows of csv files, which are already watched by another plugin, count as reconciled.
+
+        :return: Dictionary with the lists of started, stopped, updated and failed csv files
+        """
+        with self._reconcile_lock:
+            # Read before the table, so that changes in between get reconciled by the next run
+            revision = self.get_watchers_revision()
+            desired = dict((csv_file, interval if interval is not None else 10) for csv_file, interval in
+                           self.db.query(self.Watcher.csv_file, self.Watcher.interval))
+            self.db.session.remove()
+            running = dict(self.csv_watcher.get() or {})
+            result = {"started": [], "stopped": [], "updated": [], "failed": []}
+            external = set()
+
+            for csv_file in running.keys():
+                if csv_file not in desired.keys():
+                    self.csv_watcher.unregister(csv_file)
+                    result["stopped"].append(csv_file)
+
+            for csv_file, interval in desired.items():
+                watcher = running.get(csv_file, None)
+                if watcher is None and self.app.csv_watcher.get(csv_file) is not None:
+                    # Already watched by another plugin, e.g. because of CSV_FILES
+                    if csv_file not in self._external:
+                        self.log.info("%s is already watched by %s" %
+                                      (csv_file, self.app.csv_watcher.get(csv_file).plugin.name))
+                    external.add(csv_file)
+                elif watcher is None:
+                    try:
+                        self.activate_watcher(csv_file, interval)
+                    except (Exception, CsvWatcherExistsException) as e:
+                        if csv_file not in self._failed:
+                            self.log.error("Couldn't activate watcher for %s: %s" % (csv_file, e))
+                        result["failed"].append(csv_file)
+                    else:
+                        result["started"].append(csv_file)
+                elif watcher.interval != interval:
+                    watcher.interval = interval
+                    result["updated"].append(csv_file)
+
+            self._revision = revision
+            self._failed = set(result["failed"])
+            self._external = external
+            self.log.debug("Watchers reconciled: %s started, %s stopped, %s updated, %s failed" %
+                           tuple(len(result[key]) for key in ("started", "stopped", "updated", "failed")))
+            return result
+
+    def create_watchers(self, watchers):
+        """
+        Stores several watchers in one transaction. Nothing gets stored, if one of them already exists.
+        The watchers get started by reconcile_watchers().
+
+        :param watchers: List of dictionaries with csv_file and optional interval
+        :return: Number of created watchers
+        """
+        watchers = self._parse_watchers(watchers)
+        existing = self._get_watcher_ids([watcher["csv_file"] for watcher in watchers])
+        if len(existing) > 0:
+            raise ValueError("csv files already exist in database: %s" % ", ".join(sorted(existing.keys())[:10]))
+        try:
+            self.db.session.bulk_insert_mappings(self.Watcher, watchers)
+            self.db.commit()
+        finally:
+            self.db.session.remove()
+        return len(watchers)
+
+    def update_watchers(self, watchers):
+        """
+        Changes the interval of several watchers in one transaction. Nothing gets changed, if one of them is unknown.
+
+        :param watchers: List of dictionaries with csv_file and interval
+        :return: Number of updated watchers
+        """
+        watchers = self._parse_watchers(watchers, default_interval=None)
+        existing = self._get_watcher_ids([watcher["csv_file"] for watcher in watchers])
+        unknown = [watcher["csv_file"] for watcher in watchers if watcher["csv_file"] not in existing.keys()]
+        if len(unknown) > 0:
+            raise ValueError("csv files do not exist in database: %s" % ", ".join(sorted(unknown)[:10]))
+        try:
+            self.db.session.bulk_update_mappings(self.Watcher,
+                                                 [{"id": existing[watcher["csv_file"]], "interval": watcher["interval"]}
+                                                  for watcher in watchers])
+            self.db.commit()
+        finally:
+            self.db.session.remove()
+        return len(watchers)
+
+    def delete_watchers(self, csv_files):
+        """
+        Deletes the watchers of several csv files in one transaction. Unknown csv files are ignored.
+
+        :return: Number of deleted watchers
+        """
+        if not isinstance(csv_files, list) or not all(isinstance(csv_file, str) for csv_file in csv_files):
+            raise ValueError("csv_files must be a list of file names")
+        deleted = 0
+        try:
+            for start in range(0, len(csv_files), 500):
+                deleted += self.Watcher.query.filter(self.Watcher.csv_file.in_(csv_files[start:start + 500])) \
+                    .delete(synchronize_session=False)
+            self.db.commit()
+        finally:
+            self.db.session.remove()
+        return deleted
+
+    def _get_watcher_ids(self, csv_files):
+        ids = {}
+        for start in range(0, len(csv_files), 500):
+            ids.update(self.db.query(self.Watcher.csv_file, self.Watcher.id)
+                       .filter(self.Watcher.csv_file.in_(csv_files[start:start + 500])))
+        return ids
+
+    @staticmethod
+    def _parse_watchers(watchers, default_interval=10):
+        """
+        :param default_interval: Interval of watchers without one. If None, each watcher needs an interval.
+        """
+        if not isinstance(watchers, list):
+            raise ValueError("watchers must be a list")
+        parsed = []
+        csv_files = set()
+        for watcher in watchers:
+            if not isinstance(watcher, dict) or not isinstance(watcher.get("csv_file", None), str) or \
+                    not watcher["csv_file"]:
+                raise ValueError("Each watcher needs a csv_file: %s" % (watcher,))
+            interval = watcher.get("interval", default_interval)
+            if interval is None:
+                raise ValueError("Each watcher needs an interval: %s" % (watcher,))
+            if not isinstance(interval, int) or interval < 1:
+                raise ValueError("Interval of %s must be a positive number" % watcher["csv_file"])
+            if watcher["csv_file"] in csv_files:
+                raise ValueError("csv file %s is given twice" % watcher["csv_file"])
+            csv_files.add(watcher["csv_file"])
+            parsed.append({"csv_file": watcher["csv_file"], "interval": interval})
+        return parsed
+
+    def _bulk_api(self):
+        """
+        Creates (POST), updates (PUT) or deletes (DELETE) several watchers at once and reconciles the running
+        watchers afterwards.
+
+        POST and PUT expect ``{"watchers": [{"csv_file": "...", "interval": 10}, ...]}``,
+        DELETE expects ``{"csv_files": ["...", ...]}``.
+        """
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify(error="JSON object expected"), 400
+        try:
+            if request.method == "POST":
+                count = self.create_watchers(data.get("watchers", []))
+            elif request.method == "PUT":
+                count = self.update_watchers(data.get("watchers", []))
+            else:
+                count = self.delete_watchers(data.get("csv_files", []))
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        return jsonify(count=count, **self.reconcile_watchers())
 
     def csv_watcher_list(self):
         watchers = self.Watcher.query.all()
@@ -131,4 +378,4 @@ class CsvWatcherDbPlugin(GwCommandsPattern, CsvWatcherPattern, GwWebDbAdminPatte
             self.log.info(("Watcher started for %s" % csv_file))
 
     def deactivate(self):
-        pass
+        self._reconcile_stop.set()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import threading
+
 from click import Argument, Option
 from groundwork.patterns import GwCommandsPattern
 from csv_manager.patterns import CsvWatcherPattern
+from csv_manager.patterns.csv_watcher_pattern.csv_watcher_pattern import CsvWatcherExistsException
 
 
 class CsvWatcherPlugin(GwCommandsPattern, CsvWatcherPattern):
@@ -16,6 +19,7 @@ class CsvWatcherPlugin(GwCommandsPattern, CsvWatcherPattern):
         self.csv_file = None
         self.csv_interval = None
         self.watcher_thread = None
+        self._startup_stop = threading.Event()
 
     def activate(self):
 
@@ -39,11 +43,27 @@ class CsvWatcherPlugin(GwCommandsPattern, CsvWatcherPattern):
                              function=self.csv_change_monitor,
                              description="Gets called for each csv change")
 
+        self._startup_stop.clear()
+        if self.app.config.get("CSV_WATCHER_LAZY_START", False):
+            # Watchers get started in background, after the activation has finished
+            startup_thread = self.threads.register("csv_watcher_startup", self._start_watchers,
+                                                   "Starts the watchers of CSV_FILES")
+            startup_thread.run()
+        else:
+            self._start_watchers(self)
+
+    def _start_watchers(self, plugin):
         csv_files_by_config = self.app.config.get("CSV_FILES", [])
         csv_interval_by_config = self.app.config.get("CSV_INTERVAL", 5)
 
         for csv_file in csv_files_by_config:
-            self.csv_watcher_command(csv_file, csv_interval_by_config)
+            if self._startup_stop.is_set():
+                break
+            try:
+                self.csv_watcher_command(csv_file, csv_interval_by_config)
+            except (Exception, CsvWatcherExistsException) as e:
+                self.log.error("Couldn't activate watcher for %s: %s" % (csv_file, e))
+        self.log.info("%s csv watchers started" % len(self.csv_watcher.get() or {}))
 
     def csv_watcher_command(self, csv_file, interval=10):
         # Register thread
@@ -64,4 +84,4 @@ class CsvWatcherPlugin(GwCommandsPattern, CsvWatcherPattern):
             self.log.info("%s is missing row: %s" % (csv_file, row))
 
     def deactivate(self):
-        pass
+        self._startup_stop.set()
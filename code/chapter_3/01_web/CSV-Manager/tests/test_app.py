@@ -13,3 +13,219 @@ def test_csv_manager_plugin_activation():
     plugin = app.plugins.get("csv_manager_plugin")
     assert plugin is not None
     assert isinstance(plugin, csv_manager_plugin)
+
+
+def test_parse_watchers():
+    import pytest
+    from csv_manager.plugins.csv_watcher_db_plugin.csv_watcher_db_plugin import CsvWatcherDbPlugin
+
+    assert CsvWatcherDbPlugin._parse_watchers([{"csv_file": "a.csv"}, {"csv_file": "b.csv", "interval": 5}]) == \
+        [{"csv_file": "a.csv", "interval": 10}, {"csv_file": "b.csv", "interval": 5}]
+    for watchers in ({"csv_file": "a.csv"}, [{"interval": 5}], [{"csv_file": "a.csv", "interval": 0}],
+                     [{"csv_file": "a.csv"}, {"csv_file": "a.csv"}]):
+        with pytest.raises(ValueError):
+            CsvWatcherDbPlugin._parse_watchers(watchers)
+    with pytest.raises(ValueError):
+        CsvWatcherDbPlugin._parse_watchers([{"csv_file": "a.csv"}], default_interval=None)
+
+
+def test_csv_watcher_unregister(tmpdir):
+    from csv_manager.applications import CSV_MANAGER_APP
+    from csv_manager.plugins.csv_watcher_plugin.csv_watcher_plugin import CsvWatcherPlugin
+
+    csv_file = str(tmpdir.join("watched.csv"))
+    with open(csv_file, "w") as csv_file_object:
+        csv_file_object.write("a,b\n1,2\n")
+
+    app = CSV_MANAGER_APP().app
+    app.config.set("CSV_FILES", [csv_file], overwrite=True)
+    app.config.set("CSV_INTERVAL", 60, overwrite=True)
+    app.plugins.classes.register([CsvWatcherPlugin])
+    app.plugins.activate(["CsvWatcherPlugin"])
+    plugin = app.plugins.get("CsvWatcherPlugin")
+    assert isinstance(plugin, CsvWatcherPlugin)
+    watcher = plugin.csv_watcher.get(csv_file)
+
+    assert plugin.csv_watcher.unregister(csv_file, timeout=5) is watcher
+    assert not watcher.csv_thread.thread.is_alive()
+    assert watcher.snapshot is None
+    assert plugin.threads.get("csv_thread_%s" % csv_file) is None
+    assert plugin.csv_watcher.unregister(csv_file) is None
+
+    # Can be registered again and gets stopped by the deactivation of the plugin
+    plugin.csv_watcher_command(csv_file, 60)
+    watcher = plugin.csv_watcher.get(csv_file)
+    app.plugins.deactivate(["CsvWatcherPlugin"])
+    assert not watcher.csv_thread.thread.is_alive()
+    assert plugin.csv_watcher.get(csv_file) is None
+
+
+def test_csv_watcher_lazy_start(tmpdir):
+    import time
+    from csv_manager.applications import CSV_MANAGER_APP
+    from csv_manager.plugins.csv_watcher_plugin.csv_watcher_plugin import CsvWatcherPlugin
+
+    csv_files = []
+    for index in range(3):
+        csv_file = str(tmpdir.join("watched_%s.csv" % index))
+        with open(csv_file, "w") as csv_file_object:
+            csv_file_object.write("a,b\n1,2\n")
+        csv_files.append(csv_file)
+
+    app = CSV_MANAGER_APP().app
+    app.config.set("CSV_FILES", csv_files, overwrite=True)
+    app.config.set("CSV_WATCHER_LAZY_START", True, overwrite=True)
+    app.config.set("CSV_WATCHER_STARTUP_JITTER", 0.1, overwrite=True)
+    app.plugins.classes.register([CsvWatcherPlugin])
+    app.plugins.activate(["CsvWatcherPlugin"])
+    plugin = app.plugins.get("CsvWatcherPlugin")
+
+    for attempt in range(50):
+        if plugin.csv_watcher.get_progress() == {"total": 3, "ready": 3}:
+            break
+        time.sleep(0.1)
+    assert plugin.csv_watcher.get_progress() == {"total": 3, "ready": 3}
+    assert plugin.csv_watcher.get(csv_files[0]).snapshot == [{"a": "1", "b": "2"}]
+
+    app.plugins.deactivate(["CsvWatcherPlugin"])
+    assert plugin.csv_watcher.get_progress() == {"total": 0, "ready": 0}
+
+
+def test_reconcile_watchers(tmpdir):
+    from csv_manager.applications import CSV_MANAGER_APP
+
+    csv_files = []
+    for index in range(3):
+        csv_files.append(str(tmpdir.join("watched_%s.csv" % index)))
+        if index < 2:
+            with open(csv_files[-1], "w") as csv_file_object:
+                csv_file_object.write("a,b\n1,2\n")
+
+    app = CSV_MANAGER_APP().app
+    app.config.set("WATCHER_DATABASE_CONNECTION", "sqlite:///%s" % tmpdir.join("watcher_db.db"), overwrite=True)
+    app.config.set("WATCHER_RECONCILE_INTERVAL", 3600, overwrite=True)
+    app.plugins.activate(["GwWeb", "GwWebDbAdmin", "GwWebDbRest", "CsvWatcherDbPlugin"])
+    plugin = app.plugins.get("CsvWatcherDbPlugin")
+
+    revision = plugin.get_watchers_revision()
+    plugin.create_watchers([{"csv_file": csv_files[0], "interval": 60}, {"csv_file": csv_files[1]}])
+    assert plugin.get_watchers_revision() != revision
+    result = plugin.reconcile_watchers()
+    assert sorted(result["started"]) == csv_files[:2]
+    assert plugin.reconcile_watchers() == {"started": [], "stopped": [], "updated": [], "failed": []}
+
+    plugin.update_watchers([{"csv_file": csv_files[0], "interval": 30}])
+    watcher = plugin.csv_watcher.get(csv_files[1])
+    plugin.delete_watchers([csv_files[1]])
+    plugin.create_watchers([{"csv_file": csv_files[2]}])
+    result = plugin.reconcile_watchers()
+    assert result["updated"] == [csv_files[0]]
+    assert result["stopped"] == [csv_files[1]]
+    assert result["failed"] == [csv_files[2]]
+    assert plugin.csv_watcher.get(csv_files[0]).interval == 30
+    assert plugin.csv_watcher.get(csv_files[1]) is None
+    assert not watcher.csv_thread.thread.is_alive()
+
+    # Watchers of missing files get started, as soon as the file exists
+    with open(csv_files[2], "w") as csv_file_object:
+        csv_file_object.write("a,b\n1,2\n")
+    assert plugin.reconcile_watchers()["started"] == [csv_files[2]]
+
+    watcher = plugin.csv_watcher.get(csv_files[0])
+    reconciliation = plugin.threads.get("csv_watcher_reconciliation").thread
+    app.plugins.deactivate(["CsvWatcherDbPlugin"])
+    assert not watcher.csv_thread.thread.is_alive()
+    reconciliation.join(5)
+    assert not reconciliation.is_alive()
+
+
+def test_watchers_bulk_api(tmpdir):
+    from csv_manager.applications import CSV_MANAGER_APP
+    from csv_manager.plugins.csv_watcher_plugin.csv_watcher_plugin import CsvWatcherPlugin
+
+    csv_files = []
+    for index in range(3):
+        csv_files.append(str(tmpdir.join("watched_%s.csv" % index)))
+        with open(csv_files[-1], "w") as csv_file_object:
+            csv_file_object.write("a,b\n1,2\n")
+
+    app = CSV_MANAGER_APP().app
+    app.config.set("WATCHER_DATABASE_CONNECTION", "sqlite:///%s" % tmpdir.join("watcher_db.db"), overwrite=True)
+    app.config.set("WATCHER_RECONCILE_INTERVAL", 3600, overwrite=True)
+    # The third file is watched because of the configuration already
+    app.config.set("CSV_FILES", csv_files[2:], overwrite=True)
+    app.config.set("CSV_INTERVAL", 60, overwrite=True)
+    app.plugins.classes.register([CsvWatcherPlugin])
+    app.plugins.activate(["GwWeb", "GwWebDbAdmin", "GwWebDbRest", "CsvWatcherPlugin", "CsvWatcherDbPlugin"])
+    plugin = app.plugins.get("CsvWatcherDbPlugin")
+    client = app.web.flask.test_client()
+    url = "/api/csvwatchers/bulk"
+
+    response = client.post(url, json={"watchers": [{"csv_file": csv_file, "interval": 60} for csv_file in csv_files]})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result["count"] == 3
+    assert sorted(result["started"]) == csv_files[:2]
+    assert result["failed"] == []
+    assert plugin.reconcile_watchers()["failed"] == []
+
+    # Nothing gets stored, if one watcher is invalid
+    for method, data in ((client.post, {"watchers": [{"csv_file": csv_files[0]}]}),
+                         (client.post, {"watchers": {"csv_file": "new.csv"}}),
+                         (client.put, {"watchers": [{"csv_file": csv_files[0]}]}),
+                         (client.put, {"watchers": [{"csv_file": "unknown.csv", "interval": 30}]}),
+                         (client.delete, {"csv_files": "new.csv"})):
+        response = method(url, json=data)
+        assert response.status_code == 400
+        assert "error" in response.get_json()
+    assert client.put(url, data="watchers", content_type="application/json").status_code == 400
+
+    response = client.put(url, json={"watchers": [{"csv_file": csv_files[0], "interval": 30}]})
+    assert response.get_json()["count"] == 1
+    assert response.get_json()["updated"] == [csv_files[0]]
+    assert plugin.csv_watcher.get(csv_files[0]).interval == 30
+    assert plugin.csv_watcher.get(csv_files[1]).interval == 60
+
+    response = client.delete(url, json={"csv_files": csv_files[:2] + ["unknown.csv"]})
+    assert response.get_json()["count"] == 2
+    assert sorted(response.get_json()["stopped"]) == csv_files[:2]
+    assert plugin.csv_watcher.get() in (None, {})
+    assert app.csv_watcher.get(csv_files[2]) is not None
+    app.plugins.deactivate(["CsvWatcherDbPlugin", "CsvWatcherPlugin"])
+
+
+def test_csv_watcher_stop_while_waiting_for_startup(tmpdir):
+    import time
+    from csv_manager.applications import CSV_MANAGER_APP
+    from csv_manager.plugins.csv_watcher_plugin.csv_watcher_plugin import CsvWatcherPlugin
+
+    csv_file = str(tmpdir.join("watched.csv"))
+    with open(csv_file, "w") as csv_file_object:
+        csv_file_object.write("a,b\n1,2\n")
+
+    app = CSV_MANAGER_APP().app
+    app.config.set("CSV_FILES", [], overwrite=True)
+    app.config.set("CSV_WATCHER_STARTUP_JITTER", 0, overwrite=True)
+    app.plugins.classes.register([CsvWatcherPlugin])
+    app.plugins.activate(["CsvWatcherPlugin"])
+    plugin = app.plugins.get("CsvWatcherPlugin")
+
+    # All startup slots are taken, so the watcher waits for its first check
+    startup = plugin.app.csv_watcher.startup
+    slots = 0
+    while startup.acquire(blocking=False):
+        slots += 1
+    try:
+        plugin.csv_watcher_command(csv_file, 60)
+        watcher = plugin.csv_watcher.get(csv_file)
+        time.sleep(0.1)
+        assert watcher.csv_thread.thread.is_alive() and not watcher.ready
+
+        start = time.time()
+        assert plugin.csv_watcher.unregister(csv_file, timeout=5) is watcher
+        assert not watcher.csv_thread.thread.is_alive()
+        assert time.time() - start < 2
+    finally:
+        for slot in range(slots):
+            startup.release()
+    app.plugins.deactivate(["CsvWatcherPlugin"])
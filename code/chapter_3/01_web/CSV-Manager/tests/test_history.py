@@ -0,0 +1,875 @@
+from csv_manager.plugins.csv_document_plugin.history import apply_delta, compress_rows, decompress_rows, \
+    squash_deltas, get_keyed_changes, diff_rows
+
+
+def test_apply_delta():
+    rows = [{"name": "Richard"}, {"name": "Annabel"}, {"name": "Richard"}]
+    rows = apply_delta(rows, [{"name": "Richard"}], [{"name": "Dieter"}])
+    assert rows == [{"name": "Annabel"}, {"name": "Richard"}, {"name": "Dieter"}]
+
+
+def test_compress_rows():
+    rows = [{"name": "Richard", "city": "Paris"}]
+    assert decompress_rows(compress_rows(rows)) == rows
+
+
+def test_squash_deltas():
+    deltas = [([], [{"name": "Richard"}, {"name": "Annabel"}]),
+              ([{"name": "Richard"}], [{"name": "Dieter"}]),
+              ([{"name": "Paul"}], [])]
+    missing_rows, new_rows = squash_deltas(deltas)
+    assert missing_rows == [{"name": "Paul"}]
+    assert new_rows == [{"name": "Annabel"}, {"name": "Dieter"}]
+
+
+def test_shard_routing():
+    from csv_manager.plugins.csv_document_plugin.shards import get_shard_connections, get_shard_index
+
+    assert get_shard_connections("sqlite:////tmp/history_db.db", 3) == ["sqlite:////tmp/history_db.db",
+                                                                        "sqlite:////tmp/history_db_1.db",
+                                                                        "sqlite:////tmp/history_db_2.db"]
+    assert get_shard_index("test.csv", 4) == get_shard_index("test.csv", 4)
+    assert get_shard_index("test.csv", 4, {"test.csv": 2}) == 2
+
+
+def test_get_keyed_changes():
+    missing_rows = [{"name": "Richard", "city": "Paris"}, {"name": "Dieter", "city": "Mannheim"}]
+    new_rows = [{"name": "Richard", "city": "London"}, {"name": "Annabel", "city": "London"}]
+    assert get_keyed_changes(missing_rows, new_rows, ["name"]) == [("Richard", "modified"),
+                                                                   ("Dieter", "removed"),
+                                                                   ("Annabel", "added")]
+
+
+def test_changes_cursor():
+    from _datetime import datetime
+    from csv_manager.plugins.csv_document_plugin.history import parse_timestamp, encode_cursor, decode_cursor
+
+    assert parse_timestamp("2017-05-01") == datetime(2017, 5, 1)
+    assert parse_timestamp("2017-05-01T12:30:00") == datetime(2017, 5, 1, 12, 30)
+    created = datetime(2017, 5, 1, 12, 30, 0, 42)
+    assert decode_cursor(encode_cursor(created, "test.csv", 3)) == (created, "test.csv", 3)
+
+
+def test_segment_storage(tmpdir):
+    import logging
+    from _datetime import datetime
+    from csv_manager.plugins.csv_document_plugin.segments import SegmentStorage
+
+    log = logging.getLogger(__name__)
+    storage = SegmentStorage(str(tmpdir), log, segment_size=200)
+    for version in range(1, 6):
+        storage.append("a.csv", version, datetime.utcnow(), [], [{"name": "Richard %s" % version}])
+        storage.append("b.csv", version, datetime.utcnow(), [{"name": "Paul"}], [])
+
+    assert [version for version, missing, new in storage.iter_versions("a.csv", 1, 4)] == [2, 3, 4]
+    storage = SegmentStorage(str(tmpdir), log, segment_size=200)
+    assert list(storage.iter_versions("a.csv", 4, 5)) == [(5, [], [{"name": "Richard 5"}])]
+    number = storage.append("b.csv", 5, datetime.utcnow(), [], [])
+    assert storage.read(number, "b.csv", 5) == ([], [])
+    assert storage.read(number, "b.csv", 4) is None
+
+    storage.remove("b.csv")
+    storage.append("b.csv", 1, datetime.utcnow(), [], [{"name": "Paul"}])
+    assert storage.compact() > 0
+    assert list(storage.iter_versions("b.csv", 0, 5)) == [(1, [], [{"name": "Paul"}])]
+    assert len(list(storage.iter_versions("a.csv", 0, 5))) == 5
+
+
+def test_cell_changes():
+    from csv_manager.plugins.csv_document_plugin.history import split_cell_changes, expand_cell_changes
+
+    rows = [{"name": "Richard", "city": "Paris", "age": "30"}, {"name": "Annabel", "city": "Rome", "age": "25"}]
+    missing_rows = [rows[0], rows[1]]
+    new_rows = [{"name": "Richard", "city": "Berlin", "age": "30"}, {"name": "Dieter", "city": "Rome", "age": "25"}]
+    missing, new, cells = split_cell_changes(missing_rows, new_rows, ["name"])
+    assert missing == [rows[1]]
+    assert new == [new_rows[1]]
+    assert cells == [("Richard", "city", "Paris", "Berlin")]
+    assert expand_cell_changes(rows, cells, ["name"]) == ([rows[0]], [new_rows[0]])
+
+    # Duplicate key: the change belongs to the row with the old value
+    rows = [{"name": "Richard", "city": "Paris"}, {"name": "Richard", "city": "Rome"}]
+    missing, new, cells = split_cell_changes([rows[1]], [{"name": "Richard", "city": "Berlin"}], ["name"])
+    assert cells == [("Richard", "city", "Rome", "Berlin")]
+    assert expand_cell_changes(rows, cells, ["name"]) == ([rows[1]], [{"name": "Richard", "city": "Berlin"}])
+
+
+def test_compress_columnar():
+    from csv_manager.plugins.csv_document_plugin.history import compress_columnar, iter_columnar
+
+    rows = [{"name": "Richard", "city": "Paris"}, {"name": "Annabel"}, {"name": "Dieter", "city": "Rome"}]
+    assert list(iter_columnar(compress_columnar(rows))) == rows
+    assert list(iter_columnar(compress_columnar([]))) == []
+
+
+def test_change_broadcaster():
+    from csv_manager.plugins.csv_document_plugin.broadcast import ChangeBroadcaster
+
+    broadcaster = ChangeBroadcaster(buffer_size=1)
+    all_files = broadcaster.subscribe()
+    single_file = broadcaster.subscribe("a.csv")
+    broadcaster.publish({"csv_file": "b.csv"})
+    assert all_files.get(0) == {"csv_file": "b.csv"}
+    assert single_file.get(0) is None
+
+    broadcaster.publish({"csv_file": "a.csv"})
+    broadcaster.publish({"csv_file": "a.csv"})
+    assert all_files.dropped and single_file.dropped
+    assert len(broadcaster) == 0
+
+
+def test_fragment_cache(tmpdir):
+    from csv_manager.plugins.csv_document_plugin.fragments import FragmentCache
+
+    cache = FragmentCache(max_entries=2, path=str(tmpdir))
+    for version in range(1, 4):
+        assert cache.get_or_render("a.csv", version, "html", lambda: "version %s" % version) == "version %s" % version
+    assert len(cache) == 2
+    # Evicted from memory, but still stored on disk
+    assert cache.get_or_render("a.csv", 1, "html", lambda: "rendered again") == "version 1"
+
+    generation = cache.generation("a.csv")
+    cache.invalidate("a.csv", until_version=2)
+    assert cache.get("a.csv", 1, "html") is None
+    assert cache.get("a.csv", 3, "html") == "version 3"
+    # Rendered before the invalidation
+    cache.set("a.csv", 1, "html", "outdated", generation)
+    assert cache.get("a.csv", 1, "html") is None
+
+    cache.invalidate("a.csv")
+    assert cache.get("a.csv", 3, "html") is None
+
+
+def test_read_model():
+    from csv_manager.plugins.csv_document_plugin.read_model import HistoryReadModel, FileInfo, VersionInfo
+
+    read_model = HistoryReadModel(max_bytes=100000, max_versions=2)
+    read_model.set_files({}, read_model.generation())
+    generation = read_model.generation("a.csv")
+    read_model.set_versions("a.csv", [], True, generation)
+
+    for version in range(1, 4):
+        read_model.add_version(FileInfo(1, "a.csv", version, None), VersionInfo(version, version, None, None),
+                               [], [{"name": "Richard"}])
+    assert read_model.get_files()["a.csv"].current_version == 3
+    versions = read_model.get_versions("a.csv")
+    assert [version_info.version for version_info in versions["versions"]] == [3, 2]
+    assert not versions["complete"]
+    assert read_model.get_diff("a.csv", 1) == ([], [{"name": "Richard"}])
+
+    # Loaded before the last change
+    read_model.set_versions("a.csv", [], True, generation)
+    assert len(read_model.get_versions("a.csv")["versions"]) == 2
+
+    read_model.invalidate("a.csv", until_version=2)
+    assert read_model.get_versions("a.csv") is None
+    assert read_model.get_diff("a.csv", 2) is None
+    assert read_model.get_diff("a.csv", 3) is not None
+
+    read_model.max_bytes = read_model.size - 1
+    read_model.add_version(FileInfo(1, "a.csv", 4, None), VersionInfo(4, 4, None, None), [], [])
+    assert read_model.size <= read_model.max_bytes
+
+
+def _get_history_plugin(tmpdir, plugins=("GwWeb", "CsvDocumentPlugin"), **config):
+    """
+    Returns an activated CsvDocumentPlugin, which archives into a history database inside tmpdir.
+    """
+    from csv_manager.applications import CSV_MANAGER_APP
+
+    app = CSV_MANAGER_APP().app
+    app.config.set("HISTORY_DATABASE_CONNECTION", "sqlite:///%s" % tmpdir.join("history_db.db"), overwrite=True)
+    app.config.set("HISTORY_RETENTION", None, overwrite=True)
+    for name, value in config.items():
+        app.config.set(name, value, overwrite=True)
+    app.plugins.activate(list(plugins))
+    return app.plugins.get("CsvDocumentPlugin")
+
+
+def _archive_versions(plugin, csv_file, count):
+    """
+    Archives count versions, each replaces the oldest row by two new ones.
+
+    :return: List of the expected content after each version, starting with the empty file
+    """
+    rows = []
+    contents = [[]]
+    for version in range(1, count + 1):
+        new_rows = [{"name": "Richard %s" % version, "city": city} for city in ("Paris", "Rome")]
+        missing_rows = rows[:1]
+        plugin._archive_csv_change(plugin, csv_file=csv_file, new_rows=new_rows, missing_rows=missing_rows)
+        rows = rows[1:] + new_rows
+        contents.append(list(rows))
+    return contents
+
+
+def test_diff_rows():
+    old_rows = [{"name": "Richard"}, {"name": "Annabel"}, {"name": "Richard"}]
+    new_rows = [{"name": "Annabel"}, {"name": "Richard"}, {"name": "Dieter"}]
+    assert diff_rows(old_rows, new_rows) == ([{"name": "Richard"}], [{"name": "Dieter"}])
+    assert diff_rows(old_rows, old_rows) == ([], [])
+
+
+def test_history_db_pragmas(tmpdir):
+    plugin = _get_history_plugin(tmpdir)
+    engine = plugin.get_shard("a.csv").db.engine
+    # Each pooled connection gets the pragmas, not only the first one
+    connections = [engine.connect() for _ in range(2)]
+    try:
+        for connection in connections:
+            assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert connection.execute("PRAGMA synchronous").scalar() == 1
+            assert connection.execute("PRAGMA busy_timeout").scalar() == 5000
+    finally:
+        for connection in connections:
+            connection.close()
+
+    plugin = _get_history_plugin(tmpdir.mkdir("defaults"), HISTORY_DATABASE_PRAGMAS=None)
+    assert plugin.get_shard("a.csv").db.engine.execute("PRAGMA journal_mode").scalar() == "delete"
+
+
+def test_csv_at_version_with_checkpoints(tmpdir):
+    plugin = _get_history_plugin(tmpdir, HISTORY_CHECKPOINT_VERSIONS=3, HISTORY_CHECKPOINT_ROWS=0)
+    contents = _archive_versions(plugin, "a.csv", 8)
+
+    shard = plugin.get_shard("a.csv")
+    assert [version for version, in shard.db.query(shard.Snapshot.version).order_by(shard.Snapshot.version)] == \
+        [3, 6]
+    for version, rows in enumerate(contents):
+        assert plugin.get_csv_at_version("a.csv", version) == rows
+    assert plugin.get_csv_at_version("a.csv", 9) is None
+    assert plugin.get_csv_at_version("unknown.csv", 1) is None
+
+
+def test_history_compaction(tmpdir):
+    from _datetime import datetime, timedelta
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_RETENTION={"keep_versions": 3, "keep_days": 1, "squash": "daily"},
+                                 HISTORY_CHECKPOINT_VERSIONS=4, HISTORY_CHECKPOINT_ROWS=0,
+                                 HISTORY_COMPACTION_BATCH_SIZE=2)
+    contents = _archive_versions(plugin, "a.csv", 10)
+
+    # Versions 1 to 5 and 6 to 7 were archived on the same day
+    shard = plugin.get_shard("a.csv")
+    ten_days_ago = datetime.utcnow() - timedelta(days=10)
+    for version_object in shard.Version.query.filter(shard.Version.version <= 7):
+        version_object.created = ten_days_ago if version_object.version <= 5 else ten_days_ago + timedelta(days=5)
+    shard.db.commit()
+
+    assert shard.compactor.compact() == 5
+    assert [version for version, in shard.db.query(shard.Version.version).order_by(shard.Version.version)] == \
+        [5, 7, 8, 9, 10]
+    for version in (5, 7, 8, 9, 10):
+        assert plugin.get_csv_at_version("a.csv", version) == contents[version]
+    # Squashed versions are unknown instead of silently returning the content of an older version
+    for version in (1, 2, 3, 4, 6):
+        assert plugin.get_csv_at_version("a.csv", version) is None
+        assert plugin.diff_versions("a.csv", version, 10) is None
+    assert plugin.get_csv_at_version("a.csv", 0) == []
+    assert plugin.diff_versions("a.csv", 0, 5) == ([], contents[5])
+    assert shard.compactor.compact() == 0
+
+
+def test_row_blobs(tmpdir):
+    from _datetime import datetime, timedelta
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_ROW_BLOBS=True, HISTORY_CHECKPOINT_VERSIONS=4,
+                                 HISTORY_CHECKPOINT_ROWS=0,
+                                 HISTORY_RETENTION={"keep_versions": 3, "keep_days": 1, "squash": "daily"})
+    contents = _archive_versions(plugin, "a.csv", 8)
+    shard = plugin.get_shard("a.csv")
+    assert shard.RowBlob.query.count() == 8
+    assert shard.NewRow.query.count() == 0 and shard.MissingRow.query.count() == 0
+
+    plugin.read_model.clear()
+    for version, rows in enumerate(contents):
+        assert plugin.get_csv_at_version("a.csv", version) == rows
+    missing_rows, new_rows = plugin.diff_versions("a.csv", 1, 6)
+    assert apply_delta(contents[1], missing_rows, new_rows) == contents[6]
+    assert plugin.diff_versions("a.csv", 2, 3) == (contents[2][:1], contents[3][-2:])
+
+    # Versions 1 to 5 were archived on the same day and get squashed into version 5
+    ten_days_ago = datetime.utcnow() - timedelta(days=10)
+    for version_object in shard.Version.query.filter(shard.Version.version <= 5):
+        version_object.created = ten_days_ago
+    shard.db.commit()
+    assert shard.compactor.compact() == 4
+    assert shard.RowBlob.query.join(shard.Version, shard.Version.id == shard.RowBlob.version_id) \
+        .filter(shard.Version.csv_file_id.isnot(None)).count() == 4
+    plugin.read_model.clear()
+    for version in (5, 6, 7, 8):
+        assert plugin.get_csv_at_version("a.csv", version) == contents[version]
+    missing_rows, new_rows = plugin.diff_versions("a.csv", 5, 8)
+    assert apply_delta(contents[5], missing_rows, new_rows) == contents[8]
+
+
+def test_delete_csv_history(tmpdir):
+    import time
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_CHECKPOINT_VERSIONS=2, HISTORY_CHECKPOINT_ROWS=0,
+                                 HISTORY_COMPACTION_BATCH_SIZE=3, HISTORY_KEY_COLUMNS={"a.csv": ["name"]})
+    _archive_versions(plugin, "a.csv", 6)
+    contents = _archive_versions(plugin, "b.csv", 3)
+    shard = plugin.get_shard("a.csv")
+    snapshots = shard.Snapshot.query.count()
+
+    # Detached rows are invisible, before they get purged
+    csv_file_object = shard.CsvFile.query.filter_by(name="a.csv").first()
+    shard.compactor.detach_csv_file(csv_file_object.id)
+    shard.db.commit()
+    assert plugin.get_version_summaries("a.csv") == []
+    assert plugin.get_row_lineage("a.csv", "Richard 1") == []
+    assert plugin.search_history("Richard", "a.csv") == []
+    assert shard.Snapshot.query.count() == snapshots
+
+    def _wait_for_deletion(csv_file):
+        for attempt in range(50):
+            if plugin.deletion_jobs[csv_file]["done"]:
+                break
+            time.sleep(0.1)
+        return plugin.deletion_jobs[csv_file]
+
+    plugin.delete_csv_history_background("a.csv")
+    job = _wait_for_deletion("a.csv")
+    assert job["done"] and job["deleted"] == job["total"] > 0
+    assert plugin.threads.get("csv_history_delete_a.csv") is None
+    # Versions and rows of b.csv are left
+    assert shard.Version.query.count() == 3
+    assert shard.RowLineage.query.count() == 0
+    assert shard.Snapshot.query.count() == 1
+    assert plugin.get_csv_at_version("b.csv", 3) == contents[3]
+    # 6 new and 2 missing rows
+    assert len(plugin.search_history("Richard", "b.csv")) == 8
+
+    # Can be started again right away
+    plugin.delete_csv_history_background("a.csv")
+    assert _wait_for_deletion("a.csv")["done"]
+    assert plugin.delete_csv_history("b.csv") > 0
+    assert shard.Version.query.count() == 0
+
+
+def test_search_history(tmpdir, monkeypatch):
+    from csv_manager.plugins.csv_document_plugin import search
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_DATABASE_SHARDS=2)
+    _archive_versions(plugin, "a.csv", 3)
+    _archive_versions(plugin, "b.csv", 1)
+    if not plugin.get_shard("a.csv").search.available:
+        return
+
+    results = plugin.search_history("Paris")
+    assert [(result["csv_file"], result["version"], result["change"]) for result in results] == \
+        [("a.csv", 1, "new"), ("a.csv", 2, "missing"), ("a.csv", 2, "new"), ("a.csv", 3, "new"), ("b.csv", 1, "new")]
+    assert results[0]["row"] == {"name": "Richard 1", "city": "Paris"}
+    assert len(plugin.search_history('"Richard 2" AND Rome', "a.csv")) == 1
+    assert plugin.search_history("Paris", "b.csv", limit=1) == [results[-1]]
+
+    # Versions with more rows than the rowid range of a version get indexed partly
+    monkeypatch.setattr(search, "MAX_VERSION_ENTRIES", 2)
+    plugin._archive_csv_change(plugin, csv_file="c.csv", missing_rows=[],
+                               new_rows=[{"name": "Paul %s" % index} for index in range(3)])
+    assert len(plugin.search_history("Paul", "c.csv")) == 2
+
+
+def test_diff_versions(tmpdir):
+    import json
+
+    plugin = _get_history_plugin(tmpdir)
+    contents = _archive_versions(plugin, "a.csv", 5)
+
+    missing_rows, new_rows = plugin.diff_versions("a.csv", 1, 4)
+    assert apply_delta(contents[1], missing_rows, new_rows) == contents[4]
+    missing_rows, new_rows = plugin.diff_versions("a.csv", 4, 1)
+    assert sorted(map(str, apply_delta(contents[4], missing_rows, new_rows))) == sorted(map(str, contents[1]))
+    assert plugin.diff_versions("a.csv", 0, 6) is None
+
+    # Not served from the read model
+    plugin.read_model.clear()
+    assert plugin.diff_versions("a.csv", 2, 3) == (contents[2][:1], contents[3][-2:])
+
+    client = plugin.app.web.flask.test_client()
+    response = client.get("/csv/api/diff?csv_file=a.csv&from=2&to=3")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{"change": "missing", "row": contents[2][0]}] + \
+        [{"change": "new", "row": row} for row in contents[3][-2:]]
+    assert client.get("/csv/api/diff?csv_file=a.csv&from=0&to=9").status_code == 404
+    assert client.get("/csv/api/diff?csv_file=a.csv&from=x&to=1").status_code == 400
+
+
+def test_json_api(tmpdir):
+    import json
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_DATABASE_SHARDS=2)
+    contents = _archive_versions(plugin, "a.csv", 5)
+    for csv_file in ("e.csv", "b.csv", "d.csv", "c.csv"):
+        plugin._archive_csv_change(plugin, csv_file=csv_file, missing_rows=[], new_rows=[{"name": "Paul"}])
+    client = plugin.app.web.flask.test_client()
+
+    def _get_pages(url, key, name):
+        pages = []
+        cursor = None
+        while True:
+            result = client.get(url + ("&cursor=%s" % cursor if cursor is not None else "")).get_json()
+            pages.append([entry[name] for entry in result[key]])
+            cursor = result["cursor"]
+            if cursor is None:
+                return pages
+
+    for cached in (False, True):
+        plugin.read_model.clear()
+        if cached:
+            plugin.get_csv_files()
+        assert _get_pages("/csv/api/files?limit=2", "files", "name") == \
+            [["a.csv", "b.csv"], ["c.csv", "d.csv"], ["e.csv"]]
+        assert _get_pages("/csv/api/files?limit=0", "files", "name") == \
+            [["a.csv"], ["b.csv"], ["c.csv"], ["d.csv"], ["e.csv"]]
+        assert client.get("/csv/api/files?cursor=e.csv").get_json() == {"files": [], "cursor": None}
+        assert [csv_file.name for csv_file in plugin.get_csv_files(1, 2, after="a.csv")] == ["c.csv", "d.csv"]
+
+        assert _get_pages("/csv/api/versions?csv_file=a.csv&limit=2", "versions", "version") == \
+            [[5, 4], [3, 2], [1]]
+    assert client.get("/csv/api/versions?csv_file=a.csv&cursor=x").status_code == 400
+    assert client.get("/csv/api/versions?cursor=3").status_code == 400
+
+    response = client.get("/csv/api/rows?csv_file=a.csv&version=2")
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{"change": "missing", "row": contents[1][0]}] + \
+        [{"change": "new", "row": row} for row in contents[2][-2:]]
+    for url in ("/csv/api/rows?csv_file=a.csv&version=9", "/csv/api/rows?csv_file=a.csv&version=x",
+                "/csv/api/rows?csv_file=x.csv&version=1"):
+        assert client.get(url).status_code == 404
+
+
+def test_git_storage(tmpdir):
+    import pytest
+    pytest.importorskip("git")
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_STORAGE="git", HISTORY_GIT_PATH=str(tmpdir.join("history_git")))
+    # A failed git commit keeps the rows of version 3 in the history database
+    commit = plugin.git_storage.commit
+
+    def failing_commit(csv_file, version, *args):
+        if version == 3:
+            raise OSError("No space left on device")
+        return commit(csv_file, version, *args)
+
+    plugin.git_storage.commit = failing_commit
+    contents = _archive_versions(plugin, "a.csv", 4)
+
+    shard = plugin.get_shard("a.csv")
+    assert [version.commit_id is not None for version in shard.Version.query.order_by(shard.Version.version)] == \
+        [True, True, False, True]
+    assert shard.db.query(shard.NewRow).count() == 2
+    plugin.read_model.clear()
+    for version, rows in enumerate(contents):
+        assert plugin.get_csv_at_version("a.csv", version) == rows
+    assert list(plugin.iter_version_changes("a.csv", 2)) == [("missing", contents[1][0])] + \
+        [("new", row) for row in contents[2][-2:]]
+    missing_rows, new_rows = plugin.diff_versions("a.csv", 1, 4)
+    assert sorted(map(str, apply_delta(contents[1], missing_rows, new_rows))) == sorted(map(str, contents[4]))
+
+
+def test_git_storage_ragged_rows(tmpdir):
+    import logging
+    import pytest
+    pytest.importorskip("git")
+    from csv_manager.plugins.csv_document_plugin.git_storage import GitHistoryStorage
+
+    storage = GitHistoryStorage(str(tmpdir.join("history_git")), logging.getLogger(__name__))
+    # As returned by csv.DictReader for too short and too long rows, and rows of another header
+    rows = [{"name": "Richard", "city": "Paris"},
+            {"name": "Annabel", "city": None},
+            {"name": "", "city": "Rome", None: ["Italy", ""]},
+            {"name": "Dieter", "city": "Berlin", None: []},
+            {"name": "Paul", "age": "30"},
+            {}]
+    commit_id = storage.commit("a.csv", 1, rows)
+    assert storage.read(commit_id) == rows
+    assert storage.read(storage.commit("a.csv", 2, [], commit_id)) == []
+
+
+def test_segment_row_storage(tmpdir):
+    plugin = _get_history_plugin(tmpdir, HISTORY_STORAGE="segments",
+                                 HISTORY_SEGMENT_PATH=str(tmpdir.join("history_segments")), HISTORY_SEGMENT_SIZE=200)
+    contents = _archive_versions(plugin, "a.csv", 4)
+
+    shard = plugin.get_shard("a.csv")
+    assert all(version.segment is not None for version in shard.Version.query)
+    assert shard.db.query(shard.NewRow).count() == 0
+    plugin.read_model.clear()
+    for version, rows in enumerate(contents):
+        assert plugin.get_csv_at_version("a.csv", version) == rows
+    assert list(plugin.iter_version_changes("a.csv", 2)) == [("missing", contents[1][0])] + \
+        [("new", row) for row in contents[2][-2:]]
+
+    plugin.delete_csv_history("a.csv")
+    assert plugin.segment_storage.compact() == 4
+    # Versions archived after the deletion are kept
+    contents = _archive_versions(plugin, "a.csv", 1)
+    assert plugin.get_csv_at_version("a.csv", 5) == contents[1]
+    assert plugin.segment_storage.compact() == 0
+    assert plugin.get_csv_at_version("a.csv", 5) == contents[1]
+
+
+def test_cell_changes_with_duplicate_key(tmpdir):
+    plugin = _get_history_plugin(tmpdir, HISTORY_CELL_DELTAS=True, HISTORY_KEY_COLUMNS={"a.csv": ["k"]})
+    plugin._archive_csv_change(plugin, csv_file="a.csv", missing_rows=[],
+                               new_rows=[{"k": "1", "v": "a"}, {"k": "1", "v": "b"}])
+    plugin._archive_csv_change(plugin, csv_file="a.csv", missing_rows=[{"k": "1", "v": "b"}],
+                               new_rows=[{"k": "1", "v": "c"}])
+
+    shard = plugin.get_shard("a.csv")
+    assert shard.db.query(shard.CellChange).count() == 1
+    plugin.read_model.clear()
+    assert plugin.get_csv_at_version("a.csv", 2) == [{"k": "1", "v": "a"}, {"k": "1", "v": "c"}]
+    assert plugin.diff_versions("a.csv", 1, 2) == ([{"k": "1", "v": "b"}], [{"k": "1", "v": "c"}])
+
+
+def test_version_summaries(tmpdir):
+    plugin = _get_history_plugin(tmpdir, HISTORY_KEY_COLUMNS={"a.csv": ["name"]})
+    richard = {"name": "Richard", "city": "Paris", "age": "30"}
+    annabel = {"name": "Annabel", "city": "Rome", "age": "25"}
+    dieter = {"name": "Dieter", "city": "Rome", "age": ""}
+    edits = [([], [richard, annabel]),
+             # Richard moves, Annabel leaves, Dieter comes without age
+             ([richard, annabel], [dict(richard, city="Berlin"), dieter]),
+             ([dieter], [dict(dieter, age="unknown")])]
+    for missing_rows, new_rows in edits:
+        plugin._archive_csv_change(plugin, csv_file="a.csv", missing_rows=missing_rows, new_rows=new_rows)
+    plugin._archive_csv_change(plugin, csv_file="b.csv", missing_rows=[], new_rows=[{"name": "Paul"}])
+    plugin._archive_csv_change(plugin, csv_file="b.csv", missing_rows=[{"name": "Paul"}], new_rows=[{"name": "Ada"}])
+
+    shard = plugin.get_shard("a.csv")
+    stored = dict(((summary.csv_file_id, summary.version), summary) for summary in shard.VersionSummary.query)
+    a_id = shard.CsvFile.query.filter_by(name="a.csv").first().id
+    b_id = shard.CsvFile.query.filter_by(name="b.csv").first().id
+    assert [(stored[(a_id, version)].new_rows, stored[(a_id, version)].missing_rows,
+             stored[(a_id, version)].changed_rows, stored[(a_id, version)].changed_columns)
+            for version in (1, 2, 3)] == [(2, 0, 0, []), (2, 2, 1, ["city"]), (1, 1, 1, ["age"])]
+    assert stored[(a_id, 1)].numeric_min == {"age": 25.0} and stored[(a_id, 1)].numeric_max == {"age": 30.0}
+    assert stored[(a_id, 2)].null_counts == {"name": 0, "city": 0, "age": 1}
+    assert stored[(a_id, 2)].numeric_min == {"age": 30.0}
+    assert stored[(a_id, 3)].numeric_min == {}
+    # Without key columns modified rows are unknown
+    assert (stored[(b_id, 2)].new_rows, stored[(b_id, 2)].missing_rows, stored[(b_id, 2)].changed_rows,
+            stored[(b_id, 2)].changed_columns) == (1, 1, None, ["name"])
+
+    plugin.read_model.clear()
+    assert [(summary.version, summary.new_rows, summary.missing_rows, summary.changed_rows)
+            for summary in plugin.get_version_summaries("a.csv")] == [(1, 2, 0, 0), (2, 2, 2, 1), (3, 1, 1, 1)]
+
+
+def test_history_pages(tmpdir):
+    import re
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_VIEW_VERSIONS=4, HISTORY_VIEW_FILES=2, HISTORY_VIEW_ROWS=1)
+    _archive_versions(plugin, "a.csv", 10)
+    for csv_file in ("b.csv", "c.csv"):
+        _archive_versions(plugin, csv_file, 1)
+    client = plugin.app.web.flask.test_client()
+
+    def _get_versions(url):
+        page = client.get(url).get_data(as_text=True)
+        next_before = re.search(r"before=(\d+)", page)
+        return [int(version) for version in re.findall(r"<h4>(\d+) ", page)], \
+            int(next_before.group(1)) if next_before else None
+
+    for clear in (False, True):
+        if clear:
+            # Not served from the read model
+            plugin.read_model.clear()
+        assert _get_versions("/csv/history?csv_file=a.csv") == ([10, 9, 8, 7], 7)
+        assert _get_versions("/csv/history?csv_file=a.csv&before=7") == ([6, 5, 4, 3], 3)
+        assert _get_versions("/csv/history?csv_file=a.csv&before=3") == ([2, 1], None)
+
+    # Only the first rows of each version, the rest gets loaded from the version view
+    page = client.get("/csv/history?csv_file=a.csv").get_data(as_text=True)
+    assert "Load more (2 more changes)" in page
+    page = client.get("/csv/history/version?csv_file=a.csv&version=10&offset=1").get_data(as_text=True)
+    assert "Richard 10" in page
+
+    first_page = client.get("/csv/history").get_data(as_text=True)
+    assert "page=2" in first_page and "Previous files" not in first_page
+    second_page = client.get("/csv/history?page=2").get_data(as_text=True)
+    assert "Previous files" in second_page and "Next files" not in second_page
+    assert len(re.findall(r"csv_file=\w\.csv\">", first_page + second_page)) == 3
+
+
+def test_history_etags(tmpdir):
+    plugin = _get_history_plugin(tmpdir)
+    _archive_versions(plugin, "a.csv", 2)
+    client = plugin.app.web.flask.test_client()
+
+    for url in ("/csv/history", "/csv/history?csv_file=a.csv"):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "no-cache"
+        etag = response.headers["ETag"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.get_data() == b""
+
+        plugin._archive_csv_change(plugin, csv_file="a.csv", missing_rows=[], new_rows=[{"name": "Dieter"}])
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    # Squashing by another process keeps current version and highest version id, but not the summaries
+    etag = client.get("/csv/history?csv_file=a.csv").headers["ETag"]
+    other = _get_history_plugin(tmpdir, HISTORY_RETENTION={"keep_versions": 2, "keep_days": 0, "squash": "all"})
+    assert other.get_shard("a.csv").compactor.compact() == 1
+    response = client.get("/csv/history?csv_file=a.csv", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    revision = plugin.get_version_revision("a.csv", 2)
+    url = "/csv/history/version?csv_file=a.csv&version=2"
+    response = client.get(url)
+    assert response.headers["Cache-Control"] == "no-cache"
+    response = client.get("%s&rev=%s" % (url, revision))
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert client.get("/csv/history/version?csv_file=a.csv&version=9").status_code == 404
+
+
+def test_migrate_archived_versions(tmpdir):
+    from csv_manager.plugins.csv_document_plugin.migrations import SCHEMA_VERSION
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_KEY_COLUMNS={"a.csv": ["name"]})
+    contents = _archive_versions(plugin, "a.csv", 3)
+    summaries = plugin.get_version_summaries("a.csv")
+
+    # Database of a release without commit ids, summaries, lineage and search index
+    shard = plugin.get_shard("a.csv")
+    engine = shard.db.engine
+    for table in ("version_summary", "row_lineage", "row_search"):
+        engine.execute("DELETE FROM %s" % table)
+    for column in ("commit_id", "segment"):
+        engine.execute("ALTER TABLE version DROP COLUMN %s" % column)
+    engine.execute("PRAGMA user_version = 1")
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_KEY_COLUMNS={"a.csv": ["name"]})
+    shard = plugin.get_shard("a.csv")
+    assert shard.db.engine.execute("PRAGMA user_version").scalar() == SCHEMA_VERSION
+    assert [summary[1:] for summary in plugin.get_version_summaries("a.csv")] == \
+        [summary[1:] for summary in summaries]
+    assert [entry["version"] for entry in plugin.get_row_lineage("a.csv", "Richard 1")] == [1, 2, 3]
+    assert [result["version"] for result in plugin.search_history("Rome")] == [1, 2, 3, 3]
+    for version, rows in enumerate(contents):
+        assert plugin.get_csv_at_version("a.csv", version) == rows
+
+    page = plugin.app.web.flask.test_client().get("/csv/history?csv_file=a.csv").get_data(as_text=True)
+    assert all("<h4>%s " % version in page for version in (1, 2, 3))
+
+
+def test_migrate_search_index(tmpdir):
+    plugin = _get_history_plugin(tmpdir)
+    _archive_versions(plugin, "a.csv", 3)
+    if not plugin.get_shard("a.csv").search.available:
+        return
+
+    # Database of a release with summaries, but without search index
+    plugin.get_shard("a.csv").db.engine.execute("DELETE FROM row_search")
+    assert plugin.search_history("Rome") == []
+    for run in range(2):
+        plugin.get_shard("a.csv").db.engine.execute("PRAGMA user_version = 4")
+        plugin = _get_history_plugin(tmpdir)
+        # Versions with index entries are not indexed again
+        assert [result["version"] for result in plugin.search_history("Rome")] == [1, 2, 3, 3]
+
+
+def test_migrate_row_lineage(tmpdir):
+    plugin = _get_history_plugin(tmpdir, HISTORY_KEY_COLUMNS={"a.csv": ["name"]})
+    _archive_versions(plugin, "a.csv", 3)
+    _archive_versions(plugin, "b.csv", 2)
+    lineage = plugin.get_row_lineage("a.csv", "Richard 1")
+
+    # Database of a release with summaries, but without row lineage
+    plugin.get_shard("a.csv").db.engine.execute("DELETE FROM row_lineage")
+    for run in range(2):
+        plugin.get_shard("a.csv").db.engine.execute("PRAGMA user_version = 5")
+        plugin = _get_history_plugin(tmpdir, HISTORY_KEY_COLUMNS={"a.csv": ["name"]})
+        # Versions with lineage entries and files without key columns are skipped
+        assert plugin.get_row_lineage("a.csv", "Richard 1") == lineage
+        assert plugin.get_shard("a.csv").RowLineage.query.count() == 5
+
+
+def test_migrate_local_timestamps(tmpdir, monkeypatch):
+    import time
+    from _datetime import datetime
+
+    plugin = _get_history_plugin(tmpdir)
+    _archive_versions(plugin, "a.csv", 3)
+    _archive_versions(plugin, "b.csv", 1)
+
+    # Database of a release, which stored str(datetime.now()) in local time
+    engine = plugin.get_shard("a.csv").db.engine
+    local_times = {("a.csv", 1): "2017-05-01 12:30:00.250000", ("a.csv", 2): "2017-05-01 12:31:00",
+                   ("a.csv", 3): "2017-05-01 12:32:00", ("b.csv", 1): "2017-05-01 12:31:00"}
+    for (csv_file, version), created in local_times.items():
+        engine.execute("UPDATE version SET created = ? WHERE version = ? AND csv_file_id = "
+                       "(SELECT id FROM csv_file WHERE name = ?)", created, version, csv_file)
+    engine.execute("UPDATE csv_file SET created = '2017-05-01 12:30:00.250000'")
+    engine.execute("PRAGMA user_version = 0")
+
+    monkeypatch.setenv("TZ", "Europe/Berlin")
+    time.tzset()
+    try:
+        plugin = _get_history_plugin(tmpdir)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    # Central European Summer Time is two hours ahead of UTC
+    assert [csv_file.created for csv_file in plugin.get_csv_files()] == [datetime(2017, 5, 1, 10, 30, 0, 250000)] * 2
+    changes, cursor = plugin.get_changes()
+    assert [(change["csv_file"], change["version"], change["created"]) for change in changes] == \
+        [("a.csv", 1, datetime(2017, 5, 1, 10, 30, 0, 250000)), ("a.csv", 2, datetime(2017, 5, 1, 10, 31)),
+         ("b.csv", 1, datetime(2017, 5, 1, 10, 31)), ("a.csv", 3, datetime(2017, 5, 1, 10, 32))]
+    assert cursor is None
+
+    client = plugin.app.web.flask.test_client()
+
+    def _get_changes(query):
+        response = client.get("/csv/api/changes?%s" % query)
+        assert response.status_code == 200
+        return [(change["csv_file"], change["version"]) for change in response.get_json()["changes"]]
+
+    # start is inclusive, end exclusive
+    assert _get_changes("start=2017-05-01 10:31&end=2017-05-01 10:32") == [("a.csv", 2), ("b.csv", 1)]
+    assert _get_changes("start=2017-05-01T10:30:00.25&end=2017-05-01 10:31") == [("a.csv", 1)]
+    assert _get_changes("start=2017-05-01 10:30:00.250001&end=2017-05-01 10:31:00.000001") == \
+        [("a.csv", 2), ("b.csv", 1)]
+    assert _get_changes("start=2017-05-01 10:32") == [("a.csv", 3)]
+    assert _get_changes("end=2017-05-01") == []
+    assert client.get("/csv/api/changes").get_json()["changes"][0]["created"] == "2017-05-01T10:30:00.250000"
+
+    pages = []
+    cursor = ""
+    while cursor is not None:
+        result = client.get("/csv/api/changes?start=2017-05-01 10:31&limit=1&cursor=%s" % cursor).get_json()
+        pages.append([(change["csv_file"], change["version"]) for change in result["changes"]])
+        cursor = result["cursor"]
+    assert pages == [[("a.csv", 2)], [("b.csv", 1)], [("a.csv", 3)]]
+
+    for query in ("start=yesterday", "end=2017-13-01", "cursor=invalid"):
+        assert client.get("/csv/api/changes?%s" % query).status_code == 400
+
+
+def test_read_model_validation(tmpdir):
+    import re
+
+    plugin = _get_history_plugin(tmpdir)
+    _archive_versions(plugin, "a.csv", 3)
+    client = plugin.app.web.flask.test_client()
+    response = client.get("/csv/history?csv_file=a.csv")
+    etag = response.headers["ETag"]
+    plugin.get_csv_files()
+
+    # Own archived versions keep the read model valid
+    plugin._archive_csv_change(plugin, csv_file="a.csv", missing_rows=[], new_rows=[{"name": "Dieter"}])
+    assert [version.version for version in plugin.get_versions_page("a.csv")[0]] == [4, 3, 2, 1]
+    assert plugin.read_model.get_versions("a.csv") is not None
+    assert plugin.read_model.get_diff("a.csv", 4) is not None
+    assert plugin.get_csv_files()[0].current_version == 4
+    assert plugin.read_model.get_files() is not None
+
+    # Changes of another process, e.g. a command
+    other = _get_history_plugin(tmpdir)
+    other.delete_csv_history("a.csv")
+    other._archive_csv_change(other, csv_file="b.csv", missing_rows=[], new_rows=[{"name": "Paul"}])
+
+    response = client.get("/csv/history?csv_file=a.csv", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert re.findall(r"<h4>(\d+) ", response.get_data(as_text=True)) == []
+    assert plugin.diff_versions("a.csv", 1, 4) is None
+    assert [csv_file.name for csv_file in plugin.get_csv_files()] == ["a.csv", "b.csv"]
+
+
+def test_fragments_survive_restart(tmpdir):
+    fragment_path = str(tmpdir.join("fragments"))
+    plugin = _get_history_plugin(tmpdir, HISTORY_FRAGMENT_PATH=fragment_path)
+    _archive_versions(plugin, "a.csv", 3)
+    page = plugin.app.web.flask.test_client().get("/csv/history?csv_file=a.csv").get_data(as_text=True)
+    fragment_files = sorted(path.basename for path in tmpdir.join("fragments").visit() if path.isfile())
+    assert len(fragment_files) == 3
+
+    # A restarted server serves the stored snippets, without loading any changes
+    other = _get_history_plugin(tmpdir, HISTORY_FRAGMENT_PATH=fragment_path)
+    revision = other.get_version_revision("a.csv", 3)
+    assert other.fragment_cache.get("a.csv", 3, "html_50_%s" % revision) is not None
+    other._get_version_changes = None
+    assert other.app.web.flask.test_client().get("/csv/history?csv_file=a.csv").get_data(as_text=True) == page
+    assert sorted(path.basename for path in tmpdir.join("fragments").visit() if path.isfile()) == fragment_files
+
+
+def test_change_stream(tmpdir):
+    import json
+    from datetime import timedelta
+
+    plugin = _get_history_plugin(tmpdir, HISTORY_STREAM_KEEPALIVE=0.1)
+    _archive_versions(plugin, "a.csv", 3)
+    changes, cursor = plugin.get_changes(limit=1)
+    client = plugin.app.web.flask.test_client()
+    assert client.get("/csv/stream", headers={"Last-Event-ID": "invalid"}).status_code == 400
+
+    response = client.get("/csv/stream", headers={"Last-Event-ID": cursor}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    events = (json.loads(chunk.decode("utf-8").split("data: ", 1)[1]) for chunk in response.iter_encoded()
+              if b"event: change" in chunk)
+
+    # Catch-up from the archive
+    assert [next(events)["version"] for _ in range(2)] == [2, 3]
+
+    # The late published event of an archived change is not sent twice. A live change, which was
+    # created before the last replayed one, but committed later, still gets delivered.
+    last = plugin.get_changes(cursor=cursor)[0][-1]
+    plugin.broadcaster.publish(plugin._get_stream_event("a.csv", 3, last["created"], [], []))
+    plugin.broadcaster.publish(plugin._get_stream_event("b.csv", 1, last["created"] - timedelta(seconds=1),
+                                                        [], [{"name": "Paul"}]))
+    plugin._archive_csv_change(plugin, csv_file="a.csv", missing_rows=[], new_rows=[{"name": "Dieter"}])
+    event = next(events)
+    assert (event["csv_file"], event["version"], event["new_rows"]) == ("b.csv", 1, [{"name": "Paul"}])
+    event = next(events)
+    assert (event["csv_file"], event["version"], event["new_rows"]) == ("a.csv", 4, [{"name": "Dieter"}])
+    response.close()
+    assert plugin.broadcaster._subscriptions == set()
+
+
+def test_replay_history(tmpdir):
+    plugin = _get_history_plugin(tmpdir)
+    contents = _archive_versions(plugin, "a.csv", 4)
+    plugin._archive_csv_change(plugin, csv_file="b.csv", missing_rows=[], new_rows=[{"name": "Paul"}])
+    fresh = _get_history_plugin(tmpdir.mkdir("fresh"))
+    targets = [fresh]
+
+    replayed = []
+
+    def _receiver(sender, **kwargs):
+        replayed.append((kwargs["csv_file"], kwargs["version"], kwargs["replay"]))
+        targets[-1]._archive_csv_change(targets[-1], csv_file=kwargs["csv_file"], missing_rows=kwargs["missing_rows"],
+                                        new_rows=kwargs["new_rows"])
+
+    plugin.signals.connect("replay_receiver", "csv_watcher_change", _receiver, "fills a fresh history")
+    assert plugin.replay_history("a.csv", speed=0) == 4
+    assert replayed == [("a.csv", version, True) for version in range(1, 5)]
+    # The source archive ignores replayed changes
+    assert plugin.get_csv_files()[0].current_version == 4
+
+    assert [version.version for version in fresh.get_versions_page("a.csv")[0]] == [4, 3, 2, 1]
+    for version, rows in enumerate(contents):
+        assert fresh.get_csv_at_version("a.csv", version) == rows
+
+    # Without csv file, all files get replayed in the order they were archived
+    del replayed[:]
+    targets.append(_get_history_plugin(tmpdir.mkdir("fresh_all")))
+    assert plugin.replay_history(speed=0, batch_size=2) == 5
+    assert [(csv_file, version) for csv_file, version, replay in replayed] == \
+        [("a.csv", version) for version in range(1, 5)] + [("b.csv", 1)]
+    assert targets[-1].get_csv_at_version("a.csv", 4) == contents[4]
+    assert targets[-1].get_csv_at_version("b.csv", 1) == [{"name": "Paul"}]